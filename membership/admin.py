@@ -1,6 +1,6 @@
 from django.contrib import admin
 from membership.models import Membership, Contact, Fee, BillingCycle, Bill,\
-    Payment
+    Payment, OutgoingEmail
 
 
 class ContactAdmin(admin.ModelAdmin):
@@ -31,3 +31,4 @@ admin.site.register(Fee)
 admin.site.register(BillingCycle)
 admin.site.register(Bill)
 admin.site.register(Payment)
+admin.site.register(OutgoingEmail)
@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+"""
+Running payment imports queued from the web UI as ImportJobs.
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists
+
+from membership.billing.payments import process_payment_file, OpDictReader, ProcountorDictReader
+from membership.models import ImportJob, IMPORT_JOB_QUEUED, IMPORT_JOB_RUNNING, IMPORT_JOB_DONE, \
+    IMPORT_JOB_FAILED
+
+logger = logging.getLogger("membership.billing.import_jobs")
+
+READERS = {
+    'op': OpDictReader,
+    'procountor': ProcountorDictReader,
+}
+
+
+def worker_name():
+    """Identifies the process running a job"""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def _stale():
+    """Running jobs whose worker has not reported for IMPORT_JOB_STALE_SECONDS"""
+    limit = datetime.now() - timedelta(seconds=settings.IMPORT_JOB_STALE_SECONDS)
+    return ImportJob.objects.filter(status=IMPORT_JOB_RUNNING, heartbeat__lt=limit)
+
+
+def requeue_interrupted_jobs():
+    """
+    Queue again jobs left running by a stopped worker. The import resumes
+    from its checkpoint. Jobs whose worker is still reporting progress
+    are left alone.
+    """
+    count = _stale().update(status=IMPORT_JOB_QUEUED, worker='', heartbeat=None)
+    if count:
+        logger.warning("Requeued %d interrupted payment import jobs." % count)
+    return count
+
+
+def claim_next_job(worker=None):
+    """
+    Mark the oldest queued job running and return it.
+
+    Imports are run one at a time: no job is claimed while another one
+    is running. The claim is a single update conditional on no job
+    running, and on databases supporting it the queued and running jobs
+    are locked first, so concurrent workers claim one after another.
+    """
+    if worker is None:
+        worker = worker_name()
+    with transaction.atomic():
+        jobs = list(ImportJob.objects.select_for_update()
+                    .filter(status__in=[IMPORT_JOB_QUEUED, IMPORT_JOB_RUNNING])
+                    .order_by('id').values_list('id', 'status'))
+        queued = [job_id for job_id, status in jobs if status == IMPORT_JOB_QUEUED]
+        if len(queued) < len(jobs) or not queued:
+            return None
+        now = datetime.now()
+        claimed = ImportJob.objects.annotate(
+            busy=Exists(ImportJob.objects.filter(status=IMPORT_JOB_RUNNING))
+        ).filter(id=queued[0], status=IMPORT_JOB_QUEUED, busy=False).update(
+            status=IMPORT_JOB_RUNNING, started=now, worker=worker, heartbeat=now)
+    if not claimed:
+        return None
+    return ImportJob.objects.get(id=queued[0])
+
+
+class Heartbeat(threading.Thread):
+    """
+    Updates the heartbeat of a running job every interval seconds, also
+    while a slow chunk of the import is being processed
+    """
+
+    def __init__(self, job, interval=None):
+        super(Heartbeat, self).__init__(name="heartbeat-%d" % job.id, daemon=True)
+        if interval is None:
+            interval = max(1, settings.IMPORT_JOB_STALE_SECONDS / 4)
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                ImportJob.objects.filter(id=self.job.id, status=IMPORT_JOB_RUNNING,
+                                         worker=self.job.worker).update(heartbeat=datetime.now())
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job):
+    """Import the payment file of a claimed job and store the outcome"""
+    logger.info("Starting payment import job %s." % repr(job))
+
+    def progress(rows, rate):
+        ImportJob.objects.filter(id=job.id).update(rows=rows, heartbeat=datetime.now())
+
+    try:
+        job.file.open('rb')
+        try:
+            with Heartbeat(job):
+                import_messages = process_payment_file(job.file, reader_class=READERS[job.format],
+                                                       user=job.user, progress=progress)
+        finally:
+            job.file.close()
+    except Exception:
+        logger.error("%s" % traceback.format_exc())
+        logger.error("Payment import job %s failed." % repr(job))
+        job.status = IMPORT_JOB_FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = IMPORT_JOB_DONE
+        job.messages = json.dumps([(cycle, payment, str(msg)) for cycle, payment, msg in import_messages])
+        logger.info("Payment import job %s done." % repr(job))
+    job.rows = ImportJob.objects.get(id=job.id).rows
+    job.finished = datetime.now()
+    job.save()
+    if job.status == IMPORT_JOB_DONE:
+        # The file name is kept for the job listing. A failed import
+        # resumes from its checkpoint when the file is imported again.
+        job.file.storage.delete(job.file.name)
+    return job
+
+
+def run_queued_jobs():
+    """Run queued jobs until the queue is empty. Returns number of jobs run."""
+    count = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
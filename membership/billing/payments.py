@@ -1,26 +1,38 @@
 # encoding: utf-8
 
 import csv
+import hashlib
+import time
 
 from datetime import datetime, timedelta
 
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
 
 import logging
 
-from membership.models import BillingCycle, Payment
-from membership.utils import log_change
+from membership.models import BillingCycle, Payment, PaymentImportCheckpoint
+from membership.utils import log_change, log_changes
 
 from decimal import Decimal
 
 logger = logging.getLogger(__name__)
 
+# Payment rows handled in one transaction
+PAYMENT_CHUNK_SIZE = 1000
+
 
 class PaymentFromFutureException(Exception):
     pass
 
 
+class CheckpointMismatchException(Exception):
+    pass
+
+
 class RequiredFieldNotFoundException(Exception):
     pass
 
@@ -165,28 +177,32 @@ def attach_payment_to_cycle(payment, user=None):
     return cycle
 
 
+def _new_payment(row):
+    # Bank statement events have float amounts
+    amount = Payment._meta.get_field('amount').to_python(row['amount'])
+    return Payment(payment_day=min(datetime.now(), row['date']),
+                   amount=amount,
+                   type=row['event_type_description'],
+                   payer_name=row['fromto'],
+                   reference_number=row['reference'],
+                   message=row['message'][:255],
+                   transaction_id=row['transaction'])
+
+
 def row_to_payment(row):
     try:
         p = Payment.objects.get(transaction_id__exact=row['transaction'])
         return p
     except Payment.DoesNotExist:
-        p = Payment(payment_day=min(datetime.now(), row['date']),
-                    amount=row['amount'],
-                    type=row['event_type_description'],
-                    payer_name=row['fromto'],
-                    reference_number=row['reference'],
-                    message=row['message'][:255],
-                    transaction_id=row['transaction'])
+        p = _new_payment(row)
     return p
 
 
-def process_payments(reader, user=None):
+def _payment_rows(reader, chunk_size):
     """
-    Attach bank account events from reader to payments
+    Read incoming payment rows from reader in lists of chunk_size rows.
     """
-    return_messages = []
-    num_attached = num_notattached = 0
-    sum_attached = sum_notattached = 0
+    chunk = []
     for row in reader:
         if row is None:
             continue
@@ -195,36 +211,198 @@ def process_payments(reader, user=None):
         # Payment in future more than 1 day is a fatal error
         if row['date'] > datetime.now() + timedelta(days=1):
             raise PaymentFromFutureException("Payment date in future")
-        payment = row_to_payment(row)
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-        # Do nothing if this payment has already been assigned or ignored
-        if payment.billingcycle or payment.ignore:
-            continue
 
-        try:
-            cycle = attach_payment_to_cycle(payment, user=user)
-            if cycle:
+class PaymentBatch(object):
+    """
+    Attach one chunk of payment rows to billing cycles.
+
+    Existing payments, billing cycles and amounts paid for the chunk are
+    loaded with a fixed number of queries, the rules of process_payments
+    are applied in memory and the changes are written with bulk inserts
+    and updates in one transaction.
+    """
+
+    def __init__(self, rows, user=None):
+        self.rows = rows
+        self.user = user
+        self.messages = []
+        self.num_attached = self.num_notattached = 0
+        self.sum_attached = self.sum_notattached = 0
+
+        self.payments = {p.transaction_id: p for p in
+                         Payment.objects.filter(transaction_id__in={row['transaction'] for row in rows})}
+        references = {row['reference'] for row in rows}
+        references.update(p.reference_number for p in self.payments.values())
+        self.cycles = {}
+        for cycle in BillingCycle.objects.filter(reference_number__in=references):
+            self.cycles.setdefault(cycle.reference_number, []).append(cycle)
+        self.paid = {cycle.id: cycle.paid_total for cycles in self.cycles.values() for cycle in cycles}
+        self.paid_cycles = {}
+
+        self.new_payments = []
+        self.changed_payments = []
+        self.changed_cycles = []
+        self.log_entries = []
+        self._log_user = None
+
+    def _get_cycle(self, reference):
+        cycles = self.cycles.get(reference, [])
+        if not cycles:
+            raise BillingCycle.DoesNotExist()
+        if len(cycles) > 1:
+            raise BillingCycle.MultipleObjectsReturned(
+                "get() returned more than one BillingCycle -- it returned %d!" % len(cycles))
+        return cycles[0]
+
+    def _changed(self, payment):
+        if payment.pk and payment not in self.changed_payments:
+            self.changed_payments.append(payment)
+
+    def _update_is_paid(self, cycle):
+        """Same as BillingCycle.update_is_paid()"""
+        was_paid = cycle.is_paid
+        total_paid = self.paid.get(cycle.id, Decimal('0'))
+        if not was_paid and total_paid >= cycle.sum:
+            cycle.is_paid = True
+            logger.info("BillingCycle %s marked as paid, total paid: %.2f." % (
+                repr(cycle), total_paid))
+        elif was_paid and total_paid < cycle.sum:
+            cycle.is_paid = False
+            logger.info("BillingCycle %s marked as unpaid, total paid: %.2f." % (
+                repr(cycle), total_paid))
+        if cycle.is_paid != was_paid and cycle not in self.changed_cycles:
+            self.changed_cycles.append(cycle)
+        if self.user:
+            self.log_entries.append((cycle, self.user, "Marked as paid"))
+
+    def _attach(self, payment, cycle):
+        """Same as Payment.attach_to_cycle()"""
+        payment.billingcycle = cycle
+        payment.ignore = False
+        self._changed(payment)
+        logger.info("Payment %s attached to member %s cycle %s." % (repr(payment),
+            cycle.membership_id, repr(cycle)))
+        if self.user:
+            self.log_entries.append((payment, self.user, "Attached to billing cycle"))
+        self.paid[cycle.id] = self.paid.get(cycle.id, Decimal('0')) + payment.amount
+        self.paid_cycles[cycle.id] = cycle
+        self._update_is_paid(cycle)
+
+    def process(self):
+        """
+        :return: list of messages, message tuples contain a payment instead of payment id
+        """
+        for row in self.rows:
+            payment = self.payments.get(row['transaction'])
+            is_new = payment is None
+            if is_new:
+                payment = _new_payment(row)
+                self.payments[payment.transaction_id] = payment
+                self.new_payments.append(payment)
+
+            # Do nothing if this payment has already been assigned or ignored
+            if payment.billingcycle_id or payment.ignore:
+                continue
+
+            try:
+                cycle = self._get_cycle(payment.reference_number)
+            except BillingCycle.DoesNotExist:
+                # Failed to find cycle for this reference number
+                if is_new:
+                    logger.warning("No billing cycle found for %s" % payment.reference_number)
+                    self.messages.append((None, payment, _("No billing cycle found for %s") % payment))
+                    self.num_notattached = self.num_notattached + 1
+                    self.sum_notattached = self.sum_notattached + payment.amount
+                continue
+
+            if cycle.is_paid is False or self.paid.get(cycle.id, Decimal('0')) < cycle.sum:
+                self._attach(payment, cycle)
                 msg = _("Attached payment %(payment)s to cycle %(cycle)s") % {
                         'payment': str(payment), 'cycle': str(cycle)}
                 logger.info(msg)
-                return_messages.append((None, None, msg))
-                num_attached = num_attached + 1
-                sum_attached = sum_attached + payment.amount
+                self.messages.append((None, None, msg))
+                self.num_attached = self.num_attached + 1
+                self.sum_attached = self.sum_attached + payment.amount
             else:
-                # Payment not attached to cycle because enough payments were attached
+                # Don't attach a payment to a cycle with enough payments
+                payment.comment = _('duplicate payment')
+                payment.duplicate = True
+                self._changed(payment)
+                if self._log_user is None:
+                    self._log_user = User.objects.get(id=1)
+                self.log_entries.append((payment, self._log_user,
+                                         "Payment not attached due to duplicate payment"))
                 msg = _("Billing cycle already paid for %s. Payment not attached.") % payment
-                return_messages.append((None, None, msg))
+                self.messages.append((None, None, msg))
                 logger.info(msg)
-                num_notattached = num_notattached + 1
-                sum_notattached = sum_notattached + payment.amount
-        except BillingCycle.DoesNotExist:
-            # Failed to find cycle for this reference number
-            if not payment.id:
-                payment.save()  # Only save if object not in database yet
-                logger.warning("No billing cycle found for %s" % payment.reference_number)
-                return_messages.append((None, payment.id, _("No billing cycle found for %s") % payment))
-                num_notattached = num_notattached + 1
-                sum_notattached = sum_notattached + payment.amount
+                self.num_notattached = self.num_notattached + 1
+                self.sum_notattached = self.sum_notattached + payment.amount
+
+    @transaction.atomic
+    def save(self):
+        Payment.objects.bulk_create(self.new_payments)
+        if any(payment.pk is None for payment in self.new_payments):
+            ids = dict(Payment.objects.filter(
+                transaction_id__in=[payment.transaction_id for payment in self.new_payments]
+            ).values_list('transaction_id', 'id'))
+            for payment in self.new_payments:
+                payment.pk = ids[payment.transaction_id]
+        if self.changed_payments:
+            Payment.objects.bulk_update(self.changed_payments,
+                                        ['billingcycle', 'ignore', 'comment', 'duplicate'])
+        if self.changed_cycles:
+            BillingCycle.objects.bulk_update(self.changed_cycles, ['is_paid'])
+        if self.paid_cycles:
+            # Incremented in the database to keep concurrent changes
+            cycles = list(self.paid_cycles.values())
+            for cycle in cycles:
+                cycle.paid_total = F('paid_total') + (self.paid[cycle.id] - cycle.paid_total)
+            BillingCycle.objects.bulk_update(cycles, ['paid_total'])
+            for cycle in cycles:
+                cycle.paid_total = self.paid[cycle.id]
+        for payment in self.new_payments + self.changed_payments:
+            payment._saved_paid_state = (payment.billingcycle_id, payment.amount)
+        log_changes(self.log_entries)
+
+        for payment in self.new_payments:
+            post_save.send(sender=Payment, instance=payment, created=True,
+                           update_fields=None, raw=False, using=Payment.objects.db)
+        for payment in self.changed_payments:
+            post_save.send(sender=Payment, instance=payment, created=False,
+                           update_fields=None, raw=False, using=Payment.objects.db)
+        for cycle in self.changed_cycles:
+            post_save.send(sender=BillingCycle, instance=cycle, created=False,
+                           update_fields=None, raw=False, using=BillingCycle.objects.db)
+
+        return [(a, b.id if isinstance(b, Payment) else b, msg) for a, b, msg in self.messages]
+
+
+def _import_chunks(chunks, user=None, on_chunk=None):
+    """
+    Process lists of payment rows, each list in its own transaction.
+    :param on_chunk: called with the rows in the transaction of each chunk
+    """
+    return_messages = []
+    num_attached = num_notattached = 0
+    sum_attached = sum_notattached = 0
+    for rows in chunks:
+        batch = PaymentBatch(rows, user=user)
+        batch.process()
+        with transaction.atomic():
+            return_messages += batch.save()
+            if on_chunk:
+                on_chunk(rows)
+        num_attached += batch.num_attached
+        num_notattached += batch.num_notattached
+        sum_attached += batch.sum_attached
+        sum_notattached += batch.sum_notattached
 
     log_message = "Processed %s payments total %.2f EUR. Unidentified payments: %s (%.2f EUR)" % (
         num_attached + num_notattached, sum_attached + sum_notattached, num_notattached,
@@ -232,3 +410,140 @@ def process_payments(reader, user=None):
     logger.info(log_message)
     return_messages.append((None, None, log_message))
     return return_messages
+
+
+def process_payments(reader, user=None, chunk_size=PAYMENT_CHUNK_SIZE):
+    """
+    Attach bank account events from reader to payments
+
+    Rows are processed in chunks of chunk_size rows, each chunk in
+    its own transaction.
+    """
+    return _import_chunks(_payment_rows(reader, chunk_size), user=user)
+
+
+class CSVLineSource(object):
+    """
+    Decoded lines of a binary CSV file for csv readers.
+
+    The header line is always read from the beginning of the file, the
+    rest starting from start_offset. offset is the byte offset of the
+    input consumed so far.
+    """
+
+    def __init__(self, file_handle, encoding='ISO-8859-1', start_offset=0):
+        self.file_handle = file_handle
+        self.encoding = encoding
+        self.start_offset = start_offset
+        self.offset = 0
+
+    def __iter__(self):
+        self.file_handle.seek(0)
+        header = self.file_handle.readline()
+        self.offset = len(header)
+        yield header.decode(self.encoding)
+        if self.start_offset > self.offset:
+            self.file_handle.seek(self.start_offset)
+            self.offset = self.start_offset
+        while True:
+            line = self.file_handle.readline()
+            if not line:
+                break
+            self.offset += len(line)
+            yield line.decode(self.encoding)
+
+
+def file_hash(file_handle):
+    """SHA-256 of a binary file, read in blocks"""
+    digest = hashlib.sha256()
+    file_handle.seek(0)
+    for block in iter(lambda: file_handle.read(65536), b''):
+        digest.update(block)
+    file_handle.seek(0)
+    return digest.hexdigest()
+
+
+def _line_before(file_handle, offset, block_size=4096):
+    """The line of a binary file ending at byte offset"""
+    end = offset
+    data = b''
+    while end > 0:
+        start = max(0, end - block_size)
+        file_handle.seek(start)
+        data = file_handle.read(end - start) + data
+        end = start
+        newline = data.rstrip(b'\r\n').rfind(b'\n')
+        if newline >= 0:
+            return data[newline + 1:]
+    return data
+
+
+def _transaction_before(file_handle, offset, reader_class, encoding='ISO-8859-1'):
+    """
+    Transaction id of the row ending at byte offset, None if it is not
+    a payment row
+    """
+    file_handle.seek(0)
+    header = file_handle.readline()
+    if offset <= len(header):
+        return None
+    lines = [header.decode(encoding), _line_before(file_handle, offset).decode(encoding)]
+    try:
+        row = next(iter(reader_class(lines)))
+    except Exception:
+        # Not a complete row of this format
+        return None
+    return row['transaction'] if row else None
+
+
+def process_payment_file(file_handle, reader_class=OpDictReader, user=None,
+                         chunk_size=PAYMENT_CHUNK_SIZE, progress=None):
+    """
+    Streaming import of a binary payment CSV file.
+
+    The file is read incrementally and committed in chunks of chunk_size
+    rows. The position after each committed chunk is stored in a
+    PaymentImportCheckpoint, so importing the same file again continues
+    from where the previous import stopped. The import is not resumed if
+    the row before the checkpoint is not the last one imported.
+
+    :param reader_class: OpDictReader or ProcountorDictReader
+    :param progress: called after each chunk with row count and rows per second
+    :return: import messages as from process_payments
+    """
+    checkpoint, created = PaymentImportCheckpoint.objects.get_or_create(
+        file_hash=file_hash(file_handle))
+    if checkpoint.finished:
+        msg = "File already imported (%d payment rows)." % checkpoint.rows
+        logger.info(msg)
+        return [(None, None, msg)]
+    if checkpoint.byte_offset:
+        last_transaction_id = _transaction_before(file_handle, checkpoint.byte_offset, reader_class)
+        if last_transaction_id != checkpoint.last_transaction_id:
+            raise CheckpointMismatchException(
+                "Row before byte %d is transaction %s, not %s as recorded in the checkpoint" % (
+                    checkpoint.byte_offset, last_transaction_id, checkpoint.last_transaction_id))
+        logger.info("Resuming payment import at byte %d after transaction %s." % (
+            checkpoint.byte_offset, checkpoint.last_transaction_id))
+
+    source = CSVLineSource(file_handle, start_offset=checkpoint.byte_offset)
+    reader = reader_class(source)
+    started = time.monotonic()
+    stats = {'rows': 0}
+
+    def on_chunk(rows):
+        checkpoint.byte_offset = source.offset
+        checkpoint.last_transaction_id = rows[-1]['transaction']
+        checkpoint.rows += len(rows)
+        checkpoint.save()
+        stats['rows'] += len(rows)
+        rate = stats['rows'] / max(time.monotonic() - started, 0.001)
+        logger.info("Imported %d payment rows, %.1f rows/s." % (stats['rows'], rate))
+        if progress:
+            progress(stats['rows'], rate)
+
+    return_messages = _import_chunks(_payment_rows(reader, chunk_size), user=user, on_chunk=on_chunk)
+    checkpoint.byte_offset = source.offset
+    checkpoint.finished = True
+    checkpoint.save()
+    return return_messages
@@ -4,13 +4,15 @@
 Code to make pdf bills and reminders
 """
 
+from membership.billing.render_context import BillRenderContext
 from membership.reference_numbers import barcode_4
-from membership.utils import group_iban, group_reference
+from membership.utils import group_iban
 
 from django.conf import settings
 
 import os
-from decimal import Decimal
+import json
+import hashlib
 from datetime import datetime, timedelta
 
 from reportlab.pdfgen import canvas
@@ -22,16 +24,36 @@ from reportlab.graphics.barcode import code128
 
 from email import utils as emailutils
 
-import locale
 
 PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..//'))
 
-pdfmetrics.registerFont(TTFont('Arial', os.path.join(settings.FONT_PATH, 'Arial.ttf')))
-pdfmetrics.registerFont(TTFont('IstokWeb', os.path.join(settings.FONT_PATH, 'IstokWeb-Regular.ttf')))
-pdfmetrics.registerFont(TTFont('IstokWeb-Bold', os.path.join(settings.FONT_PATH, 'IstokWeb-Bold.ttf')))
+FONTS = {
+    'Arial': 'Arial.ttf',
+    'IstokWeb': 'IstokWeb-Regular.ttf',
+    'IstokWeb-Bold': 'IstokWeb-Bold.ttf',
+}
+_fonts_registered = False
+
+
+def register_fonts():
+    """
+    Register the TrueType fonts, once per process on first use
+    """
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    for name, filename in FONTS.items():
+        pdfmetrics.registerFont(TTFont(name, os.path.join(settings.FONT_PATH, filename)))
+    _fonts_registered = True
 
 LOGO = os.path.join(settings.IMG_PATH, 'kapsi-logo.jpg')
 
+# Increase when the layout changes to invalidate cached pdfs
+TEMPLATE_VERSION = 2
+
+# Name of the form XObject with the static part of the layout
+TEMPLATE_FORM = 'PageTemplate'
+
 
 # Unit is centimeter from left upper corner of page
 
@@ -51,6 +73,7 @@ class PDFTemplate(object):
         :param filehandle: Filename or file-like object
         :param cycle: optional billingcycle object
         """
+        register_fonts()
         self._dpi = 300.0
         self._scale = float(self._dpi / 72.0)
         self.size = (self.scale(A4[0], False), self.scale(A4[1], False))
@@ -73,26 +96,29 @@ class PDFTemplate(object):
     def reset(self):
         self.canvas = canvas.Canvas(self._filehandle, pagesize=A4,
                                     bottomup=1)
+        self._template_form = False
 
-    def addCycle(self, cycle, payments=None):
+    def addCycle(self, cycle, payments=None, context=None):
         self.canvas.scale(72.0 / self._dpi, 72.0 / self._dpi)
-        self.createData(cycle, payments=payments)
+        self.createData(cycle, payments=payments, context=context)
         self.addTemplate()
         self.addContent()
         self.canvas.showPage()
         self.page_count += 1
 
-    def addBill(self, bill, payments=None):
+    def addBill(self, bill, payments=None, context=None):
         self.canvas.scale(72.0 / self._dpi, 72.0 / self._dpi)
-        self.createData(cycle=bill.billingcycle, bill=bill, payments=payments)
+        self.createData(cycle=bill.billingcycle, bill=bill, payments=payments, context=context)
         self.addTemplate()
         self.addContent()
         self.canvas.showPage()
         self.page_count += 1
 
-    def addCycles(self, cycles, payments=None):
+    def addCycles(self, cycles, payments=None, context=None):
+        if context is None:
+            context = BillRenderContext(cycles=cycles, payments=payments)
         for cycle in cycles:
-            self.addCycle(cycle, payments=payments)
+            self.addCycle(cycle, payments=payments, context=context)
 
     def real_y(self, y):
         y = self.scale(y)
@@ -175,7 +201,7 @@ class PDFTemplate(object):
         textobject.textLine(line)
         textobject.setFont(font, size)
 
-    def drawTable(self, x, y, data, font=None, size=None):
+    def drawTable(self, x, y, data, font=None, size=None, keys=True, values=True):
         if font is None:
             font = self.font
         if size is None:
@@ -196,8 +222,10 @@ class PDFTemplate(object):
         for key, value in data:
             self._add_text(key, keytextobject, font, size)
             self._add_text(value, valuetextobject, font, size)
-        self.canvas.drawText(keytextobject)
-        self.canvas.drawText(valuetextobject)
+        if keys:
+            self.canvas.drawText(keytextobject)
+        if values:
+            self.canvas.drawText(valuetextobject)
 
     def drawText(self, x, y, text, font=None, size=None):
         if font is None:
@@ -215,127 +243,46 @@ class PDFTemplate(object):
             self._add_text(line, textobject, font, size)
         self.canvas.drawText(textobject)
 
-    def createData(self, cycle, bill=None, payments=None):
-        # TODO: use Django SHORT_DATE_FORMAT
-        membercontact = cycle.membership.get_billing_contact()
-        amount_paid = 0
-
-        if membercontact.organization_name and (membercontact.first_name or membercontact.last_name):
-            name = "{organization_name}\n{first_name} {last_name}".format(
-                organization_name = membercontact.organization_name,
-                first_name = membercontact.first_name,
-                last_name = membercontact.last_name
-            )
-        else:
-            name = cycle.membership.name()
-
-        # Calculate vat; copied from models.Bill#render_as_text(self)
-        vat = Decimal(cycle.get_vat_percentage()) / Decimal(100)
-        if self.__type__ == 'reminder':
-            amount_paid = cycle.amount_paid()
-            sum = cycle.sum - amount_paid
-            non_vat_amount = sum / (Decimal(1) + vat)
-        else:
-            sum = cycle.sum
-            non_vat_amount = (cycle.sum / (Decimal(1) + vat))
-
-        # Select due date
-        if self.__type__ == 'reminder':
-            due_date = "HETI"
-        elif bill:
-            due_date = bill.due_date.strftime("%d.%m.%Y")
-        else:
-            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
-            due_date = due_date.strftime("%d.%m.%Y")
-
-        lineitems = []
-        # ['1', 'Jäsenmaksu', '04.05.2010 - 04.05.2011', '32.74 €','7.26 €','40.00 €']
-        cycle_start_date = cycle.start.strftime('%d.%m.%Y')
-        cycle_end_date = cycle.end_date().strftime('%d.%m.%Y')
-        lineitems.append([
-            "1",
-            "Jäsenmaksu",
-            "%s - %s" % (cycle_start_date, cycle_end_date),
-            "%s €" % locale.format("%.2f", cycle.sum / (Decimal(1) + vat)),
-            "%s %%" % locale.format("%d", cycle.get_vat_percentage()),
-            "%s €" % locale.format("%.2f", vat * non_vat_amount),
-            "%s €" % locale.format("%.2f", cycle.sum)
-        ])
-        # Note any payments attached
-        if self.__type__ == 'reminder' and amount_paid > 0:
-            lineitems.append([
-                "2",
-                "Maksuja huomioitu yht.",
-                "",  # start-end
-                "",  # amount
-                "",  # vat-percentage
-                "",  # vat amount
-                "%s €" % locale.format("%.2f", -amount_paid),  # total amount
-            ])
-
-        first_bill = cycle.first_bill()
-        if bill:
-            bill_id = bill.id
-        elif first_bill:
-            bill_id = first_bill.id
-        else:
-            bill_id = None
-        if bill:
-            date = bill.created
-        else:
-            date = datetime.now()
-        if payments:
-            latest_payment_date = payments.latest_payment_date()
-            if latest_payment_date:
-                latest_payments = min([payments.latest_payment_date(), datetime.now()])
-            else:
-                latest_payments = datetime(year=2003, month=1, day=1)
-        else:
-            latest_payments = datetime.now()
-        self.data = {
-            'name': name,
-            'address': membercontact.street_address,
-            'postal_code': membercontact.postal_code,
-            'postal_office': membercontact.post_office.upper(),
-            'country': membercontact.country.upper() if membercontact.country not in ['Suomi', 'Finland'] else '',
-            'date': date.strftime("%d.%m.%Y"),
-            'latest_payment_date': latest_payments.strftime('%d.%m.%Y'),
-            'member_id': cycle.membership.id,
-            'due_date': due_date,
-            'email': membercontact.email,
-            'bill_id': bill_id,
-            'vat': vat,
-            'sum': sum,
-            'pretty_sum': locale.format('%.2f', sum),
-            'notify_period': '%d vrk' % (settings.REMINDER_GRACE_DAYS,),
-            'lineitems': lineitems,
-            'reference_number': group_reference(cycle.reference_number)
-        }
+    def createData(self, cycle, bill=None, payments=None, context=None):
+        """
+        :param context: BillRenderContext with the cycle or bill loaded
+        """
+        if context is None:
+            context = BillRenderContext(payments=payments)
+        self.data = context.pdf_data(cycle, bill=bill, reminder=self.__type__ == 'reminder')
+
+    def cache_key(self):
+        """
+        Hash of the render inputs, the data from createData() and the
+        settings printed on the page
+        """
+        data = dict(self.data)
+        if self.__type__ != 'reminder':
+            # Only printed on reminders
+            data.pop('latest_payment_date', None)
+        inputs = [TEMPLATE_VERSION, self.__type__, data, settings.IBAN_ACCOUNT_NUMBER, settings.BIC_CODE,
+                  settings.BANK_NAME, settings.BUSINESS_ID, settings.ORGANIZATION_REG_ID,
+                  settings.BILLING_FROM_EMAIL]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
     def addTemplate(self):
-        # Logo to upper left corner
-        self.drawImage(1.8, 1, 3.4, 1.7, LOGO)
+        # The static part of the layout is drawn once per document as a
+        # form XObject, referenced on every page
+        if not self._template_form:
+            self.canvas.beginForm(TEMPLATE_FORM, upperx=self.size[0], uppery=self.size[1])
+            self.addStaticTemplate()
+            self.addStaticContent()
+            self.canvas.endForm()
+            self._template_form = True
+        self.canvas.doForm(TEMPLATE_FORM)
+
         self.drawString(12.4, 2.9, "%(date)s" % self.data, size=12)
-        self.drawString(1.8, 2.9, "Kapsi Internet-käyttäjät ry, Kaitoväylä 14 B 9, 90570 OULU",
-                        size=8)
         # Address block
         self.drawText(1.8, 4.4, "%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s\n%(country)s" % self.data, size=12, font='Arial')
 
-        self.drawBox(12.2, 3.5, 5, 1.7)
-        self.drawTable(12.4, 4, [['Jäsennumero:', '%(member_id)s' % self.data],
-                                 ['Eräpäivä:', '%(due_date)s' % self.data],
-                                 ['Huomautusaika:', '%(notify_period)s' % self.data]
-                                 ], size=10)
+        self.drawTable(12.4, 4, self.member_table(), size=10, keys=False)
 
         xtable = [1, 1.5, 7, 12, 13.5, 15, 17]
-        self.drawString(xtable[1], 8.8, "Selite", size=9)
-        self.drawString(xtable[2], 8.8, "Aikaväli", size=9)
-        self.drawString(xtable[3], 8.8, "ilman alv", size=9)
-        self.drawString(xtable[4], 8.8, "alv", size=9)
-        self.drawString(xtable[5], 8.8, "alv osuus", size=9)
-        self.drawString(xtable[6], 8.8, "Yhteensä", size=9)
-        self.drawHorizontalStroke(1, 8.9, 18.5)
-
         y = 9.3
         for line in self.data['lineitems']:
             for i in range(len(xtable)):
@@ -348,6 +295,45 @@ class PDFTemplate(object):
         self.drawString(xtable[3], y, "Maksettavaa yhteensä:" % self.data, size=10)
         self.drawString(xtable[6], y, "<b>%(pretty_sum)s €</b>" % self.data, size=10)
 
+        # Bill part
+        self.drawText(3.0, 23.5, "%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s\n%(email)s" % self.data,
+                      size=9)
+        self.drawText(13.15, 25.7, "%(reference_number)s" % self.data, size=9)
+        self.drawText(13.15, 26.65, "%(due_date)s" % self.data, size=9)
+        self.drawText(16.9, 26.65, "%(pretty_sum)s" % self.data, size=9)
+
+        due_date = None
+        if self.__type__ != 'reminder':
+            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
+        barcode_string = barcode_4(settings.IBAN_ACCOUNT_NUMBER, self.data['reference_number'], due_date,
+                                   self.data['sum'])
+        barcode = code128.Code128(str(barcode_string), barWidth=0.12 * cm, barHeight=4.5 * cm)
+        barcode.drawOn(self.canvas, self.real_x(2), self.real_y(28.7))
+
+    def member_table(self):
+        return [['Jäsennumero:', '%(member_id)s' % self.data],
+                ['Eräpäivä:', '%(due_date)s' % self.data],
+                ['Huomautusaika:', '%(notify_period)s' % self.data]]
+
+    def addStaticTemplate(self):
+        # Logo to upper left corner
+        self.drawImage(1.8, 1, 3.4, 1.7, LOGO)
+        self.drawString(1.8, 2.9, "Kapsi Internet-käyttäjät ry, Kaitoväylä 14 B 9, 90570 OULU",
+                        size=8)
+
+        self.drawBox(12.2, 3.5, 5, 1.7)
+        # Values are not used for drawing the keys
+        self.drawTable(12.4, 4, [[key, ''] for key, value in self.member_table()], size=10, values=False)
+
+        xtable = [1, 1.5, 7, 12, 13.5, 15, 17]
+        self.drawString(xtable[1], 8.8, "Selite", size=9)
+        self.drawString(xtable[2], 8.8, "Aikaväli", size=9)
+        self.drawString(xtable[3], 8.8, "ilman alv", size=9)
+        self.drawString(xtable[4], 8.8, "alv", size=9)
+        self.drawString(xtable[5], 8.8, "alv osuus", size=9)
+        self.drawString(xtable[6], 8.8, "Yhteensä", size=9)
+        self.drawHorizontalStroke(1, 8.9, 18.5)
+
         self.drawHorizontalStroke(1, 18, 18.5)
 
         self.drawText(1, 18.5, "<b>Kapsi Internet-käyttäjät ry</b>\nKaitoväylä 14 B 9\n90570 OULU", size=7)
@@ -379,9 +365,6 @@ class PDFTemplate(object):
         self.drawString(2.4, 23.9, "namn och", size=6, alignment="right")
         self.drawString(2.4, 24.1, "adress", size=6, alignment="right")
 
-        self.drawText(3.0, 23.5, "%(name)s\n%(address)s\n%(postal_code)s %(postal_office)s\n%(email)s" % self.data,
-                      size=9)
-
         self.drawString(2.4, 25.6, "Allekirjoitus", size=6, alignment="right")
         self.drawString(2.4, 25.9, "Ynderskrift", size=6, alignment="right")
 
@@ -393,11 +376,8 @@ class PDFTemplate(object):
         self.drawText(3.0, 20, "IBAN", size=7)
 
         self.drawText(11.15, 25.6, "Viitenro\nRef.nr", size=7)
-        self.drawText(13.15, 25.7, "%(reference_number)s" % self.data, size=9)
         self.drawText(11.15, 26.5, "Eräpäivä\nFörf.dag", size=7)
-        self.drawText(13.15, 26.65, "%(due_date)s" % self.data, size=9)
         self.drawText(15.9, 26.4, "Euro", size=7)
-        self.drawText(16.9, 26.65, "%(pretty_sum)s" % self.data, size=9)
 
         # Lines on bottom part
         self.drawHorizontalStroke(1, 21, 10, width=6)
@@ -420,13 +400,8 @@ class PDFTemplate(object):
                                 "kontonummer betalaren angivit.", size=5)
         self.drawText(17.8, 29.1, "PANKKI BANKEN", size=6)
 
-        due_date = None
-        if self.__type__ != 'reminder':
-            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
-        barcode_string = barcode_4(settings.IBAN_ACCOUNT_NUMBER, self.data['reference_number'], due_date,
-                                   self.data['sum'])
-        barcode = code128.Code128(str(barcode_string), barWidth=0.12 * cm, barHeight=4.5 * cm)
-        barcode.drawOn(self.canvas, self.real_x(2), self.real_y(28.7))
+    def addStaticContent(self):
+        pass
 
     def addContent(self):
         pass
@@ -438,7 +413,7 @@ class PDFTemplate(object):
 class PDFReminder(PDFTemplate):
     __type__ = 'reminder'
 
-    def addContent(self):
+    def addStaticContent(self):
         self.drawString(12.4, 2, "<b>MUISTUTUS</b>")
         self.drawText(1, 11.5, """Hei!
 
@@ -453,6 +428,8 @@ muuta kysyttävää jäsenasioista.
 
         self.drawText(1, 16, "<b>Muistutuksen maksamatta jättäminen johtaa jäsenpalveluiden lukitsemiseen ja "
                              "erottamiseen yhdistyksestä!</b>", size=10)
+
+    def addContent(self):
         self.drawText(1, 17, "Jos olet jo maksanut muistutuksen, tämä viesti on aiheeton. Olemme huomioineet meille "
                              "näkyvät jäsenmaksu-\nsuoritukset %(latest_payment_date)s asti." % self.data, size=10)
         if self.data['bill_id']:
@@ -462,7 +439,7 @@ muuta kysyttävää jäsenasioista.
 class PDFInvoice(PDFTemplate):
     __type__ = 'invoice'
 
-    def addContent(self):
+    def addStaticContent(self):
         self.drawString(12.4, 2, "<b>LASKU</b>")
         self.drawText(1, 11.5, """
 Voit ottaa yhteyttä Kapsin laskutukseen osoitteeseen %s esimerkiksi seuraavissa tilanteissa:
@@ -472,5 +449,7 @@ Voit ottaa yhteyttä Kapsin laskutukseen osoitteeseen %s esimerkiksi seuraavissa
    - haluat sopia maksuaikataulusta
    - sinulla on muuta kysyttävää jäsenasioista
 """ % (get_billing_email(),), size=10)
+
+    def addContent(self):
         if self.data['bill_id']:
             self.drawText(11.5, 23.4, "Laskunumero %s" % self.data['bill_id'], size=10)
@@ -0,0 +1,138 @@
+# encoding: utf-8
+
+"""
+Size and age management of the bill pdf cache.
+
+Cached pdfs are stored in bill_pdfs/ of the cache storage, in
+subdirectories of 1000 bill ids. The modification time of a file is
+its last access time, it is updated on every cache hit.
+
+Cache hits are counted in memory and added to PDFCacheStats in batches
+of HIT_BATCH_SIZE, so concurrent reads don't all update the same row.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger("membership.billing.pdf_cache")
+
+BILLS_PER_DIRECTORY = 1000
+HIT_BATCH_SIZE = 100
+
+_pending_hits = 0
+_pending_lock = threading.Lock()
+
+
+class PDFCache(object):
+
+    def __init__(self, storage, directory="bill_pdfs"):
+        self.storage = storage
+        self.directory = directory
+
+    def name_for(self, bill_id, key):
+        """
+        Cache file name of the pdf of a bill rendered from inputs with hash key
+        """
+        return "{directory}/{shard}/{bill_id}-{key}.pdf".format(
+            directory=self.directory, shard=bill_id // BILLS_PER_DIRECTORY, bill_id=bill_id, key=key)
+
+    def touch(self, name):
+        """
+        Mark a cached file used now
+        """
+        try:
+            os.utime(self.storage.path(name))
+        except NotImplementedError:
+            pass
+
+    def files(self, directory=None):
+        """
+        Generator of (name, size, last access time) of the cached files
+        """
+        if directory is None:
+            directory = self.directory
+        if not self.storage.exists(directory):
+            return
+        subdirectories, files = self.storage.listdir(directory)
+        for filename in files:
+            name = "%s/%s" % (directory, filename)
+            yield name, self.storage.size(name), self.storage.get_modified_time(name)
+        for subdirectory in subdirectories:
+            for entry in self.files("%s/%s" % (directory, subdirectory)):
+                yield entry
+
+    def usage(self):
+        """
+        :return: number of files and bytes used
+        """
+        count = used = 0
+        for name, size, accessed in self.files():
+            count += 1
+            used += size
+        return count, used
+
+    def evict(self, max_bytes=None, max_age=None, now=None):
+        """
+        Remove the files not used in max_age, then the least recently
+        used files until the cache fits in max_bytes.
+        :return: number of files and bytes removed
+        """
+        if max_bytes is None:
+            max_bytes = settings.PDF_CACHE_MAX_BYTES
+        if max_age is None:
+            max_age = timedelta(days=settings.PDF_CACHE_MAX_AGE_DAYS)
+        oldest = (now or datetime.now()) - max_age
+
+        entries = sorted(self.files(), key=lambda entry: entry[2])
+        used = sum(size for name, size, accessed in entries)
+        count = evicted = 0
+        for name, size, accessed in entries:
+            if accessed >= oldest and used <= max_bytes:
+                break
+            self.storage.delete(name)
+            used -= size
+            count += 1
+            evicted += size
+        if count:
+            logger.info("Evicted %d pdfs, %d bytes from the cache" % (count, evicted))
+            record_cache_use(evictions=count, evicted_bytes=evicted)
+        return count, evicted
+
+
+def _take_hits(hits, flush=False):
+    """
+    Count hits in memory, returns the hits to write to the database
+    """
+    global _pending_hits
+    with _pending_lock:
+        _pending_hits += hits
+        if not flush and _pending_hits < HIT_BATCH_SIZE:
+            return 0
+        hits, _pending_hits = _pending_hits, 0
+    return hits
+
+
+def record_cache_use(hits=0, **counts):
+    """
+    Add to the counters of PDFCacheStats. Hits are written with the next
+    other counts or when HIT_BATCH_SIZE of them have been recorded.
+    """
+    _write_stats(hits=_take_hits(hits, flush=bool(counts)), **counts)
+
+
+def flush_cache_stats():
+    """
+    Write the hits counted in memory to PDFCacheStats
+    """
+    _write_stats(hits=_take_hits(0, flush=True))
+
+
+def _write_stats(**counts):
+    counts = {field: count for field, count in counts.items() if count}
+    if counts:
+        from membership.models import PDFCacheStats
+        PDFCacheStats.increment(**counts)
@@ -2,28 +2,47 @@
 
 """
 Some functions that cannot be in pdf.py file to prevent import loop.
+
+ReportLab and pypdf are imported on first use, not when models are loaded.
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 import logging
 
+from django.conf import settings
 from django.core.files import File
-from membership.billing import pdf
+from django.db import connections
+
+from membership.billing.pdf_cache import PDFCache, flush_cache_stats, record_cache_use
 
 
 logger = logging.getLogger("membership.billing.pdf")
 
+# Bills loaded at once by pregenerate_bill_pdfs()
+PREGENERATE_CHUNK_SIZE = 100
+
 
-def create_reminder_pdf(cycles, output_file, payments=None):
+def create_reminder_pdf(cycles, output_file, payments=None, workers=1, context=None):
     """
     Generate reminder pdf with billing cycles `cycles` to file `output_file`
     :param cycles: list of billingcycles
     :param output_file: File-like object
+    :param workers: render shards of the cycles in this many processes
+    :param context: BillRenderContext with the cycles loaded
     :return: None
     """
+    if workers > 1 and len(cycles) >= settings.PDF_PARALLEL_MIN_PAGES:
+        shard_size = -(-len(cycles) // (2 * workers))
+        shards = [[cycle.id for cycle in cycles[i:i + shard_size]]
+                  for i in range(0, len(cycles), shard_size)]
+        merge_pdfs(render_reminder_shards(shards, workers=workers), output_file)
+        return None
+
+    from membership.billing import pdf
     p = pdf.PDFReminder(output_file)
     try:
-        p.addCycles(cycles, payments=payments)
+        p.addCycles(cycles, payments=payments, context=context)
         p.generate()
         return None
     except Exception as e:
@@ -32,33 +51,139 @@ def create_reminder_pdf(cycles, output_file, payments=None):
         raise
 
 
-def get_bill_pdf(bill, payments=None):
+def _render_reminder_shard(cycle_ids):
+    from membership.models import Payment
+    from membership.billing.render_context import BillRenderContext
+    context = BillRenderContext(cycles=cycle_ids, payments=Payment)
+    output = BytesIO()
+    create_reminder_pdf(context.cycles, output, payments=Payment, context=context)
+    return output.getvalue()
+
+
+def render_reminder_shards(shards, workers=1):
+    """
+    Render reminder pdfs of lists of billing cycle ids, in worker
+    processes if workers > 1.
+    :return: list of pdf contents in the order of shards
     """
-    Get from pdf_file field or generate pdf for Bill
+    if workers <= 1:
+        return [_render_reminder_shard(shard) for shard in shards]
+
+    # Forked workers must not share the database connection
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render_reminder_shard, shards))
+
+
+def merge_pdfs(contents, output_file):
+    """
+    Write the pages of pdf contents to output_file in order
+    """
+    from pypdf import PdfReader, PdfWriter
+    writer = PdfWriter()
+    for content in contents:
+        writer.append(PdfReader(BytesIO(content)))
+    writer.write(output_file)
+
+
+def bill_pdf_template(bill, pdf_fp, payments=None, context=None):
+    """
+    PDF template for Bill with render data loaded
+    :param context: BillRenderContext with the bill loaded
+    """
+    from membership.billing import pdf
+    # Select template bill/reminder
+    if bill.is_reminder():
+        p = pdf.PDFReminder(pdf_fp)
+    else:
+        p = pdf.PDFInvoice(pdf_fp)
+    p.createData(cycle=bill.billingcycle, bill=bill, payments=payments, context=context)
+    return p
+
+
+def ensure_bill_pdf(bill, payments=None, context=None):
+    """
+    Make sure the pdf of Bill is in the cache.
+
+    The cache file is named by the hash of the render inputs, so a pdf
+    rendered from outdated contact, fee or payment data is detected by
+    a name mismatch and rendered again. Evicted pdfs are rendered again.
+    :param bill: Bill
+    :param context: BillRenderContext with the bill loaded
+    :return: True if the pdf was rendered
+    """
+    pdf_fp = BytesIO()
+    p = bill_pdf_template(bill, pdf_fp, payments=payments, context=context)
+    storage = bill.pdf_file.storage
+    cache = PDFCache(storage, directory=bill.pdf_file.field.upload_to)
+    name = cache.name_for(bill.id, p.cache_key())
+
+    rendered = False
+    if bill.pdf_file.name == name and storage.exists(name):
+        cache.touch(name)
+        record_cache_use(hits=1)
+    else:
+        if storage.exists(name):
+            cache.touch(name)
+        else:
+            p.addBill(bill, payments=payments, context=context)
+            p.generate()
+            pdf_fp.seek(0)
+            name = storage.save(name, File(pdf_fp))
+            rendered = True
+        # Remove the outdated version
+        if bill.pdf_file.name and bill.pdf_file.name != name and storage.exists(bill.pdf_file.name):
+            storage.delete(bill.pdf_file.name)
+        bill.pdf_file.name = name
+        bill.save(update_fields=['pdf_file'])
+        record_cache_use(misses=1)
+    pdf_fp.close()
+    return rendered
+
+
+def open_bill_pdf(bill, payments=None, context=None):
+    """
+    Open the cached pdf of Bill, generating it if needed
     :param bill: Bill
+    :param context: BillRenderContext with the bill loaded
+    :return: binary file object
+    """
+    ensure_bill_pdf(bill, payments=payments, context=context)
+    return bill.pdf_file.storage.open(bill.pdf_file.name, 'rb')
+
+
+def get_bill_pdf(bill, payments=None, context=None):
+    """
+    Get from cache or generate pdf for Bill
+    :param bill: Bill
+    :param context: BillRenderContext with the bill loaded
     :return: pdf file content
     """
+    with open_bill_pdf(bill, payments=payments, context=context) as f:
+        return f.read()
 
-    # Check if PDF cache is valid
-    if bill.pdf_file:
-        if not bill.pdf_file.storage.exists(bill.pdf_file.name):
-            bill.pdf_file = None
 
-    # If PDF does not exist, generate it
-    if not bill.pdf_file:
-        pdf_fp = BytesIO()
+def _pregenerate(bill_ids):
+    from membership.models import Payment
+    from membership.billing.render_context import BillRenderContext
+    context = BillRenderContext(bill_ids, payments=Payment)
+    rendered = sum(ensure_bill_pdf(bill, payments=Payment, context=context) for bill in context.bills)
+    flush_cache_stats()
+    return rendered
 
-        # Select template bill/reminder
-        if bill.is_reminder():
-            p = pdf.PDFReminder(pdf_fp)
-        else:
-            p = pdf.PDFInvoice(pdf_fp)
 
-        p.addBill(bill, payments=payments)
-        p.generate()
-        pdf_fp.seek(0)
-        django_file = File(pdf_fp)
-        bill.pdf_file.save("bill_{id}.pdf".format(id=bill.id), django_file)
-        pdf_fp.close()
+def pregenerate_bill_pdfs(bill_ids, workers=1):
+    """
+    Render the missing and outdated pdfs of bills to the cache,
+    in worker processes if workers > 1.
+    :return: number of pdfs rendered
+    """
+    bill_ids = list(bill_ids)
+    chunks = [bill_ids[i:i + PREGENERATE_CHUNK_SIZE] for i in range(0, len(bill_ids), PREGENERATE_CHUNK_SIZE)]
+    if workers <= 1:
+        return sum(_pregenerate(chunk) for chunk in chunks)
 
-    return bill.pdf_file.read()
+    # Forked workers must not share the database connection
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(_pregenerate, chunks))
@@ -7,6 +7,7 @@ from io import StringIO
 from decimal import Decimal
 
 from django.conf import settings
+from membership.billing.render_context import BillRenderContext
 from membership.models import Bill, CancelledBill
 
 logger = logging.getLogger("membership.billing.procountor")
@@ -137,13 +138,15 @@ def create_csv(start=None, mark_cancelled=True):
     filehandle = StringIO()
     output = csv.writer(filehandle, delimiter=';', quoting=csv.QUOTE_NONE)
 
-    for bill in Bill.objects.filter(created__gte=start, reminder_count=0).all():
+    context = BillRenderContext(Bill.objects.filter(created__gte=start, reminder_count=0))
+    for bill in context.bills:
         for row in _bill_to_rows(bill):
             output.writerow(row)
 
     cancelled_bills = CancelledBill.objects.filter(exported=False)
-    for cb in cancelled_bills:
-        for row in _bill_to_rows(cb.bill, cancel=True):
+    context = BillRenderContext(list(cancelled_bills.values_list('bill_id', flat=True)))
+    for bill in context.bills:
+        for row in _bill_to_rows(bill, cancel=True):
             output.writerow(row)
     if mark_cancelled:
         cancelled_bills.update(exported=True)
@@ -0,0 +1,245 @@
+# encoding: utf-8
+
+"""
+Data for rendering bills as email text and pdf.
+
+BillRenderContext loads a batch of bills or billing cycles with their
+memberships and contacts in one query and the latest payment date once,
+instead of the lazy foreign key access of every single bill.
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import locale
+
+from django.conf import settings
+from django.db.models import Prefetch
+from django.db.models.query import QuerySet
+
+from membership.models import Bill, BillingCycle, Payment, MEMBER_TYPES_DICT
+from membership.reference_numbers import barcode_4, group_right
+from membership.utils import group_reference
+
+MEMBERSHIP_RELATED = ['membership', 'membership__person', 'membership__organization',
+                      'membership__billing_contact']
+
+_NOT_LOADED = object()
+
+
+def _ids(objects):
+    return [getattr(obj, 'id', obj) for obj in objects]
+
+
+class BillRenderContext(object):
+
+    def __init__(self, bills=(), cycles=(), payments=Payment):
+        """
+        :param bills: Bill objects, ids or a Bill queryset to load
+        :param cycles: BillingCycle objects, ids or a BillingCycle queryset to load
+        :param payments: Payment model for the latest payment date printed
+            on the pdf, pdfs are dated now if None
+        """
+        self.payments = payments
+        self.bills = self._load(Bill, bills, ['billingcycle__' + name for name in MEMBERSHIP_RELATED])
+        self.cycles = self._load(BillingCycle, cycles, MEMBERSHIP_RELATED,
+                                 Prefetch('bill_set', queryset=Bill.objects.order_by('due_date'),
+                                          to_attr='bills_by_due_date'))
+        self._bills = {bill.id: bill for bill in self.bills}
+        self._cycles = {cycle.id: cycle for cycle in self.cycles}
+        self._latest_payment_date = _NOT_LOADED
+
+    @staticmethod
+    def _load(model, objects, related, *prefetch):
+        if isinstance(objects, QuerySet):
+            return list(objects.select_related(*related).prefetch_related(*prefetch))
+        ids = _ids(objects)
+        if not ids:
+            return []
+        loaded = model.objects.select_related(*related).prefetch_related(*prefetch).in_bulk(ids)
+        return [loaded[obj_id] for obj_id in ids if obj_id in loaded]
+
+    def bill(self, bill):
+        """Loaded instance of Bill, or bill itself if not in the batch"""
+        return self._bills.get(bill.id, bill)
+
+    def cycle(self, cycle):
+        """Loaded instance of BillingCycle, or cycle itself if not in the batch"""
+        return self._cycles.get(cycle.id, cycle)
+
+    def latest_payment_date(self):
+        if self._latest_payment_date is _NOT_LOADED:
+            self._latest_payment_date = (self.payments or Payment).latest_payment_date()
+        return self._latest_payment_date
+
+    @staticmethod
+    def _first_bill(cycle):
+        bills = getattr(cycle, 'bills_by_due_date', None)
+        if bills is None:
+            return cycle.first_bill()
+        return bills[0] if bills else None
+
+    def text_context(self, bill):
+        """
+        Template context of membership/bill.txt or membership/reminder.txt
+        """
+        bill = self.bill(bill)
+        cycle = bill.billingcycle
+        membership = cycle.membership
+        contact = membership.get_billing_contact()
+        vat_percentage = cycle.get_vat_percentage()
+        vat = Decimal(vat_percentage) / Decimal(100)
+        context = {
+            'membership_type': MEMBER_TYPES_DICT[membership.type],
+            'membership_type_raw': membership.type,
+            'bill_id': bill.id,
+            'member_id': membership.id,
+            'member_name': membership.name(),
+            'billing_contact': membership.billing_contact,
+            'billing_name': str(contact),
+            'street_address': contact.street_address,
+            'postal_code': contact.postal_code,
+            'post_office': contact.post_office,
+            'billingcycle': cycle,
+            'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
+            'bic_code': settings.BIC_CODE,
+            'today': datetime.now(),
+            'reference_number': group_right(cycle.reference_number),
+            'vat_percentage': vat_percentage,
+        }
+        if not bill.is_reminder():
+            non_vat_amount = cycle.sum / (Decimal(1) + vat)
+            context.update({
+                'country': contact.country,
+                'due_date': bill.due_date,
+                'sum': cycle.sum,
+                'vat_amount': vat * non_vat_amount,
+                'non_vat_amount': non_vat_amount,
+                'barcode': barcode_4(iban=settings.IBAN_ACCOUNT_NUMBER,
+                                     refnum=cycle.reference_number,
+                                     duedate=bill.due_date,
+                                     euros=cycle.sum)
+            })
+        else:
+            amount_paid = cycle.amount_paid()
+            sum = cycle.sum - amount_paid
+            non_vat_amount = sum / (Decimal(1) + vat)
+            context.update({
+                'municipality': membership.municipality,
+                'billing_email': contact.email,
+                'email': membership.primary_contact().email,
+                'latest_recorded_payment': self.latest_payment_date(),
+                'original_sum': cycle.sum,
+                'amount_paid': amount_paid,
+                'sum': sum,
+                'vat_amount': vat * non_vat_amount,
+                'non_vat_amount': non_vat_amount,
+                'barcode': barcode_4(iban=settings.IBAN_ACCOUNT_NUMBER,
+                                     refnum=cycle.reference_number,
+                                     duedate=None,
+                                     euros=sum)
+            })
+        return context
+
+    def pdf_data(self, cycle, bill=None, reminder=False):
+        """
+        Data of a PDFTemplate page
+        :param cycle: BillingCycle
+        :param bill: Bill of the page, first bill of the cycle if None
+        :param reminder: render as reminder
+        """
+        # TODO: use Django SHORT_DATE_FORMAT
+        if bill is not None:
+            bill = self.bill(bill)
+            cycle = bill.billingcycle
+        else:
+            cycle = self.cycle(cycle)
+        membercontact = cycle.membership.get_billing_contact()
+        amount_paid = 0
+
+        if membercontact.organization_name and (membercontact.first_name or membercontact.last_name):
+            name = "{organization_name}\n{first_name} {last_name}".format(
+                organization_name = membercontact.organization_name,
+                first_name = membercontact.first_name,
+                last_name = membercontact.last_name
+            )
+        else:
+            name = cycle.membership.name()
+
+        vat_percentage = cycle.get_vat_percentage()
+        vat = Decimal(vat_percentage) / Decimal(100)
+        if reminder:
+            amount_paid = cycle.amount_paid()
+            sum = cycle.sum - amount_paid
+            non_vat_amount = sum / (Decimal(1) + vat)
+        else:
+            sum = cycle.sum
+            non_vat_amount = (cycle.sum / (Decimal(1) + vat))
+
+        # Select due date
+        if reminder:
+            due_date = "HETI"
+        elif bill:
+            due_date = bill.due_date.strftime("%d.%m.%Y")
+        else:
+            due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
+            due_date = due_date.strftime("%d.%m.%Y")
+
+        lineitems = []
+        # ['1', 'Jäsenmaksu', '04.05.2010 - 04.05.2011', '32.74 €','7.26 €','40.00 €']
+        cycle_start_date = cycle.start.strftime('%d.%m.%Y')
+        cycle_end_date = cycle.end_date().strftime('%d.%m.%Y')
+        lineitems.append([
+            "1",
+            "Jäsenmaksu",
+            "%s - %s" % (cycle_start_date, cycle_end_date),
+            "%s €" % locale.format("%.2f", cycle.sum / (Decimal(1) + vat)),
+            "%s %%" % locale.format("%d", vat_percentage),
+            "%s €" % locale.format("%.2f", vat * non_vat_amount),
+            "%s €" % locale.format("%.2f", cycle.sum)
+        ])
+        # Note any payments attached
+        if reminder and amount_paid > 0:
+            lineitems.append([
+                "2",
+                "Maksuja huomioitu yht.",
+                "",  # start-end
+                "",  # amount
+                "",  # vat-percentage
+                "",  # vat amount
+                "%s €" % locale.format("%.2f", -amount_paid),  # total amount
+            ])
+
+        if bill:
+            bill_id = bill.id
+            date = bill.created
+        else:
+            first_bill = self._first_bill(cycle)
+            bill_id = first_bill.id if first_bill else None
+            date = datetime.now()
+        if self.payments:
+            latest_payment_date = self.latest_payment_date()
+            if latest_payment_date:
+                latest_payments = min([latest_payment_date, datetime.now()])
+            else:
+                latest_payments = datetime(year=2003, month=1, day=1)
+        else:
+            latest_payments = datetime.now()
+        return {
+            'name': name,
+            'address': membercontact.street_address,
+            'postal_code': membercontact.postal_code,
+            'postal_office': membercontact.post_office.upper(),
+            'country': membercontact.country.upper() if membercontact.country not in ['Suomi', 'Finland'] else '',
+            'date': date.strftime("%d.%m.%Y"),
+            'latest_payment_date': latest_payments.strftime('%d.%m.%Y'),
+            'member_id': cycle.membership.id,
+            'due_date': due_date,
+            'email': membercontact.email,
+            'bill_id': bill_id,
+            'vat': vat,
+            'sum': sum,
+            'pretty_sum': locale.format('%.2f', sum),
+            'notify_period': '%d vrk' % (settings.REMINDER_GRACE_DAYS,),
+            'lineitems': lineitems,
+            'reference_number': group_reference(cycle.reference_number)
+        }
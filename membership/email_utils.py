@@ -7,15 +7,109 @@ from django.core import mail
 from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 
+from contextlib import contextmanager
 import logging
+import threading
+import traceback
 logger = logging.getLogger("membership.email_utils")
 
+_bulk = threading.local()
+
 
 def format_email(name, email):
     clean_name = name.replace('"', '')  # Strip double quotes
     return '"{name}" <{email}>'.format(name=clean_name, email=email)
 
 
+class BulkMailer(object):
+    """
+    Collects messages and sends them in batches, each batch over one
+    opened email backend connection. Messages not sent because of an
+    error are kept and sent with the next batch.
+    """
+
+    def __init__(self, batch_size=None, connection=None):
+        if batch_size is None:
+            batch_size = settings.EMAIL_BATCH_SIZE
+        self.batch_size = batch_size
+        self.connection = connection or mail.get_connection()
+        # (message, log message) pairs
+        self.messages = []
+        self.sent = 0
+        self.batches = 0
+
+    def add(self, email, log_message=None):
+        """
+        :param log_message: logged when the message has been sent
+        """
+        self.messages.append((email, log_message))
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the collected messages
+        :return: number of messages sent
+        """
+        if not self.messages:
+            return 0
+        self.connection.open()
+        sent = 0
+        try:
+            for email, log_message in self.messages:
+                self.connection.send_messages([email])
+                sent += 1
+                if log_message:
+                    logger.info(log_message)
+        finally:
+            self.connection.close()
+            del self.messages[:sent]
+            self.sent += sent
+        self.batches += 1
+        logger.info("Sent a batch of %d emails" % sent)
+        return sent
+
+
+@contextmanager
+def bulk_delivery(batch_size=None, connection=None):
+    """
+    Collect the emails sent with send_email() in this thread and send them
+    in batches with BulkMailer. Remaining messages are sent on exit, also
+    when leaving because of an exception: the bills they were sent for
+    may already be committed.
+    """
+    previous = getattr(_bulk, 'mailer', None)
+    mailer = BulkMailer(batch_size=batch_size, connection=connection)
+    _bulk.mailer = mailer
+    try:
+        yield mailer
+    except Exception:
+        try:
+            mailer.flush()
+        except Exception:
+            # The original exception is raised below
+            logger.error("%s" % traceback.format_exc())
+            logger.error("%d collected emails not sent" % len(mailer.messages))
+        raise
+    finally:
+        _bulk.mailer = previous
+    mailer.flush()
+
+
+def send_email(email, log_message=None):
+    """
+    Send EmailMessage `email`, or add it to the current bulk delivery
+    :param log_message: logged when the message has been sent
+    """
+    mailer = getattr(_bulk, 'mailer', None)
+    if mailer is not None:
+        mailer.add(email, log_message=log_message)
+    else:
+        mail.get_connection().send_messages([email])
+        if log_message:
+            logger.info(log_message)
+
+
 # Address helper
 def unix_email(membership):
     if settings.UNIX_EMAIL_DOMAIN:
@@ -30,7 +124,9 @@ def unix_email(membership):
 
 
 # Signal handlers
-def bill_sender(sender, instance=None, **kwargs):
+def bill_sender(sender, instance=None, context=None, **kwargs):
+    if context is not None:
+        instance = context.bill(instance)
     membership = instance.billingcycle.membership
     to = [membership.billing_email()]
     if instance.is_reminder():
@@ -40,19 +136,18 @@ def bill_sender(sender, instance=None, **kwargs):
         if local_email:
             to.append(local_email)
 
-    if settings.BILL_ATTACH_PDF:
-        pdf = instance.generate_pdf()
-        if instance.is_reminder():
-            attachments = [("Kapsi_muistutuslasku_%s.pdf" % instance.billingcycle.reference_number, pdf,
-                            "application/pdf")]
-        else:
-            attachments = [("kapsi_jasenlasku_%s.pdf" % instance.billingcycle.reference_number, pdf, "application/pdf")]
+    if instance.is_reminder():
+        attachment_name = "Kapsi_muistutuslasku_%s.pdf" % instance.billingcycle.reference_number
+    else:
+        attachment_name = "kapsi_jasenlasku_%s.pdf" % instance.billingcycle.reference_number
+    if settings.BILL_ATTACH_PDF and not settings.BILL_EMAIL_OUTBOX:
+        attachments = [(attachment_name, instance.generate_pdf(context=context), "application/pdf")]
     else:
         attachments = []
 
     if settings.BILLING_CC_EMAIL is not None:
         email = EmailMessage(instance.bill_subject(),
-                             instance.render_as_text(),
+                             instance.render_as_text(context=context),
                              settings.BILLING_FROM_EMAIL,
                              to,
                              [settings.BILLING_CC_EMAIL],
@@ -60,14 +155,19 @@ def bill_sender(sender, instance=None, **kwargs):
                              headers={'CC': settings.BILLING_CC_EMAIL})
     else:
         email = EmailMessage(instance.bill_subject(),
-                             instance.render_as_text(),
+                             instance.render_as_text(context=context),
                              settings.BILLING_FROM_EMAIL,
                              to,
                              attachments=attachments)
-    connection = mail.get_connection()
-    connection.send_messages([email])
-    logger.info('A bill sent as email to %s: %s' % (",".join(to),
-                                                     str(instance)))
+    if settings.BILL_EMAIL_OUTBOX:
+        # imported here since on top-level it would lead into a circular import
+        from .models import OutgoingEmail
+        OutgoingEmail.enqueue(email, bill=instance,
+                              attachment_name=attachment_name if settings.BILL_ATTACH_PDF else '')
+        logger.info('A bill queued as email to %s: %s' % (",".join(to),
+                                                           str(instance)))
+        return
+    send_email(email, log_message='A bill sent as email to %s: %s' % (",".join(to), str(instance)))
 
 
 def preapprove_email_sender(sender, instance=None, user=None, **kwargs):
@@ -85,8 +185,7 @@ def preapprove_email_sender(sender, instance=None, user=None, **kwargs):
                                   settings.FROM_EMAIL,
                                   [settings.SYSADMIN_EMAIL],
                                   headers = {'Reply-To': instance.email_to()})
-    connection = mail.get_connection()
-    connection.send_messages([sysadmin_email])
+    send_email(sysadmin_email)
     logger.info('A preapprove email sent to %s (%s) by %s' % (str(instance),
                                                                instance.billing_email(),
                                                                user))
@@ -108,8 +207,7 @@ def duplicate_payment_sender(sender, instance=None, user=None, billingcycle=None
                              to,
                              [settings.BILLING_CC_EMAIL],
                              headers={'CC': settings.BILLING_CC_EMAIL})
-    connection = mail.get_connection()
-    connection.send_messages([email])
+    send_email(email)
     logger.info('A duplicate payment notice email sent to %s (%s) by %s' % (str(membership),
                                                                membership.billing_email(),
                                                                user))
@@ -26,7 +26,7 @@ class LoginField(forms.CharField):
         errors = []
         if re.match(VALID_USERNAME_RE, value) is None:
             errors.append(_('Login begins with an illegal character or contains an illegal character.'))
-        if Alias.objects.filter(name__iexact=value).count() > 0:
+        if Alias.taken_names([value]):
             errors.append(_('Login already reserved.'))
 
         if len(errors) > 0:
@@ -0,0 +1,79 @@
+# encoding: UTF-8
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from membership.models import Contact, Membership, MembershipSearchIndex
+from membership.test_utils import random_first_name, random_last_name
+
+SCANNED_FIELDS = ['first_name', 'last_name', 'given_names', 'organization_name', 'email', 'phone', 'sms']
+
+
+def scan_search(query):
+    """Substring search over the contact tables without the index, for comparison"""
+    qs = Membership.objects.all()
+    for word in set(query.split(" ")):
+        word_q = Q()
+        for contact in ['person', 'organization']:
+            for field in SCANNED_FIELDS:
+                word_q |= Q(**{'%s__%s__icontains' % (contact, field): word})
+        qs = qs.filter(word_q)
+    return qs
+
+
+class Command(BaseCommand):
+    help = 'Compare indexed member search with contact table scans, in a rolled back transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members',
+            dest='members',
+            default=50000,
+            type=int,
+            help='Generated person memberships')
+        parser.add_argument('--repeat',
+            dest='repeat',
+            default=20,
+            type=int,
+            help='Times every query is run')
+
+    def _time(self, search, query, repeat):
+        started = time.time()
+        for i in range(repeat):
+            count = len(list(search(query)))
+        return (time.time() - started) / repeat * 1000, count
+
+    def _create_members(self, count):
+        contacts = []
+        for i in range(count):
+            first_name = random_first_name()
+            contacts.append(Contact(first_name=first_name, given_names='%s Kapsi' % first_name,
+                                    last_name=random_last_name(), street_address='Testikatu %d' % i,
+                                    postal_code='00100', post_office='Helsinki', country='Finland',
+                                    phone='%09d' % (40000000 + i), email='bench%d@example.com' % i))
+        Contact.objects.bulk_create(contacts)
+        person_ids = Contact.objects.filter(email__startswith='bench').values_list('id', flat=True)
+        Membership.objects.bulk_create((Membership(type='P', status='A', person_id=person_id,
+                                                   nationality='Finnish', municipality='Helsinki')
+                                        for person_id in person_ids))
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            started = time.time()
+            self._create_members(options['members'])
+            print("Created %d members in %.1f s" % (options['members'], time.time() - started))
+            started = time.time()
+            MembershipSearchIndex.rebuild()
+            print("Indexed in %.1f s" % (time.time() - started))
+
+            last_name = random_last_name()
+            queries = [last_name, last_name[:2], 'bench4242', '"%s"' % random_first_name(),
+                       '%s %s' % (random_first_name(), last_name)]
+            print("%-30s %12s %12s %8s" % ('query', 'indexed ms', 'scan ms', 'matches'))
+            for query in queries:
+                indexed, count = self._time(Membership.search, query, options['repeat'])
+                scanned, scan_count = self._time(scan_search, query.strip('"'), options['repeat'])
+                print("%-30s %12.1f %12.1f %8d" % (query, indexed, scanned, count))
+            transaction.set_rollback(True)
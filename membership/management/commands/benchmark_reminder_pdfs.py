@@ -0,0 +1,59 @@
+# encoding: UTF-8
+
+import re
+import time
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from membership.billing.pdf_utils import create_reminder_pdf
+from membership.models import BillingCycle, Payment, STATUS_APPROVED
+
+PAGE_RE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+def count_pages(content):
+    """Count the page objects of pdf content"""
+    return len(PAGE_RE.findall(content))
+
+
+class Command(BaseCommand):
+    help = 'Compare serial and parallel rendering of paper reminder pdfs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cycles',
+            dest='cycles',
+            default=1000,
+            type=int,
+            help='Pages rendered from the unpaid billing cycles of approved members, oldest first')
+        parser.add_argument('--workers',
+            dest='workers',
+            default=settings.PDF_RENDER_WORKERS,
+            type=int,
+            help='Processes used for the parallel rendering')
+
+    def _render(self, cycles, workers):
+        output = BytesIO()
+        started = time.time()
+        create_reminder_pdf(cycles, output, payments=Payment, workers=workers)
+        return output.getvalue(), time.time() - started
+
+    def handle(self, *args, **options):
+        unpaid = list(BillingCycle.objects.filter(membership__status=STATUS_APPROVED, is_paid=False).select_related(
+            'membership').order_by('start')[:options['cycles']])
+        if not unpaid:
+            raise CommandError("No unpaid billing cycles to render")
+        # Repeat cycles if there are not enough of them
+        cycles = [unpaid[i % len(unpaid)] for i in range(options['cycles'])]
+
+        serial, serial_time = self._render(cycles, workers=1)
+        settings.PDF_PARALLEL_MIN_PAGES = 0
+        parallel, parallel_time = self._render(cycles, workers=options['workers'])
+
+        print("%d cycles" % len(cycles))
+        print("serial:   %.2f s, %d pages, %d bytes" % (serial_time, count_pages(serial), len(serial)))
+        print("parallel: %.2f s, %d pages, %d bytes (%d workers)" % (
+            parallel_time, count_pages(parallel), len(parallel), options['workers']))
+        if not count_pages(serial) == count_pages(parallel) == len(cycles):
+            raise CommandError("Page counts differ")
@@ -7,7 +7,8 @@ import os
 
 from django.core.management.base import BaseCommand
 
-from membership.billing.payments import process_op_csv, process_procountor_csv
+from membership.billing.payments import process_op_csv, process_procountor_csv, process_payment_file, \
+    OpDictReader, ProcountorDictReader, PAYMENT_CHUNK_SIZE
 
 logger = logging.getLogger("membership.csvbills")
 
@@ -27,11 +28,31 @@ class Command(BaseCommand):
             default=None,
             action="store_true",
             help='Use procountor import csv format')
+        parser.add_argument(
+            '--stream',
+            dest='stream',
+            default=False,
+            action="store_true",
+            help='Read the file incrementally and resume an interrupted import of the same file')
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            default=PAYMENT_CHUNK_SIZE,
+            type=int,
+            help='Payment rows per transaction in stream mode')
 
     def handle(self, csvfiles, *args, **options):
         for csvfile in csvfiles:
             logger.info("Starting the processing of file %s." %
                 os.path.abspath(csvfile))
+            if options['stream']:
+                reader_class = ProcountorDictReader if options['procountor'] else OpDictReader
+                with open(csvfile, 'rb') as file_handle:
+                    process_payment_file(file_handle, reader_class=reader_class,
+                                         chunk_size=options['chunk_size'],
+                                         progress=self.progress)
+                logger.info("Done processing file %s." % os.path.abspath(csvfile))
+                continue
             # Exceptions of process_csv are fatal in command line run
             with open(csvfile, 'r', encoding='ISO-8859-1') as file_handle:
                 if options['procountor']:
@@ -39,3 +60,6 @@ class Command(BaseCommand):
                 else:
                     process_op_csv(file_handle)
             logger.info("Done processing file %s." % os.path.abspath(csvfile))
+
+    def progress(self, rows, rate):
+        self.stdout.write("%d rows, %.1f rows/s" % (rows, rate))
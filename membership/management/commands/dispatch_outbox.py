@@ -0,0 +1,41 @@
+# encoding: UTF-8
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from membership.billing.pdf_cache import flush_cache_stats
+from membership.outbox import dispatch_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send emails queued to the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+            dest='batch_size',
+            default=settings.OUTBOX_BATCH_SIZE,
+            type=int,
+            help='Messages fetched from the database at once')
+        parser.add_argument('--rate',
+            dest='rate_limit',
+            default=settings.OUTBOX_RATE_LIMIT,
+            type=float,
+            help='Maximum messages per second, 0 is unlimited')
+        parser.add_argument('--max-attempts',
+            dest='max_attempts',
+            default=settings.OUTBOX_MAX_ATTEMPTS,
+            type=int,
+            help='Attempts before a message is marked failed')
+        parser.add_argument('--backoff',
+            dest='backoff',
+            default=settings.OUTBOX_RETRY_BACKOFF,
+            type=int,
+            help='Seconds before the first retry, doubled on every further attempt')
+
+    def handle(self, *args, **options):
+        counts = dispatch_outbox(batch_size=options['batch_size'],
+                                 rate_limit=options['rate_limit'],
+                                 max_attempts=options['max_attempts'],
+                                 backoff=options['backoff'])
+        flush_cache_stats()
+        print("Sent %(sent)d, to retry %(retry)d, failed %(failed)d" % counts)
@@ -4,18 +4,27 @@
 import calendar
 import logging
 import traceback
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.signals import post_save
 from django.utils import translation
 
-from membership.models import BillingCycle, Bill, Payment, Membership
+from membership.billing.pdf_cache import flush_cache_stats
+from membership.billing.render_context import BillRenderContext
+from membership.email_utils import bulk_delivery
+from membership.models import BillingCycle, Bill, Payment, Membership, fee_schedule
+from membership.reference_numbers import generate_membership_bill_reference_number
 
 logger = logging.getLogger("membership.makebills")
 
+BATCH_CHUNK_SIZE = 500
+
 
 class MembershipNotApproved(Exception):
     pass
@@ -59,6 +68,89 @@ def create_billingcycle(membership):
         raise
 
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _bulk_create_chunk(cycles):
+    """
+    Insert billing cycles and their first bills with two bulk inserts.
+
+    Backends which do not return primary keys from bulk inserts get them
+    with one extra query per model. post_save is sent for every row so
+    that the same log entries are written as by create_billingcycle().
+    """
+    BillingCycle.objects.bulk_create(cycles)
+    if any(cycle.pk is None for cycle in cycles):
+        created = BillingCycle.objects.filter(
+            membership_id__in=[cycle.membership_id for cycle in cycles],
+            start__in=[cycle.start for cycle in cycles])
+        ids = {(membership_id, start): pk for pk, membership_id, start
+               in created.values_list('id', 'membership_id', 'start')}
+        for cycle in cycles:
+            cycle.pk = ids[(cycle.membership_id, cycle.start)]
+
+    bills = [Bill(billingcycle=cycle, due_date=Bill.default_due_date()) for cycle in cycles]
+    Bill.objects.bulk_create(bills)
+    if any(bill.pk is None for bill in bills):
+        ids = dict(Bill.objects.filter(billingcycle__in=cycles).values_list('billingcycle_id', 'id'))
+        for bill in bills:
+            bill.pk = ids[bill.billingcycle_id]
+
+    for cycle in cycles:
+        post_save.send(sender=BillingCycle, instance=cycle, created=True,
+                       update_fields=None, raw=False, using=BillingCycle.objects.db)
+    for bill in bills:
+        post_save.send(sender=Bill, instance=bill, created=True,
+                       update_fields=None, raw=False, using=Bill.objects.db)
+    return bills
+
+
+def create_billingcycles(memberships, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Batch version of create_billingcycle().
+
+    Start and end dates, reference numbers and fees are computed up front
+    and the billing cycles and bills are inserted with bulk_create, one
+    transaction per chunk. The memberships must carry the latest_cycle_end
+    annotation of plan_makebills().
+
+    :return: list of created billing cycles
+    """
+    cycles = []
+    for membership in memberships:
+        if membership.status != 'A':
+            logger.critical("%s not Approved. Cannot send bill" % repr(membership))
+            raise MembershipNotApproved("%s not Approved. Cannot send bill" % repr(membership))
+        if membership.latest_cycle_end is not None:
+            cycle_start = membership.latest_cycle_end
+        elif membership.approved is not None:
+            cycle_start = membership.approved
+        else:
+            logger.critical("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
+            raise MembershipNotApproved("%s is missing the approved timestamp. Cannot send bill" % repr(membership))
+        cycles.append(BillingCycle(
+            membership=membership,
+            start=cycle_start,
+            end=BillingCycle.end_for_start(cycle_start),
+            reference_number=generate_membership_bill_reference_number(membership.id, cycle_start.year),
+            sum=fee_schedule.fee_at(membership.type, cycle_start).sum))
+
+    for chunk in _chunks(cycles, chunk_size):
+        try:
+            with transaction.atomic():
+                bills = _bulk_create_chunk(chunk)
+        except Exception:
+            logger.critical("%s" % traceback.format_exc())
+            logger.critical("Transaction rolled back, billing cycles not created!")
+            raise
+        context = BillRenderContext(bills, payments=Payment)
+        for bill in bills:
+            bill.send_as_email(context=context)
+    return cycles
+
+
 def can_send_reminder(last_due_date, latest_recorded_payment):
     """
     Determine if we have recent payments so that we can be sure
@@ -80,48 +172,122 @@ def can_send_reminder(last_due_date, latest_recorded_payment):
     return can_send
 
 
-def send_reminder(membership):
-    billing_cycle = membership.billingcycle_set.latest('end')
+def send_reminder(membership, billing_cycle=None, context=None):
+    """
+    :param billing_cycle: latest billing cycle of the membership
+    :param context: BillRenderContext for rendering the reminder
+    """
+    if billing_cycle is None:
+        billing_cycle = membership.billingcycle_set.latest('end')
     bill = Bill(billingcycle=billing_cycle)
     bill.reminder_count = billing_cycle.bill_set.count()
     bill.save()
-    bill.send_as_email()
+    bill.send_as_email(context=context)
     return bill
 
 
-def makebills():
+BillingPlan = namedtuple('BillingPlan', ['new_cycles', 'reminders'])
+
+
+def plan_makebills(latest_recorded_payment, now=None):
+    """
+    Find the approved memberships which need a new billing cycle and the
+    ones which need a reminder.
+
+    The decision is made from a fixed number of annotated queries instead
+    of walking the billing cycles and bills of every membership, so the
+    cost of planning does not grow with the number of members.
+
+    :param latest_recorded_payment: datetime of latest imported payment
+    :param now: reference time, defaults to datetime.now()
+    :return: BillingPlan with a list of memberships needing a new cycle and
+             a list of memberships needing a reminder
+    """
+    if now is None:
+        now = datetime.now()
+    last_of_month = datetime(now.year, now.month, calendar.monthrange(now.year, now.month)[1], 23, 59, 59)
+
+    latest_cycle = BillingCycle.objects.filter(membership=OuterRef('pk')).order_by('-end')
+    members = Membership.objects.filter(status='A').filter(id__gt=0).annotate(
+        latest_cycle_id=Subquery(latest_cycle.values('id')[:1]),
+        latest_cycle_end=Subquery(latest_cycle.values('end')[:1]),
+        latest_cycle_is_paid=Subquery(latest_cycle.values('is_paid')[:1]))
+
+    # Last bill due date for every unpaid cycle whose last bill is late
+    late_cycles = BillingCycle.objects.filter(
+        is_paid=False, membership__status='A', membership__id__gt=0).annotate(
+        last_due_date=Max('bill__due_date')).filter(last_due_date__lt=now)
+    late_due_dates = dict(late_cycles.values_list('id', 'last_due_date'))
+
+    new_cycles = []
+    reminders = []
+    for member in members:
+        # Billing cycles and bills
+        if member.latest_cycle_id is None or member.latest_cycle_end <= last_of_month:
+            # The new cycle is the latest one and its bill is not late yet
+            new_cycles.append(member)
+            continue
+
+        # Reminders
+        if member.latest_cycle_is_paid:
+            continue
+        last_due_date = late_due_dates.get(member.latest_cycle_id)
+        if last_due_date is None:
+            continue
+        if can_send_reminder(last_due_date, latest_recorded_payment):
+            reminders.append(member)
+    return BillingPlan(new_cycles=new_cycles, reminders=reminders)
+
+
+def makebills(batch=False, chunk_size=BATCH_CHUNK_SIZE, email_batch_size=None):
+    """
+    :param batch: create billing cycles and bills with bulk inserts
+    :param chunk_size: number of billing cycles per transaction in batch mode
+    :param email_batch_size: emails sent over one connection, default is settings.EMAIL_BATCH_SIZE
+    """
     logger.info("Running makebills...")
     latest_recorded_payment = Payment.latest_payment_date()
 
-    dt = datetime.now()
-    last_of_month = datetime(dt.year, dt.month, calendar.monthrange(dt.year, dt.month)[1], 23, 59, 59)
-    for member in Membership.objects.filter(status='A').filter(id__gt=0):
-        # Billing cycles and bills
-        cycles = member.billingcycle_set
-        if cycles.count() == 0:
-            cycle = create_billingcycle(member)
-            logger.info("Created billing cycle %s for %s" % (repr(cycle), repr(member)))
+    plan = plan_makebills(latest_recorded_payment)
+    with bulk_delivery(batch_size=email_batch_size):
+        if batch:
+            for cycle in create_billingcycles(plan.new_cycles, chunk_size=chunk_size):
+                logger.info("Created billing cycle %s for %s" % (repr(cycle), repr(cycle.membership)))
         else:
-            latest_cycle = cycles.latest("end")
-            if latest_cycle.end <= last_of_month:
+            for member in plan.new_cycles:
                 cycle = create_billingcycle(member)
-                logger.info("Created billing cycle %s for %s" %
-                            (repr(cycle), repr(member)))
-
-        # Reminders
-        latest_cycle = member.billingcycle_set.latest('end')
-        if not latest_cycle.is_paid:
-            if latest_cycle.is_last_bill_late():
-                last_due_date = latest_cycle.last_bill().due_date
-                if can_send_reminder(last_due_date, latest_recorded_payment):
-                    reminder = send_reminder(member)
-                    logger.info("Sent reminder %s to %s." % (repr(reminder), repr(member)))
+                logger.info("Created billing cycle %s for %s" % (repr(cycle), repr(member)))
+        # Latest cycles loaded with the contacts for rendering the reminders
+        context = BillRenderContext(cycles=[member.latest_cycle_id for member in plan.reminders],
+                                    payments=Payment)
+        for cycle in context.cycles:
+            reminder = send_reminder(cycle.membership, billing_cycle=cycle, context=context)
+            logger.info("Sent reminder %s to %s." % (repr(reminder), repr(cycle.membership)))
     logger.info("Done running makebills.")
 
 
 class Command(BaseCommand):
     help = 'Find expiring billing cycles, send bills, send reminders'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch',
+            dest='batch',
+            default=False,
+            action='store_true',
+            help='Create billing cycles and bills with bulk inserts')
+        parser.add_argument('--chunk-size',
+            dest='chunk_size',
+            default=BATCH_CHUNK_SIZE,
+            type=int,
+            help='Billing cycles per transaction in batch mode')
+        parser.add_argument('--email-batch-size',
+            dest='email_batch_size',
+            default=settings.EMAIL_BATCH_SIZE,
+            type=int,
+            help='Emails sent over one email connection')
+
     def handle(self, *args, **options):
         translation.activate(settings.LANGUAGE_CODE)
-        makebills()
+        makebills(batch=options['batch'], chunk_size=options['chunk_size'],
+                  email_batch_size=options['email_batch_size'])
+        flush_cache_stats()
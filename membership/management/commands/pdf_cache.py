@@ -0,0 +1,55 @@
+# encoding: UTF-8
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from membership.billing.pdf_cache import PDFCache
+from membership.models import Bill, PDFCacheStats
+
+
+class Command(BaseCommand):
+    help = 'Report the bill pdf cache usage and evict files over the size and age budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict',
+            dest='evict',
+            default=False,
+            action='store_true',
+            help='Remove the least recently used pdfs over the budget')
+        parser.add_argument('--max-bytes',
+            dest='max_bytes',
+            default=settings.PDF_CACHE_MAX_BYTES,
+            type=int,
+            help='Size budget of the cache')
+        parser.add_argument('--max-age',
+            dest='max_age',
+            default=settings.PDF_CACHE_MAX_AGE_DAYS,
+            type=int,
+            help='Days a pdf is kept after its last use')
+        parser.add_argument('--reset-stats',
+            dest='reset_stats',
+            default=False,
+            action='store_true',
+            help='Reset the hit and eviction counters')
+
+    def handle(self, *args, **options):
+        field = Bill._meta.get_field('pdf_file')
+        cache = PDFCache(field.storage, directory=field.upload_to)
+        if options['evict']:
+            count, evicted = cache.evict(max_bytes=options['max_bytes'],
+                                         max_age=timedelta(days=options['max_age']))
+            print("Evicted %d files, %d bytes" % (count, evicted))
+
+        count, used = cache.usage()
+        stats = PDFCacheStats.current()
+        hit_rate = stats.hit_rate()
+        print("Files: %d" % count)
+        print("Bytes used: %d of %d" % (used, options['max_bytes']))
+        print("Since %s" % stats.since.strftime("%Y-%m-%d %H:%M"))
+        print("Hits: %d, misses: %d, hit rate: %s" % (
+            stats.hits, stats.misses, "%.1f %%" % (100 * hit_rate) if hit_rate is not None else "-"))
+        print("Evictions: %d files, %d bytes" % (stats.evictions, stats.evicted_bytes))
+        if options['reset_stats']:
+            PDFCacheStats.reset()
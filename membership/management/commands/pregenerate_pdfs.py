@@ -0,0 +1,32 @@
+# encoding: UTF-8
+
+import os
+
+from django.core.management.base import BaseCommand
+
+from membership.billing.pdf_utils import pregenerate_bill_pdfs
+from membership.models import Bill
+
+
+class Command(BaseCommand):
+    help = 'Render missing and outdated bill pdfs to the cache, run after makebills'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers',
+            dest='workers',
+            default=os.cpu_count() or 1,
+            type=int,
+            help='Rendering processes')
+        parser.add_argument('--all',
+            dest='all',
+            default=False,
+            action='store_true',
+            help='Include bills of paid billing cycles')
+
+    def handle(self, *args, **options):
+        bills = Bill.objects.all()
+        if not options['all']:
+            bills = bills.filter(billingcycle__is_paid=False)
+        bill_ids = list(bills.order_by('id').values_list('id', flat=True))
+        rendered = pregenerate_bill_pdfs(bill_ids, workers=options['workers'])
+        print("Rendered %d of %d bill pdfs" % (rendered, len(bill_ids)))
@@ -7,7 +7,7 @@ from django.core.management import BaseCommand, CommandError
 
 from procountor.procountor_api import ProcountorAPIClient
 from membership.billing.payments import process_payments
-from procountor.models import APIToken
+from procountor.models import APIToken, SyncState
 
 
 def valid_date(s):
@@ -24,9 +24,13 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-s', "--startdate", help="Start Date (YYYY-MM-DD)",
                             default=None, type=valid_date)
+        parser.add_argument('--overlap', dest='overlap', type=int,
+                            default=settings.PROCOUNTOR_SYNC_OVERLAP_DAYS,
+                            help='Days before the last synced date to fetch again')
 
     def handle(self, *args, **options):
-        start = options['startdate'] or datetime.now() - timedelta(days=1)
+        now = datetime.now()
+        overlap = timedelta(days=options['overlap'])
 
         api_key = APIToken.current()
 
@@ -41,12 +45,40 @@ class Command(BaseCommand):
                                   api_key=api_key)
         api.refresh_access_token()
 
-        statements = api.get_referencepayments(start=start, end=datetime.now())
-        for message in process_payments(statements):
+        state = SyncState.for_endpoint(SyncState.REFERENCE_PAYMENTS)
+        known = state.known_archive_ids()
+        seen = []
+
+        def new_payments(statements):
+            for statement in statements:
+                seen.append((statement.archiveId, statement.paymentDate))
+                if statement.archiveId not in known:
+                    yield statement
+
+        start = self._window_start(options, state, overlap, now)
+        statements = api.get_referencepayments(start=start, end=now)
+        for message in process_payments(new_payments(statements)):
             print(message)
+        state.advance(now, seen, overlap)
 
-        bankstatements = api.get_bankstatements(start=start, end=datetime.now())
+        state = SyncState.for_endpoint(SyncState.BANK_STATEMENTS)
+        known = state.known_archive_ids()
+        seen = []
+        start = self._window_start(options, state, overlap, now)
+        bankstatements = api.get_bankstatements(start=start, end=now)
         for bankstatement in bankstatements:
-            for message in process_payments(
-                    [x for x in bankstatement.events if x["explanationCode"] in [700, 710]]):
-                print(message)
+            events = []
+            for event in bankstatement.events:
+                if event["explanationCode"] not in [700, 710]:
+                    continue
+                seen.append((event.archiveCode, event.payDate))
+                if event.archiveCode not in known:
+                    events.append(event)
+            if events:
+                for message in process_payments(events):
+                    print(message)
+        state.advance(now, seen, overlap)
+
+    @staticmethod
+    def _window_start(options, state, overlap, now):
+        return options['startdate'] or state.window_start(overlap) or now - timedelta(days=1)
@@ -0,0 +1,22 @@
+# encoding: UTF-8
+
+from django.core.management.base import BaseCommand
+
+from membership.models import MembershipSearchIndex, MembershipDuplicateKey
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the member search index and duplicate keys, needed after bulk changes of contacts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+            dest='batch_size',
+            default=1000,
+            type=int,
+            help='Memberships indexed per query')
+
+    def handle(self, *args, **options):
+        count = MembershipSearchIndex.rebuild(batch_size=options['batch_size'])
+        print("%d memberships indexed" % count)
+        count = MembershipDuplicateKey.rebuild(batch_size=options['batch_size'])
+        print("%d duplicate keys" % count)
@@ -0,0 +1,69 @@
+# encoding: UTF-8
+
+import logging
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from membership.models import BillingCycle, Payment
+
+logger = logging.getLogger("membership.recompute_paid_totals")
+
+
+def drifted_cycles():
+    """
+    BillingCycles whose paid_total differs from the sum of their payments,
+    annotated with the correct sum as actual_total
+    """
+    totals = Payment.objects.filter(billingcycle=OuterRef('pk')).order_by().values(
+        'billingcycle').annotate(total=Sum('amount')).values('total')
+    return BillingCycle.objects.annotate(actual_total=Coalesce(
+        Subquery(totals, output_field=DecimalField(max_digits=9, decimal_places=2)), Value(Decimal('0')))
+    ).exclude(paid_total=F('actual_total'))
+
+
+@transaction.atomic
+def recompute_paid_totals(repair=True, batch_size=1000):
+    """
+    Find and optionally repair BillingCycle.paid_total values that have
+    drifted from the payments. Repaired cycles also get is_paid updated.
+    :return: list of drifted cycles
+    """
+    cycles = list(drifted_cycles().select_for_update())
+    for cycle in cycles:
+        logger.warning("BillingCycle %s paid_total %.2f, payments total %.2f" % (
+            repr(cycle), cycle.paid_total, cycle.actual_total))
+    if repair and cycles:
+        for cycle in cycles:
+            cycle.previous_total = cycle.paid_total
+            cycle.paid_total = cycle.actual_total
+        BillingCycle.objects.bulk_update(cycles, ['paid_total'], batch_size=batch_size)
+        for cycle in cycles:
+            cycle.update_is_paid()
+    return cycles
+
+
+class Command(BaseCommand):
+    help = 'Verify and repair the paid totals of billing cycles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run',
+            dest='dry_run',
+            default=False,
+            action='store_true',
+            help='Only report the billing cycles with a wrong paid total')
+        parser.add_argument('--batch-size',
+            dest='batch_size',
+            default=1000,
+            type=int,
+            help='Billing cycles updated per query')
+
+    def handle(self, *args, **options):
+        cycles = recompute_paid_totals(repair=not options['dry_run'], batch_size=options['batch_size'])
+        for cycle in cycles:
+            print("%s: %.2f -> %.2f" % (cycle.reference_number, getattr(cycle, 'previous_total', cycle.paid_total),
+                                        cycle.actual_total))
+        print("%d billing cycles %s" % (len(cycles), "with wrong paid total" if options['dry_run'] else "repaired"))
@@ -0,0 +1,32 @@
+# encoding: UTF-8
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from membership.billing.import_jobs import requeue_interrupted_jobs, run_queued_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run payment imports queued from the web UI'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',
+            dest='once',
+            default=False,
+            action='store_true',
+            help='Run queued jobs and exit instead of polling')
+        parser.add_argument('--interval',
+            dest='interval',
+            default=5,
+            type=int,
+            help='Seconds between polls of the job queue')
+
+    def handle(self, *args, **options):
+        while True:
+            # Jobs of stopped workers have no recent heartbeat
+            requeue_interrupted_jobs()
+            run_queued_jobs()
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0005_cancelledbill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('subject', models.CharField(max_length=256, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('from_email', models.CharField(max_length=256, verbose_name='From')),
+                ('to', models.TextField(verbose_name='To')),
+                ('bcc', models.TextField(default='[]', verbose_name='Bcc')),
+                ('headers', models.TextField(default='{}', verbose_name='Headers')),
+                ('attachment_name', models.CharField(blank=True, max_length=128, verbose_name='Attachment name')),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('S', 'Sent'), ('F', 'Failed')], db_index=True, default='Q', max_length=1, verbose_name='Status')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.now, verbose_name='Next attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('sent', models.DateTimeField(null=True, verbose_name='Sent')),
+                ('bill', models.ForeignKey(null=True, verbose_name='Bill', to='membership.Bill', on_delete=models.PROTECT)),
+            ],
+        ),
+    ]
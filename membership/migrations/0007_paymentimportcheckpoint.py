@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0006_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file_hash', models.CharField(max_length=64, unique=True, verbose_name='File hash')),
+                ('byte_offset', models.BigIntegerField(default=0, verbose_name='Byte offset')),
+                ('last_transaction_id', models.CharField(blank=True, max_length=30, verbose_name='Last transaction id')),
+                ('rows', models.IntegerField(default=0, verbose_name='Rows')),
+                ('finished', models.BooleanField(default=False, verbose_name='Finished')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated')),
+            ],
+        ),
+    ]
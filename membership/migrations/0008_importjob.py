@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+
+from django.conf import settings
+from django.db import migrations, models
+import django.core.files.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('membership', '0007_paymentimportcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file', models.FileField(storage=django.core.files.storage.FileSystemStorage(location=settings.CACHE_DIRECTORY), upload_to='payment_imports', verbose_name='File')),
+                ('format', models.CharField(choices=[('op', 'Osuuspankki'), ('procountor', 'Procountor')], max_length=16, verbose_name='File type')),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('R', 'Running'), ('D', 'Done'), ('F', 'Failed')], db_index=True, default='Q', max_length=1, verbose_name='Status')),
+                ('rows', models.IntegerField(default=0, verbose_name='Rows')),
+                ('messages', models.TextField(default='[]', verbose_name='Messages')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('started', models.DateTimeField(null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(null=True, verbose_name='Finished')),
+                ('user', models.ForeignKey(null=True, on_delete=models.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+class Migration(migrations.Migration):
+
+    def fill_paid_total(apps, schema_editor):
+        BillingCycle = apps.get_model("membership", "BillingCycle")
+        Payment = apps.get_model("membership", "Payment")
+        totals = Payment.objects.filter(billingcycle=OuterRef('pk')).order_by().values(
+            'billingcycle').annotate(total=Sum('amount')).values('total')
+        BillingCycle.objects.update(paid_total=Coalesce(
+            Subquery(totals, output_field=DecimalField(max_digits=9, decimal_places=2)), Value(Decimal('0'))))
+
+    dependencies = [
+        ('membership', '0008_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingcycle',
+            name='paid_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), editable=False, max_digits=9, verbose_name='Paid total'),
+        ),
+        migrations.RunPython(fill_paid_total, migrations.RunPython.noop),
+    ]
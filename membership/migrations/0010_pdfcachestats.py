@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0009_billingcycle_paid_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDFCacheStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hits', models.BigIntegerField(default=0, verbose_name='Hits')),
+                ('misses', models.BigIntegerField(default=0, verbose_name='Misses')),
+                ('evictions', models.BigIntegerField(default=0, verbose_name='Evictions')),
+                ('evicted_bytes', models.BigIntegerField(default=0, verbose_name='Evicted bytes')),
+                ('since', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Since')),
+            ],
+        ),
+    ]
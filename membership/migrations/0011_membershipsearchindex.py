@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Frozen copies of membership.models.SEARCH_FTS_TABLE and search_index_values
+SEARCH_FTS_TABLE = 'membership_search_fts'
+SEARCH_SEPARATOR = '|'
+INDEX_TABLE = 'membership_membershipsearchindex'
+
+
+def _search_join(values):
+    return SEARCH_SEPARATOR + SEARCH_SEPARATOR.join(
+        (value or '').replace(SEARCH_SEPARATOR, ' ').lower() for value in values) + SEARCH_SEPARATOR
+
+
+def search_index_values(person, organization):
+    names = []
+    document = []
+    for contact, contact_names in [(person, ['first_name', 'last_name', 'given_names']),
+                                   (organization, ['organization_name'])]:
+        if contact is None:
+            continue
+        names.extend(getattr(contact, name) for name in contact_names)
+        document.extend(getattr(contact, name) for name in contact_names + ['email', 'phone', 'sms'])
+    return {'names': _search_join(names), 'document': _search_join(document)}
+
+POSTGRESQL_CREATE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX membership_search_document_trgm ON %s USING gin (document gin_trgm_ops)" % INDEX_TABLE,
+    "CREATE INDEX membership_search_names_trgm ON %s USING gin (names gin_trgm_ops)" % INDEX_TABLE,
+]
+POSTGRESQL_DROP = [
+    "DROP INDEX IF EXISTS membership_search_document_trgm",
+    "DROP INDEX IF EXISTS membership_search_names_trgm",
+]
+
+# External content FTS5 table, kept in sync with triggers
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE {fts} USING fts5(document, names, content='{table}', content_rowid='membership_id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {fts}(rowid, document, names) VALUES (new.membership_id, new.document, new.names); END",
+    "CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, document, names) VALUES ('delete', old.membership_id, old.document, old.names); "
+    "END",
+    "CREATE TRIGGER {fts}_update AFTER UPDATE ON {table} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, document, names) VALUES ('delete', old.membership_id, old.document, old.names); "
+    "INSERT INTO {fts}(rowid, document, names) VALUES (new.membership_id, new.document, new.names); END",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS {fts}_insert",
+    "DROP TRIGGER IF EXISTS {fts}_delete",
+    "DROP TRIGGER IF EXISTS {fts}_update",
+    "DROP TABLE IF EXISTS {fts}",
+]
+
+
+def _execute(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement.format(fts=SEARCH_FTS_TABLE, table=INDEX_TABLE))
+
+
+class Migration(migrations.Migration):
+
+    def create_trigram_index(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            _execute(schema_editor, POSTGRESQL_CREATE)
+        elif vendor == 'sqlite':
+            # Needs SQLite 3.34 or newer, searches use LIKE without it
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5'), sqlite_version()")
+                fts5, version = cursor.fetchone()
+            if fts5 and tuple(int(part) for part in version.split('.')) >= (3, 34):
+                _execute(schema_editor, SQLITE_CREATE)
+
+    def drop_trigram_index(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            _execute(schema_editor, POSTGRESQL_DROP)
+        elif vendor == 'sqlite':
+            _execute(schema_editor, SQLITE_DROP)
+
+    def fill_index(apps, schema_editor):
+        Membership = apps.get_model("membership", "Membership")
+        MembershipSearchIndex = apps.get_model("membership", "MembershipSearchIndex")
+        MembershipSearchIndex.objects.bulk_create(
+            (MembershipSearchIndex(membership_id=membership.id,
+                                   **search_index_values(membership.person, membership.organization))
+             for membership in Membership.objects.select_related('person', 'organization').iterator()))
+
+    dependencies = [
+        ('membership', '0010_pdfcachestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipSearchIndex',
+            fields=[
+                ('membership', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='membership.Membership')),
+                ('document', models.TextField()),
+                ('names', models.TextField()),
+            ],
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+        migrations.RunPython(fill_index, migrations.RunPython.noop),
+    ]
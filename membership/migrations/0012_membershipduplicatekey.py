@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Frozen copy of membership.models.duplicate_keys
+ORGANIZATION_LEGAL_FORMS = {'ry', 'oy', 'oyj', 'ab', 'ky', 'tmi', 'ay', 'ltd', 'inc', 'rf'}
+MIN_PHONE_DIGITS = 6
+
+
+def _normalize_name(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return ' '.join(value.lower().split())
+
+
+def _normalize_phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    if digits.startswith('358'):
+        digits = '0' + digits[3:]
+    return digits
+
+
+def duplicate_keys(person, organization):
+    keys = set()
+    if person and not organization:
+        first_name = _normalize_name(person.first_name)
+        last_name = _normalize_name(person.last_name)
+        if first_name and last_name:
+            keys.add('name:%s|%s' % (first_name, last_name))
+        email = (person.email or '').strip().lower()
+        if email:
+            keys.add('email:%s' % email)
+        for number in [person.phone, person.sms]:
+            digits = _normalize_phone(number)
+            if len(digits) >= MIN_PHONE_DIGITS:
+                keys.add('phone:%s' % digits)
+    elif organization and not person:
+        tokens = set(re.findall(r'\w+', _normalize_name(organization.organization_name))) - ORGANIZATION_LEGAL_FORMS
+        if tokens:
+            keys.add('org:%s' % ' '.join(sorted(tokens)))
+    return keys
+
+
+class Migration(migrations.Migration):
+
+    def fill_keys(apps, schema_editor):
+        Membership = apps.get_model("membership", "Membership")
+        MembershipDuplicateKey = apps.get_model("membership", "MembershipDuplicateKey")
+        MembershipDuplicateKey.objects.bulk_create(
+            MembershipDuplicateKey(membership_id=membership.id, key=key)
+            for membership in Membership.objects.select_related('person', 'organization').iterator()
+            for key in duplicate_keys(membership.person, membership.organization))
+
+    dependencies = [
+        ('membership', '0011_membershipsearchindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipDuplicateKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=320)),
+                ('membership', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duplicate_keys', to='membership.Membership')),
+            ],
+            options={
+                'unique_together': {('membership', 'key')},
+            },
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0013_payment_day_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingemail',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Locked until'),
+        ),
+    ]
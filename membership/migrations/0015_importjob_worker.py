@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0014_outgoingemail_locked_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='worker',
+            field=models.CharField(blank=True, max_length=255, verbose_name='Worker'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='heartbeat',
+            field=models.DateTimeField(null=True, verbose_name='Heartbeat'),
+        ),
+    ]
@@ -1,31 +1,40 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_right
+from collections import defaultdict
 from datetime import datetime, timedelta
 from decimal import Decimal
+import json
 import logging
+import re
+import time
+import unicodedata
 from django.core.files.storage import FileSystemStorage
-from membership.billing.pdf_utils import get_bill_pdf, create_reminder_pdf
+from membership.billing.pdf_utils import get_bill_pdf, open_bill_pdf, create_reminder_pdf
 
-from membership.reference_numbers import barcode_4, group_right,\
-    generate_membership_bill_reference_number
+from membership.reference_numbers import generate_membership_bill_reference_number
 
 import traceback
 
-from io import StringIO, BytesIO
+from tempfile import SpooledTemporaryFile
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db import transaction
-from django.db.models import Q, Sum, Count
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum, Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce
 from django.utils.translation import ugettext_lazy as _
 import django.utils.timezone
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.forms import ValidationError
+from django.core.mail import EmailMessage
 
 from django.db.models.query import QuerySet
 
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django_comments.models import Comment
 
 from .utils import log_change, tupletuple_to_dict
 
@@ -182,11 +191,33 @@ class MembershipManager(models.Manager):
         qs = MembershipQuerySet(self.model)
         return qs.sort(sortkey)
 
-    def get_query_set(self):
-        return MembershipQuerySet(self.model)
+    def get_queryset(self):
+        return MembershipQuerySet(self.model, using=self._db)
+
+    def for_listing(self):
+        return self.get_queryset().for_listing()
 
 
 class MembershipQuerySet(QuerySet):
+    def for_listing(self):
+        """
+        Memberships with the data of membership_list.html loaded in one
+        query: contacts joined, comment_count and has_duplicates annotated.
+        """
+        comments = Comment.objects.filter(
+            content_type__app_label='membership', content_type__model='membership',
+            object_pk=Cast(OuterRef('pk'), models.TextField()), site_id=settings.SITE_ID, is_public=True)
+        if getattr(settings, 'COMMENTS_HIDE_REMOVED', True):
+            comments = comments.filter(is_removed=False)
+        comment_count = comments.order_by().values('object_pk').annotate(count=Count('pk')).values('count')
+        shared_keys = MembershipDuplicateKey.objects.filter(key=OuterRef('key')).exclude(
+            membership_id=OuterRef('membership_id'))
+        duplicate_keys = MembershipDuplicateKey.objects.filter(membership_id=OuterRef('pk')).annotate(
+            shared=Exists(shared_keys)).filter(shared=True)
+        return self.select_related('person', 'organization').annotate(
+            comment_count=Coalesce(Subquery(comment_count, output_field=models.IntegerField()), 0),
+            has_duplicates=Exists(duplicate_keys))
+
     def sort(self, sortkey):
         sortkey = sortkey.strip()
         reverse = False
@@ -448,92 +479,50 @@ class Membership(models.Model):
                 contact.delete_if_no_references(user)
         log_change(self, user, change_message="Deleted")
 
+    def duplicate_ids(self):
+        """
+        Ids of possible duplicate memberships, memberships sharing a
+        normalized name, email, phone number or organization name.
+        """
+        return MembershipDuplicateKey.duplicate_ids([self.id])[self.id]
+
     def duplicates(self):
         """
-        Finds duplicates of memberships, looks for similar names, emails, phone
-        numbers and contact details.  Returns a QuerySet object that doesn't
+        Finds duplicates of memberships. Returns a QuerySet object that doesn't
         include the membership of which duplicates are search for itself.
         """
-        matches = Membership.objects.none()
-
-        if self.person and not self.organization:
-            # Matches by first or last name
-            matches |= Membership.objects.filter(
-                person__first_name__icontains=self.person.first_name.strip(),
-                person__last_name__icontains=self.person.last_name.strip())
-
-            # Matches by email address
-            matches |= Membership.objects.filter(
-                person__email__contains=self.person.email.strip())
-
-            # Matches by phone or SMS number
-            phone_number = self.person.phone.strip()
-            sms_number = self.person.sms.strip()
-            if phone_number:
-                matches |= Membership.objects.filter(person__phone__icontains=phone_number)
-            if sms_number:
-                matches |= Membership.objects.filter(person__sms__icontains=sms_number)
-        elif self.organization and not self.person:
-            organization_name = self.organization.organization_name.strip()
-            matches = Membership.objects.filter(
-                organization__organization_name__icontains=organization_name)
-
-        return matches.exclude(id=self.id)
+        return Membership.objects.filter(id__in=self.duplicate_ids())
 
     @classmethod
     def search(cls, query):
-        person_contacts = Contact.objects
-        org_contacts = Contact.objects
-
+        """
+        Search memberships with MembershipSearchIndex. Each word narrows
+        the search further, #123 matches the membership id and "word" a
+        whole name. A membership with an alias named as any word matches.
+        """
         # Split into words and remove duplicates
         words = set(query.split(" "))
-        # Each word narrows the search further
+        index = MembershipSearchIndex.objects.all()
+        text_words = []
         for word in words:
             # Exact match for membership id (for Django admin)
             if word.startswith('#'):
                 try:
-                    mid = int(word[1:])
-                    person_contacts = person_contacts.filter(person_set__id=mid)
-                    org_contacts = org_contacts.filter(organization_set__id=mid)
+                    index = index.filter(membership_id=int(word[1:]))
                     continue
                 except ValueError:
                     pass  # Continue processing normal search
-
-            # Exact word match when word is "word"
-            if word.startswith('"') and word.endswith('"'):
-                word = word[1:-1]
-                # Search query for people
-                f_q = Q(first_name__iexact=word)
-                l_q = Q(last_name__iexact=word)
-                g_q = Q(given_names__iexact=word)
-                person_contacts = person_contacts.filter(f_q | l_q | g_q)
-
-                # Search for organizations
-                o_q = Q(organization_name__iexact=word)
-                org_contacts = org_contacts.filter(o_q)
-            else:
-                # Common search parameters
-                email_q = Q(email__icontains=word)
-                phone_q = Q(phone__icontains=word)
-                sms_q = Q(sms__icontains=word)
-                common_q = email_q | phone_q | sms_q
-
-                # Search query for people
-                f_q = Q(first_name__icontains=word)
-                l_q = Q(last_name__icontains=word)
-                g_q = Q(given_names__icontains=word)
-                person_contacts = person_contacts.filter(f_q | l_q | g_q | common_q)
-
-                # Search for organizations
-                o_q = Q(organization_name__icontains=word)
-                org_contacts = org_contacts.filter(o_q | common_q)
+            text_words.append(word)
+        if text_words:
+            index = index & MembershipSearchIndex.matching(text_words)
 
         # Finally combine matches; all membership for which there are matching
         # contacts or aliases
-        person_q = Q(person__in=person_contacts)
-        org_q = Q(organization__in=org_contacts)
-        alias_q = Q(alias__name__in=words)
-        qs = Membership.objects.filter(person_q | org_q | alias_q).distinct()
+        from services.models import Alias, normalize_alias
+        index_q = Q(id__in=index.values('membership_id'))
+        alias_q = Q(id__in=Alias.objects.filter(normalized_name__in=[normalize_alias(word) for word in words])
+                    .values('owner_id'))
+        qs = Membership.objects.filter(index_q | alias_q)
 
         qs = qs.order_by("organization__organization_name",
                          "person__last_name",
@@ -550,11 +539,7 @@ class Membership(models.Model):
         bill_qs = Bill.objects.filter(unpaid_filter, type_filter, date_filter,
                                       not_deleted_filter)
 
-        membership_ids = set()
-        for bill in bill_qs:
-            membership_ids.add(bill.billingcycle.membership.id)
-
-        return Membership.objects.filter(id__in=membership_ids)
+        return Membership.objects.filter(id__in=bill_qs.values('billingcycle__membership_id'))
 
     def __repr__(self):
         return "<Membership(%s): %s (%i)>" % (self.type, str(self), self.id)
@@ -580,13 +565,79 @@ class Fee(models.Model):
                (self.get_type_display(), str(self.sum), str(self.vat_percentage), str(self.start))
 
 
+class FeeSchedule(object):
+    """
+    The Fee table loaded into memory, sorted by start date for each fee type.
+
+    The table is loaded on first use and dropped when a Fee is saved or
+    deleted in this process. Changes made by other processes are loaded
+    at most FEE_SCHEDULE_CACHE_SECONDS later.
+    """
+
+    def __init__(self):
+        self._fees = None
+        self._loaded = 0
+
+    def invalidate(self, **kwargs):
+        self._fees = None
+
+    def _load(self):
+        fees = {}
+        for fee in Fee.objects.order_by('start', 'id'):
+            fees.setdefault(fee.type, []).append(fee)
+        return {type: ([fee.start for fee in type_fees], type_fees)
+                for type, type_fees in fees.items()}
+
+    def fee_at(self, type, date):
+        """
+        Get the Fee in effect at `date` for membership type `type`.
+        :raises Fee.DoesNotExist: if no fee is in effect
+        """
+        fees = self._fees
+        now = time.monotonic()
+        if fees is None or now - self._loaded > settings.FEE_SCHEDULE_CACHE_SECONDS:
+            fees = self._fees = self._load()
+            self._loaded = now
+        starts, type_fees = fees.get(type, ([], []))
+        i = bisect_right(starts, date)
+        if i == 0:
+            raise Fee.DoesNotExist("No fee for type %s at %s" % (type, date))
+        return type_fees[i - 1]
+
+
+fee_schedule = FeeSchedule()
+
+
 class BillingCycleManager(models.Manager):
 
-    def get_query_set(self):
-        return BillingCycleQuerySet(self.model)
+    def get_queryset(self):
+        return BillingCycleQuerySet(self.model, using=self._db)
+
+    def for_listing(self):
+        return self.get_queryset().for_listing()
+
+
+# Bill fields annotated on listed billing cycles as last_bill_<field>
+LISTING_LAST_BILL_FIELDS = ('id', 'due_date', 'reminder_count', 'created')
+
+_NOT_ANNOTATED = object()
 
 
 class BillingCycleQuerySet(QuerySet):
+    def for_listing(self):
+        """
+        Billing cycles with the data of bill_list.html loaded in a constant
+        number of queries: the last and first bill annotated, memberships
+        and their contacts joined and payments prefetched.
+        """
+        bills = Bill.objects.filter(billingcycle=OuterRef('pk'))
+        last_bill = bills.order_by('-due_date', '-id')
+        annotations = {'last_bill_%s' % field: Subquery(last_bill.values(field)[:1])
+                       for field in LISTING_LAST_BILL_FIELDS}
+        annotations['first_bill_due_date'] = Subquery(bills.order_by('due_date').values('due_date')[:1])
+        return self.annotate(**annotations).select_related(
+            'membership', 'membership__person', 'membership__organization').prefetch_related('payment_set')
+
     def sort(self, sortkey):
         sortkey = sortkey.strip()
         reverse = False
@@ -624,6 +675,9 @@ class BillingCycle(models.Model):
     end =  models.DateTimeField(verbose_name=_('End'))
     sum = models.DecimalField(_('Sum'), max_digits=6, decimal_places=2) # This limits sum to 9999,99
     is_paid = models.BooleanField(default=False, verbose_name=_('Is paid'))
+    # Sum of attached payments, maintained by Payment.save() and delete
+    paid_total = models.DecimalField(_('Paid total'), max_digits=9, decimal_places=2, default=Decimal('0'),
+                                     editable=False)
     # NOT an integer since it can begin with 0 XXX: format
     reference_number = models.CharField(max_length=64, verbose_name=_('Reference number'))
     logs = property(_get_logs)
@@ -653,9 +707,13 @@ class BillingCycle(models.Model):
     def is_first_bill_late(self):
         if self.is_paid:
             return False
-        try:
-            first_due_date = self.bill_set.order_by('due_date')[0].due_date
-        except IndexError:
+        first_due_date = getattr(self, 'first_bill_due_date', _NOT_ANNOTATED)
+        if first_due_date is _NOT_ANNOTATED:
+            try:
+                first_due_date = self.bill_set.order_by('due_date')[0].due_date
+            except IndexError:
+                first_due_date = None
+        if first_due_date is None:
             # No bills sent yet
             return False
         if datetime.now() > first_due_date:
@@ -663,17 +721,24 @@ class BillingCycle(models.Model):
         return False
 
     def is_last_bill_late(self):
-        if self.is_paid or self.last_bill() is None:
+        if self.is_paid:
+            return False
+        last_due_date = getattr(self, 'last_bill_due_date', _NOT_ANNOTATED)
+        if last_due_date is _NOT_ANNOTATED:
+            last_bill = self.last_bill()
+            last_due_date = last_bill.due_date if last_bill else None
+        if last_due_date is None:
             return False
-        if datetime.now() > self.last_bill().due_date:
+        if datetime.now() > last_due_date:
             return True
         return False
 
     def amount_paid(self):
-        data = self.payment_set.aggregate(Sum('amount'))['amount__sum']
-        if data is None:
-            data = Decimal('0')
-        return data
+        return self.paid_total
+
+    @staticmethod
+    def add_to_paid_total(cycle_id, amount):
+        BillingCycle.objects.filter(pk=cycle_id).update(paid_total=F('paid_total') + amount)
 
     def update_is_paid(self, user=None):
         was_paid = self.is_paid
@@ -693,18 +758,10 @@ class BillingCycle(models.Model):
             log_change(self, user, change_message="Marked as paid")
 
     def get_fee(self):
-        for_this_type = Q(type=self.membership.type)
-        not_before_start = Q(start__lte=self.start)
-        fees = Fee.objects.filter(for_this_type, not_before_start)
-        valid_fee = fees.latest('start').sum
-        return valid_fee
+        return fee_schedule.fee_at(self.membership.type, self.start).sum
 
     def get_vat_percentage(self):
-        for_this_type = Q(type=self.membership.type)
-        not_before_start = Q(start__lte=self.start)
-        fees = Fee.objects.filter(for_this_type, not_before_start)
-        vat_percentage = fees.latest('start').vat_percentage
-        return vat_percentage
+        return fee_schedule.fee_at(self.membership.type, self.start).vat_percentage
 
     def is_cancelled(self):
         first_bill = self.first_bill()
@@ -755,15 +812,32 @@ class BillingCycle(models.Model):
         return qs
 
     @classmethod
-    def get_pdf_reminders(cls, memberid=None):
-        buffer = BytesIO()
+    def get_pdf_reminders_file(cls, memberid=None, workers=1):
+        """
+        Render paper reminders to a temporary file, spooled to disk when
+        larger than PDF_SPOOL_MAX_SIZE
+        :param workers: rendering processes, only management commands should use more than one
+        :return: file positioned at the start or None if no reminders
+        """
         cycles = cls.create_paper_reminder_list(memberid)
         if len(cycles) == 0:
             return None
-        create_reminder_pdf(cycles, buffer, payments=Payment)
-        pdf_content = buffer.getvalue()
-        buffer.close()
-        return pdf_content
+        output = SpooledTemporaryFile(max_size=settings.PDF_SPOOL_MAX_SIZE)
+        try:
+            create_reminder_pdf(cycles, output, payments=Payment, workers=workers)
+        except Exception:
+            output.close()
+            raise
+        output.seek(0)
+        return output
+
+    @classmethod
+    def get_pdf_reminders(cls, memberid=None, workers=1):
+        pdf_file = cls.get_pdf_reminders_file(memberid, workers=workers)
+        if pdf_file is None:
+            return None
+        with pdf_file:
+            return pdf_file.read()
 
     @classmethod
     def create_paper_reminder_list(cls, memberid=None):
@@ -773,7 +847,7 @@ class BillingCycle(models.Model):
         :return: list of billingcycles
         """
         datalist = []
-        for cycle in cls.get_reminder_billingcycles(memberid).all():
+        for cycle in cls.get_reminder_billingcycles(memberid).prefetch_related('bill_set'):
             # check if paper reminder already sent
             cont = False
             for bill in cycle.bill_set.all():
@@ -799,22 +873,65 @@ class BillingCycle(models.Model):
     def __str__(self):
         return str(self.start.date()) + "--" + str(self.end_date())
 
+    @staticmethod
+    def end_for_start(start):
+        """Default end timestamp for a billing cycle beginning at start"""
+        end = start + timedelta(days=365)
+        if (end.day != start.day):
+            # Leap day
+            end += timedelta(days=1)
+        return end
+
     def save(self, *args, **kwargs):
         if not self.end:
-            self.end = self.start + timedelta(days=365)
-            if (self.end.day != self.start.day):
-                # Leap day
-                self.end += timedelta(days=1)
+            self.end = self.end_for_start(self.start)
         if not self.reference_number:
             self.reference_number = generate_membership_bill_reference_number(self.membership.id, self.start.year)
         if not self.sum:
             self.sum = self.get_fee()
+        # paid_total of a stored cycle is only changed incrementally, so
+        # saving a stale instance must not overwrite it
+        if not self._state.adding and not kwargs.get('update_fields') and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != 'paid_total']
         super(BillingCycle, self).save(*args, **kwargs)
 
 
 cache_storage = FileSystemStorage(location=settings.CACHE_DIRECTORY)
 
 
+class PDFCacheStats(models.Model):
+    """
+    Counters of the bill pdf cache, a single row
+    """
+    hits = models.BigIntegerField(default=0, verbose_name=_('Hits'))
+    misses = models.BigIntegerField(default=0, verbose_name=_('Misses'))
+    evictions = models.BigIntegerField(default=0, verbose_name=_('Evictions'))
+    evicted_bytes = models.BigIntegerField(default=0, verbose_name=_('Evicted bytes'))
+    since = models.DateTimeField(default=django.utils.timezone.now, verbose_name=_('Since'))
+
+    @classmethod
+    def current(cls):
+        return cls.objects.get_or_create(pk=1)[0]
+
+    @classmethod
+    def increment(cls, **counts):
+        updates = {field: F(field) + count for field, count in counts.items()}
+        if not cls.objects.filter(pk=1).update(**updates):
+            stats, created = cls.objects.get_or_create(pk=1, defaults=counts)
+            if not created:
+                cls.objects.filter(pk=1).update(**updates)
+
+    @classmethod
+    def reset(cls):
+        cls.objects.filter(pk=1).delete()
+
+    def hit_rate(self):
+        if not self.hits + self.misses:
+            return None
+        return self.hits / (self.hits + self.misses)
+
+
 class CancelledBill(models.Model):
     """List of bills that have been cancelled"""
     bill = models.OneToOneField('Bill', verbose_name=_('Original bill'), on_delete=models.PROTECT)
@@ -846,12 +963,16 @@ class Bill(models.Model):
     def __str__(self):
         return '{sent_on} {date}'.format(sent_on=_('Sent on'), date=str(self.created))
 
+    @staticmethod
+    def default_due_date(reminder_count=0):
+        due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
+        # Second is from reminder_count so that tests can assume due_date
+        # is monotonically increasing
+        return due_date.replace(hour=23, minute=59, second=reminder_count % 60)
+
     def save(self, *args, **kwargs):
         if not self.due_date:
-            self.due_date = datetime.now() + timedelta(days=settings.BILL_DAYS_TO_DUE)
-            # Second is from reminder_count so that tests can assume due_date
-            # is monotonically increasing
-            self.due_date = self.due_date.replace(hour=23, minute=59, second=self.reminder_count % 60)
+            self.due_date = self.default_due_date(self.reminder_count)
         super(Bill, self).save(*args, **kwargs)
 
     def is_reminder(self):
@@ -866,88 +987,42 @@ class Bill(models.Model):
         return False
 
     # FIXME: different template based on class? should this code be here?
-    def render_as_text(self):
+    def render_as_text(self, context=None):
         """
         Renders the object as text suitable for sending as e-mail.
+        :param context: BillRenderContext with this bill loaded
         """
-        membership = self.billingcycle.membership
-        vat = Decimal(self.billingcycle.get_vat_percentage()) / Decimal(100)
+        if context is None:
+            # imported here since on top-level it would lead into a circular import
+            from membership.billing.render_context import BillRenderContext
+            context = BillRenderContext()
         if not self.is_reminder():
-            non_vat_amount = (self.billingcycle.sum / (Decimal(1) + vat))
-            return render_to_string('membership/bill.txt', {
-                'membership_type' : MEMBER_TYPES_DICT[membership.type],
-                'membership_type_raw' : membership.type,
-                'bill_id': self.id,
-                'member_id': membership.id,
-                'member_name': membership.name(),
-                'billing_contact': membership.billing_contact,
-                'billing_name': str(membership.get_billing_contact()),
-                'street_address': membership.get_billing_contact().street_address,
-                'postal_code': membership.get_billing_contact().postal_code,
-                'post_office': membership.get_billing_contact().post_office,
-                'country': membership.get_billing_contact().country,
-                'billingcycle': self.billingcycle,
-                'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
-                'bic_code': settings.BIC_CODE,
-                'due_date': self.due_date,
-                'today': datetime.now(),
-                'reference_number': group_right(self.billingcycle.reference_number),
-                'sum': self.billingcycle.sum,
-                'vat_amount': vat * non_vat_amount,
-                'non_vat_amount': non_vat_amount,
-                'vat_percentage': self.billingcycle.get_vat_percentage(),
-                'barcode': barcode_4(iban = settings.IBAN_ACCOUNT_NUMBER,
-                                     refnum = self.billingcycle.reference_number,
-                                     duedate = self.due_date,
-                                     euros = self.billingcycle.sum)
-                })
+            template = 'membership/bill.txt'
         else:
-            amount_paid = self.billingcycle.amount_paid()
-            sum = self.billingcycle.sum - amount_paid
-            non_vat_amount = sum / (Decimal(1) + vat)
-            return render_to_string('membership/reminder.txt', {
-                'membership_type' : MEMBER_TYPES_DICT[membership.type],
-                'membership_type_raw' : membership.type,
-                'bill_id': self.id,
-                'member_id': membership.id,
-                'member_name': membership.name(),
-                'billing_contact': membership.billing_contact,
-                'billing_name': str(membership.get_billing_contact()),
-                'street_address': membership.get_billing_contact().street_address,
-                'postal_code': membership.get_billing_contact().postal_code,
-                'post_office': membership.get_billing_contact().post_office,
-                'municipality': membership.municipality,
-                'billing_email': membership.get_billing_contact().email,
-                'email': membership.primary_contact().email,
-                'billingcycle': self.billingcycle,
-                'iban_account_number': settings.IBAN_ACCOUNT_NUMBER,
-                'bic_code': settings.BIC_CODE,
-                'today': datetime.now(),
-                'latest_recorded_payment': Payment.latest_payment_date(),
-                'reference_number': group_right(self.billingcycle.reference_number),
-                'original_sum': self.billingcycle.sum,
-                'amount_paid': amount_paid,
-                'sum': sum,
-                'vat_amount': vat * non_vat_amount,
-                'non_vat_amount':   non_vat_amount,
-                'vat_percentage': self.billingcycle.get_vat_percentage(),
-                'barcode': barcode_4(iban = settings.IBAN_ACCOUNT_NUMBER,
-                                     refnum = self.billingcycle.reference_number,
-                                     duedate = None,
-                                     euros = sum)
-                })
-
-    def generate_pdf(self):
+            template = 'membership/reminder.txt'
+        return render_to_string(template, context.text_context(self))
+
+    def generate_pdf(self, context=None):
         """
         Generate pdf and return pdf content
+        :param context: BillRenderContext with this bill loaded
+        """
+        return get_bill_pdf(self, payments=Payment, context=context)
+
+    def open_pdf(self):
+        """
+        Generate pdf if needed and return it as an open file
         """
-        return get_bill_pdf(self, payments=Payment)
+        return open_bill_pdf(self, payments=Payment)
 
     # FIXME: Should save sending date
-    def send_as_email(self):
+    def send_as_email(self, context=None):
+        """
+        :param context: BillRenderContext with this bill loaded
+        """
         membership = self.billingcycle.membership
         if self.billingcycle.sum > 0:
-            ret_items = send_as_email.send_robust(self.__class__, instance=self)
+            ret_items = send_as_email.send_robust(self.__class__, instance=self, context=context)
             for item in ret_items:
                 sender, error = item
                 if error != None:
@@ -976,6 +1051,10 @@ class Payment(models.Model):
         permissions = (
             ("can_import_payments", "Can import payment data"),
         )
+        indexes = [
+            # Payment lists are ordered and paginated by these
+            models.Index(fields=['payment_day', 'id'], name='membership_payment_day_id'),
+        ]
 
     """
     Payment object for billing
@@ -1001,6 +1080,47 @@ class Payment(models.Model):
     def __str__(self):
         return "%.2f euros (reference '%s', date '%s')" % (self.amount, self.reference_number, self.payment_day)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Payment, cls).from_db(db, field_names, values)
+        if 'billingcycle_id' in field_names and 'amount' in field_names:
+            instance._saved_paid_state = (instance.billingcycle_id, instance.amount)
+        else:
+            # Deferred, read from the database when saved
+            instance._saved_paid_state = None
+        return instance
+
+    def _stored_paid_state(self):
+        state = Payment.objects.filter(pk=self.pk).values_list('billingcycle_id', 'amount').first()
+        return state or (None, None)
+
+    def _saves_paid_state(self, update_fields):
+        """True if save() writes both billingcycle and amount"""
+        if 'billingcycle_id' not in self.__dict__ or 'amount' not in self.__dict__:
+            # Deferred fields are left out of the update
+            return False
+        if update_fields is None:
+            return True
+        update_fields = set(update_fields)
+        return bool(update_fields & {'billingcycle', 'billingcycle_id'}) and 'amount' in update_fields
+
+    def save(self, *args, **kwargs):
+        old_state = getattr(self, '_saved_paid_state', (None, None))
+        if old_state is None:
+            old_state = self._stored_paid_state()
+        super(Payment, self).save(*args, **kwargs)
+        if self._saves_paid_state(kwargs.get('update_fields')):
+            new_state = (self.billingcycle_id, self.amount)
+        else:
+            new_state = self._stored_paid_state()
+        if old_state != new_state:
+            old_cycle_id, old_amount = old_state
+            if old_cycle_id:
+                BillingCycle.add_to_paid_total(old_cycle_id, -old_amount)
+            if new_state[0]:
+                BillingCycle.add_to_paid_total(new_state[0], new_state[1])
+        self._saved_paid_state = new_state
+
     def attach_to_cycle(self, cycle, user=None):
         if self.billingcycle:
             raise PaymentAttachedError("Payment %s already attached to BillingCycle %s." % (repr(self), repr(cycle)))
@@ -1008,6 +1128,7 @@ class Payment(models.Model):
         self.billingcycle = cycle
         self.ignore = False
         self.save()
+        cycle.refresh_from_db(fields=['paid_total'])
         logger.info("Payment %s attached to member %s cycle %s." % (repr(self),
             cycle.membership.id, repr(cycle)))
         if user:
@@ -1022,6 +1143,7 @@ class Payment(models.Model):
             repr(cycle)))
         self.billingcycle = None
         self.save()
+        cycle.refresh_from_db(fields=['paid_total'])
         if user:
             log_change(self, user, change_message="Detached from billing cycle")
         cycle.update_is_paid()
@@ -1048,6 +1170,388 @@ class Payment(models.Model):
             return None
 
 
+class PaymentImportCheckpoint(models.Model):
+    """
+    Progress of a streaming payment file import, used to resume the import
+    of the same file after an interruption.
+    """
+    file_hash = models.CharField(max_length=64, unique=True, verbose_name=_('File hash'))
+    byte_offset = models.BigIntegerField(default=0, verbose_name=_('Byte offset'))
+    last_transaction_id = models.CharField(max_length=30, blank=True, verbose_name=_('Last transaction id'))
+    rows = models.IntegerField(default=0, verbose_name=_('Rows'))
+    finished = models.BooleanField(default=False, verbose_name=_('Finished'))
+    updated = models.DateTimeField(auto_now=True, verbose_name=_('Updated'))
+
+    def __str__(self):
+        return "%s at byte %d" % (self.file_hash, self.byte_offset)
+
+
+IMPORT_JOB_QUEUED = 'Q'
+IMPORT_JOB_RUNNING = 'R'
+IMPORT_JOB_DONE = 'D'
+IMPORT_JOB_FAILED = 'F'
+IMPORT_JOB_STATUS = ((IMPORT_JOB_QUEUED, _('Queued')),
+                     (IMPORT_JOB_RUNNING, _('Running')),
+                     (IMPORT_JOB_DONE, _('Done')),
+                     (IMPORT_JOB_FAILED, _('Failed')))
+IMPORT_JOB_FORMATS = (('op', 'Osuuspankki'),
+                      ('procountor', 'Procountor'))
+
+
+class ImportJob(models.Model):
+    """
+    Uploaded payment file waiting to be imported by the run_import_jobs command.
+    """
+    file = models.FileField(upload_to="payment_imports", storage=cache_storage, verbose_name=_('File'))
+    format = models.CharField(max_length=16, choices=IMPORT_JOB_FORMATS, verbose_name=_('File type'))
+    user = models.ForeignKey(User, null=True, verbose_name=_('User'), on_delete=models.SET_NULL)
+    status = models.CharField(max_length=1, choices=IMPORT_JOB_STATUS, default=IMPORT_JOB_QUEUED,
+                              db_index=True, verbose_name=_('Status'))
+    rows = models.IntegerField(default=0, verbose_name=_('Rows'))
+    # JSON encoded list of import messages
+    messages = models.TextField(default='[]', verbose_name=_('Messages'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
+    started = models.DateTimeField(null=True, verbose_name=_('Started'))
+    finished = models.DateTimeField(null=True, verbose_name=_('Finished'))
+    # Worker running the job and when it last reported progress
+    worker = models.CharField(max_length=255, blank=True, verbose_name=_('Worker'))
+    heartbeat = models.DateTimeField(null=True, verbose_name=_('Heartbeat'))
+
+    def __str__(self):
+        return "%s (%s)" % (self.file.name, self.get_status_display())
+
+    def is_finished(self):
+        return self.status in (IMPORT_JOB_DONE, IMPORT_JOB_FAILED)
+
+    def import_messages(self):
+        return json.loads(self.messages)
+
+
+OUTBOX_QUEUED = 'Q'
+OUTBOX_SENT = 'S'
+OUTBOX_FAILED = 'F'
+OUTBOX_STATUS = ((OUTBOX_QUEUED, _('Queued')),
+                 (OUTBOX_SENT, _('Sent')),
+                 (OUTBOX_FAILED, _('Failed')))
+
+
+class OutgoingEmail(models.Model):
+    """
+    Rendered email waiting to be sent by the dispatch_outbox command.
+
+    Bill PDF attachments are not stored, they are fetched through the
+    bill when the message is sent.
+    """
+    bill = models.ForeignKey('Bill', verbose_name=_('Bill'), null=True, on_delete=models.PROTECT)
+    subject = models.CharField(max_length=256, verbose_name=_('Subject'))
+    body = models.TextField(verbose_name=_('Body'))
+    from_email = models.CharField(max_length=256, verbose_name=_('From'))
+    # JSON encoded lists of addresses and dictionary of headers
+    to = models.TextField(verbose_name=_('To'))
+    bcc = models.TextField(default='[]', verbose_name=_('Bcc'))
+    headers = models.TextField(default='{}', verbose_name=_('Headers'))
+    attachment_name = models.CharField(max_length=128, blank=True, verbose_name=_('Attachment name'))
+
+    status = models.CharField(max_length=1, choices=OUTBOX_STATUS, default=OUTBOX_QUEUED,
+                              db_index=True, verbose_name=_('Status'))
+    attempts = models.IntegerField(default=0, verbose_name=_('Attempts'))
+    next_attempt = models.DateTimeField(default=datetime.now, verbose_name=_('Next attempt'))
+    last_error = models.TextField(blank=True, verbose_name=_('Last error'))
+    # Claimed by a dispatcher sending the message until this time
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name=_('Locked until'))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
+    sent = models.DateTimeField(null=True, verbose_name=_('Sent'))
+
+    def __str__(self):
+        return "%s (%s)" % (self.subject, self.get_status_display())
+
+    @classmethod
+    def enqueue(cls, email, bill=None, attachment_name=''):
+        """
+        Store EmailMessage `email` to the outbox.
+        :param bill: Bill whose PDF is attached when sending
+        :param attachment_name: file name of the attached PDF
+        """
+        return cls.objects.create(bill=bill,
+                                  subject=email.subject,
+                                  body=email.body,
+                                  from_email=email.from_email,
+                                  to=json.dumps(email.to),
+                                  bcc=json.dumps(email.bcc),
+                                  headers=json.dumps(email.extra_headers),
+                                  attachment_name=attachment_name)
+
+    def email_message(self, context=None):
+        """
+        Build the EmailMessage to send
+        :param context: BillRenderContext with the bill loaded
+        """
+        attachments = []
+        if self.attachment_name and self.bill:
+            attachments.append((self.attachment_name, self.bill.generate_pdf(context=context), "application/pdf"))
+        return EmailMessage(self.subject,
+                            self.body,
+                            self.from_email,
+                            json.loads(self.to),
+                            json.loads(self.bcc),
+                            attachments=attachments,
+                            headers=json.loads(self.headers))
+
+
+SEARCH_SEPARATOR = '|'
+# SQLite FTS5 trigram table over MembershipSearchIndex, see migration 0011
+SEARCH_FTS_TABLE = 'membership_search_fts'
+# Shortest substring matched with the trigram index
+SEARCH_TRIGRAM_LENGTH = 3
+
+
+# Database alias to whether the FTS5 table exists, cleared by migrate
+_fts_available = {}
+
+
+def _search_join(values):
+    """Lowercased values between separators, '|first|last|'"""
+    return SEARCH_SEPARATOR + SEARCH_SEPARATOR.join(
+        (value or '').replace(SEARCH_SEPARATOR, ' ').lower() for value in values) + SEARCH_SEPARATOR
+
+
+def search_index_values(person, organization):
+    """
+    Searched contact fields of a membership
+    :return: dictionary of MembershipSearchIndex fields
+    """
+    names = []
+    document = []
+    for contact, contact_names in [(person, ['first_name', 'last_name', 'given_names']),
+                                   (organization, ['organization_name'])]:
+        if contact is None:
+            continue
+        names.extend(getattr(contact, name) for name in contact_names)
+        document.extend(getattr(contact, name) for name in contact_names + ['email', 'phone', 'sms'])
+    return {'names': _search_join(names), 'document': _search_join(document)}
+
+
+class MembershipSearchIndex(models.Model):
+    """
+    Denormalized, lowercased search document of a membership, kept
+    current by the signals of Membership and Contact.
+
+    Searches are substring matches served by a trigram index: pg_trgm on
+    PostgreSQL, an FTS5 trigram table on SQLite.
+    """
+    membership = models.OneToOneField('Membership', primary_key=True, related_name='search_index',
+                                      on_delete=models.CASCADE)
+    # Person and organization names, emails and phone numbers
+    document = models.TextField()
+    # Person and organization names for "exact" queries
+    names = models.TextField()
+
+    @classmethod
+    def update_for(cls, membership):
+        cls.objects.update_or_create(
+            membership_id=membership.id,
+            defaults=search_index_values(membership.person, membership.organization))
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """
+        Index all memberships again, e.g. after bulk updates of contacts
+        :return: number of memberships indexed
+        """
+        _fts_available.clear()
+        count = 0
+        with transaction.atomic():
+            cls.objects.all().delete()
+            memberships = Membership.objects.select_related('person', 'organization').order_by('id')
+            batch = []
+            for membership in memberships.iterator(chunk_size=batch_size):
+                batch.append(cls(membership_id=membership.id,
+                                 **search_index_values(membership.person, membership.organization)))
+                if len(batch) >= batch_size:
+                    cls.objects.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            cls.objects.bulk_create(batch)
+            count += len(batch)
+        return count
+
+    @staticmethod
+    def _fts_available():
+        """
+        True if the FTS5 table exists, looked up once per database alias
+        """
+        if connection.vendor != 'sqlite':
+            return False
+        if connection.alias not in _fts_available:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [SEARCH_FTS_TABLE])
+                _fts_available[connection.alias] = cursor.fetchone() is not None
+        return _fts_available[connection.alias]
+
+    @classmethod
+    def matching(cls, words):
+        """
+        Index entries matching all words. A word in double quotes matches
+        a whole name, other words any part of a name, email or phone number.
+        """
+        qs = cls.objects.all()
+        use_fts = cls._fts_available()
+        fts_terms = []
+        for word in words:
+            if word.startswith('"') and word.endswith('"') and len(word) > 1:
+                field, text = 'names', _search_join([word[1:-1]])
+            else:
+                field, text = 'document', word.lower()
+            if not text:
+                continue
+            if use_fts and len(text) >= SEARCH_TRIGRAM_LENGTH:
+                fts_terms.append('%s : "%s"' % (field, text.replace('"', '""')))
+            else:
+                # Lowercased on both sides, so a plain LIKE can use the pg_trgm index
+                qs = qs.filter(**{field + '__contains': text})
+        if fts_terms:
+            qs = qs.extra(
+                where=["membership_id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)" % (
+                    SEARCH_FTS_TABLE, SEARCH_FTS_TABLE)],
+                params=[" AND ".join(fts_terms)])
+        return qs
+
+
+# Legal forms left out of organization name keys
+ORGANIZATION_LEGAL_FORMS = {'ry', 'oy', 'oyj', 'ab', 'ky', 'tmi', 'ay', 'ltd', 'inc', 'rf'}
+# Shorter phone numbers are not used as duplicate keys
+MIN_PHONE_DIGITS = 6
+
+
+def _normalize_name(value):
+    """Lowercased, accents stripped and whitespace collapsed"""
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return ' '.join(value.lower().split())
+
+
+def _normalize_phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    if digits.startswith('358'):
+        digits = '0' + digits[3:]
+    return digits
+
+
+def duplicate_keys(person, organization):
+    """
+    Blocking keys of a membership, memberships sharing a key are
+    possible duplicates
+    :return: set of keys
+    """
+    keys = set()
+    if person and not organization:
+        first_name = _normalize_name(person.first_name)
+        last_name = _normalize_name(person.last_name)
+        if first_name and last_name:
+            keys.add('name:%s|%s' % (first_name, last_name))
+        email = (person.email or '').strip().lower()
+        if email:
+            keys.add('email:%s' % email)
+        for number in [person.phone, person.sms]:
+            digits = _normalize_phone(number)
+            if len(digits) >= MIN_PHONE_DIGITS:
+                keys.add('phone:%s' % digits)
+    elif organization and not person:
+        tokens = set(re.findall(r'\w+', _normalize_name(organization.organization_name))) - ORGANIZATION_LEGAL_FORMS
+        if tokens:
+            keys.add('org:%s' % ' '.join(sorted(tokens)))
+    return keys
+
+
+class MembershipDuplicateKey(models.Model):
+    """
+    Normalized blocking keys of memberships for duplicate detection,
+    kept current by the signals of Membership and Contact.
+    """
+    membership = models.ForeignKey('Membership', related_name='duplicate_keys', on_delete=models.CASCADE)
+    key = models.CharField(max_length=320, db_index=True)
+
+    class Meta:
+        unique_together = ('membership', 'key')
+
+    @classmethod
+    def update_for(cls, membership):
+        keys = duplicate_keys(membership.person, membership.organization)
+        cls.objects.filter(membership_id=membership.id).exclude(key__in=keys).delete()
+        existing = set(cls.objects.filter(membership_id=membership.id).values_list('key', flat=True))
+        cls.objects.bulk_create([cls(membership_id=membership.id, key=key) for key in keys - existing])
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """
+        Compute the keys of all memberships again
+        :return: number of keys
+        """
+        _fts_available.clear()
+        count = 0
+        with transaction.atomic():
+            cls.objects.all().delete()
+            memberships = Membership.objects.select_related('person', 'organization').order_by('id')
+            batch = []
+            for membership in memberships.iterator(chunk_size=batch_size):
+                batch.extend(cls(membership_id=membership.id, key=key)
+                             for key in duplicate_keys(membership.person, membership.organization))
+                if len(batch) >= batch_size:
+                    cls.objects.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            cls.objects.bulk_create(batch)
+            count += len(batch)
+        return count
+
+    @classmethod
+    def duplicate_ids(cls, membership_ids):
+        """
+        Possible duplicates of memberships, with one query
+        :return: dictionary of membership id to sorted list of duplicate ids
+        """
+        membership_ids = set(membership_ids)
+        members_by_key = defaultdict(set)
+        shared = cls.objects.filter(key__in=cls.objects.filter(membership_id__in=membership_ids).values('key'))
+        for membership_id, key in shared.values_list('membership_id', 'key'):
+            members_by_key[key].add(membership_id)
+        duplicates = {membership_id: set() for membership_id in membership_ids}
+        for members in members_by_key.values():
+            for membership_id in members & membership_ids:
+                duplicates[membership_id] |= members
+        return {membership_id: sorted(ids - {membership_id}) for membership_id, ids in duplicates.items()}
+
+    @classmethod
+    def clusters(cls):
+        """
+        Groups of possible duplicates in the whole table, in one pass
+        over the shared keys
+        :return: list of sorted lists of membership ids
+        """
+        shared_keys = cls.objects.values('key').annotate(count=Count('id')).filter(count__gt=1).values('key')
+        parent = {}
+
+        def find(membership_id):
+            parent.setdefault(membership_id, membership_id)
+            while parent[membership_id] != membership_id:
+                parent[membership_id] = parent[parent[membership_id]]
+                membership_id = parent[membership_id]
+            return membership_id
+
+        first_of_key = {}
+        for membership_id, key in cls.objects.filter(key__in=shared_keys).values_list('membership_id', 'key'):
+            if key in first_of_key:
+                parent[find(membership_id)] = find(first_of_key[key])
+            else:
+                first_of_key[key] = membership_id
+                find(membership_id)
+        groups = defaultdict(list)
+        for membership_id in parent:
+            groups[find(membership_id)].append(membership_id)
+        return sorted(sorted(group) for group in groups.values())
+
+
 class ApplicationPoll(models.Model):
     """
     Store statistics taken from membership application "where did you
@@ -1065,6 +1569,47 @@ models.signals.post_save.connect(logging_log_change, sender=BillingCycle)
 models.signals.post_save.connect(logging_log_change, sender=Bill)
 models.signals.post_save.connect(logging_log_change, sender=Fee)
 models.signals.post_save.connect(logging_log_change, sender=Payment)
+models.signals.post_save.connect(logging_log_change, sender=OutgoingEmail)
+models.signals.post_save.connect(fee_schedule.invalidate, sender=Fee, dispatch_uid="fee_schedule_save")
+models.signals.post_delete.connect(fee_schedule.invalidate, sender=Fee, dispatch_uid="fee_schedule_delete")
+
+
+def _membership_saved(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not {'person', 'organization'} & set(update_fields):
+        return
+    MembershipSearchIndex.update_for(instance)
+    MembershipDuplicateKey.update_for(instance)
+
+
+def _contact_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    memberships = Membership.objects.filter(Q(person=instance) | Q(organization=instance))
+    for membership in memberships.select_related('person', 'organization'):
+        MembershipSearchIndex.update_for(membership)
+        MembershipDuplicateKey.update_for(membership)
+
+
+models.signals.post_save.connect(_membership_saved, sender=Membership, dispatch_uid="membership_search_index")
+models.signals.post_save.connect(_contact_saved, sender=Contact, dispatch_uid="contact_search_index")
+
+
+def _payment_deleted(sender, instance, **kwargs):
+    if instance.billingcycle_id:
+        BillingCycle.add_to_paid_total(instance.billingcycle_id, -instance.amount)
+
+
+models.signals.post_delete.connect(_payment_deleted, sender=Payment, dispatch_uid="payment_paid_total")
+
+
+def _migrated(sender, **kwargs):
+    # Migrations may have created or dropped the FTS5 table
+    _fts_available.clear()
+
+
+models.signals.post_migrate.connect(_migrated, dispatch_uid="membership_search_fts")
 
 # These are registered here due to import madness and general clarity
 send_as_email.connect(bill_sender, sender=Bill, dispatch_uid="email_bill")
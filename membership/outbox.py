@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sending of emails queued to the OutgoingEmail outbox.
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core import mail
+from django.db.models import Q
+
+from membership.billing.render_context import BillRenderContext
+from membership.models import OutgoingEmail, Payment, OUTBOX_QUEUED, OUTBOX_SENT, OUTBOX_FAILED
+
+logger = logging.getLogger("membership.outbox")
+
+
+def dispatch_outbox(batch_size=None, rate_limit=None, max_attempts=None, backoff=None,
+                    connection=None):
+    """
+    Send queued emails which are due over one email backend connection.
+
+    A failed message is retried later with exponential backoff and marked
+    failed after `max_attempts` attempts. Messages rescheduled during this
+    run are not retried before their next attempt time.
+
+    Each message is claimed before sending, so dispatchers running at the
+    same time don't send it twice. The connection is reopened after a
+    failed send.
+
+    :param batch_size: number of messages fetched from the database at once
+    :param rate_limit: maximum messages per second, 0 is unlimited
+    :param max_attempts: attempts before a message is marked failed
+    :param backoff: seconds before the first retry
+    :param connection: email backend connection, default is mail.get_connection()
+    :return: dictionary with counts of sent, retried and failed messages
+    """
+    if batch_size is None:
+        batch_size = settings.OUTBOX_BATCH_SIZE
+    if rate_limit is None:
+        rate_limit = settings.OUTBOX_RATE_LIMIT
+    if max_attempts is None:
+        max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+    if backoff is None:
+        backoff = settings.OUTBOX_RETRY_BACKOFF
+    if connection is None:
+        connection = mail.get_connection()
+    interval = 1.0 / rate_limit if rate_limit else 0
+
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    started = datetime.now()
+    last_id = 0
+    connection.open()
+    try:
+        while True:
+            batch = list(_due(started).filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+            context = BillRenderContext([message.bill_id for message in batch
+                                         if message.bill_id and message.attachment_name], payments=Payment)
+            for message in batch:
+                last_id = message.id
+                if not _claim(message, started):
+                    continue
+                before = time.monotonic()
+                if not _send(message, connection, max_attempts, backoff, counts, context):
+                    _reopen(connection)
+                elapsed = time.monotonic() - before
+                if elapsed < interval:
+                    time.sleep(interval - elapsed)
+    finally:
+        connection.close()
+    logger.info("Outbox dispatched: %(sent)d sent, %(retry)d to retry, %(failed)d failed." % counts)
+    return counts
+
+
+def _due(started):
+    unlocked = Q(locked_until=None) | Q(locked_until__lt=datetime.now())
+    return OutgoingEmail.objects.filter(unlocked, status=OUTBOX_QUEUED, next_attempt__lte=started)
+
+
+def _claim(message, started):
+    """Lock message for this dispatcher, False if another one got it first"""
+    locked_until = datetime.now() + timedelta(seconds=settings.OUTBOX_LOCK_SECONDS)
+    if not _due(started).filter(id=message.id).update(locked_until=locked_until):
+        return False
+    message.locked_until = locked_until
+    return True
+
+
+def _reopen(connection):
+    """Replace a connection a failed send may have left broken"""
+    try:
+        connection.close()
+        connection.open()
+    except Exception as e:
+        # The backend opens a connection itself on the next send
+        logger.warning("Reopening the email connection failed: %r" % (e,))
+
+
+def _send(message, connection, max_attempts, backoff, counts, context=None):
+    """
+    Send a claimed message and record the result
+    :return: True if sent
+    """
+    try:
+        sent = connection.send_messages([message.email_message(context=context)])
+        if not sent:
+            raise RuntimeError("Email backend did not send the message")
+    except Exception as e:
+        message.attempts += 1
+        message.last_error = repr(e)
+        if message.attempts >= max_attempts:
+            message.status = OUTBOX_FAILED
+            counts['failed'] += 1
+            logger.error("Outbox email %s failed after %d attempts: %r" % (repr(message), message.attempts, e))
+        else:
+            delay = backoff * 2 ** (message.attempts - 1)
+            message.next_attempt = datetime.now() + timedelta(seconds=delay)
+            counts['retry'] += 1
+            logger.warning("Outbox email %s failed, retrying in %d seconds: %r" % (repr(message), delay, e))
+    else:
+        message.attempts += 1
+        message.status = OUTBOX_SENT
+        message.sent = datetime.now()
+        counts['sent'] += 1
+        logger.info('Outbox email sent to %s: %s' % (",".join(json.loads(message.to)), str(message)))
+    message.locked_until = None
+    message.save()
+    return message.status == OUTBOX_SENT
@@ -0,0 +1,228 @@
+# encoding: utf-8
+
+"""
+Paginators of the list views.
+
+KeysetPaginator seeks to a page with the ordering values of the row
+before it instead of an OFFSET, so deep pages cost as much as the
+first one. The cursor of a page is the ordering values of its first or
+last row, encoded in the URL.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import Sequence
+from datetime import date, datetime, time
+from decimal import Decimal
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db.models import F, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+
+
+class ListingPaginator(Paginator):
+    """Paginator counting the rows without the annotations of for_listing()"""
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            return self.object_list.values('pk').count()
+        return super(ListingPaginator, self).count
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError("Cannot encode %r in a cursor" % (value,))
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_encode_value, separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(cursor)
+    return values
+
+
+def _seekable(model, name):
+    """
+    True if name is a path of not null fields with a single value per row,
+    rows with NULL can't be compared with the cursor values
+    """
+    parts = name.split(LOOKUP_SEP)
+    for i, part in enumerate(parts):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return False
+        if not field.concrete or field.null or field.many_to_many:
+            return False
+        if field.is_relation:
+            if i == len(parts) - 1:
+                # Ordered by the ordering of the related model
+                return False
+            model = field.related_model
+    return True
+
+
+def keyset_ordering(queryset):
+    """
+    Ordering of queryset as (field name, descending) pairs ending with
+    the primary key, None if it can't be paginated by keys
+    """
+    query = queryset.query
+    if query.order_by:
+        terms = query.order_by
+    elif query.default_ordering:
+        terms = queryset.model._meta.ordering
+    else:
+        terms = ()
+    if query.distinct or query.extra_order_by:
+        return None
+    pk_name = queryset.model._meta.pk.name
+    ordering = []
+    for term in terms:
+        if not isinstance(term, str) or term == '?':
+            return None
+        descending = term.startswith('-')
+        name = term.lstrip('-')
+        if name == 'pk':
+            name = pk_name
+        if not _seekable(queryset.model, name):
+            return None
+        ordering.append((name, descending))
+        if name == pk_name:
+            return ordering
+    ordering.append((pk_name, False))
+    return ordering
+
+
+class KeysetPage(Sequence):
+
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __repr__(self):
+        return '<Page after %s>' % (self.previous_cursor,)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def _cursor(self, obj):
+        return encode_cursor([getattr(obj, 'keyset_%d' % i) for i in range(len(self.paginator.ordering))])
+
+    @property
+    def previous_cursor(self):
+        """Cursor of the page before this, the values of the first row"""
+        return self._cursor(self.object_list[0]) if self.object_list else None
+
+    @property
+    def next_cursor(self):
+        """Cursor of the page after this, the values of the last row"""
+        return self._cursor(self.object_list[-1]) if self.object_list else None
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset by the values of its ordering and primary key.
+    Pages are addressed by cursors instead of numbers and the total count
+    is cached for KEYSET_COUNT_CACHE_SECONDS.
+    """
+    keyset = True
+
+    def __init__(self, queryset, per_page):
+        self.ordering = keyset_ordering(queryset)
+        if self.ordering is None:
+            raise ValueError("Queryset ordering does not allow keyset pagination")
+        self.queryset = queryset
+        self.per_page = int(per_page)
+
+    @staticmethod
+    def supports(queryset):
+        return isinstance(queryset, QuerySet) and keyset_ordering(queryset) is not None
+
+    @cached_property
+    def count(self):
+        rows = self.queryset.values('pk').order_by()
+        sql, params = rows.query.sql_with_params()
+        key = 'keyset-count-%s' % hashlib.md5(('%s %r' % (sql, params)).encode('utf-8')).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = rows.count()
+            cache.set(key, count, settings.KEYSET_COUNT_CACHE_SECONDS)
+        return count
+
+    def _order_by(self, reverse=False):
+        return ['%s%s' % ('-' if descending != reverse else '', name) for name, descending in self.ordering]
+
+    def _seek(self, values, reverse=False):
+        """Rows after values in the ordering, or before them if reverse"""
+        seek = Q()
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, values):
+            lookup = 'lt' if descending != reverse else 'gt'
+            seek |= equal & Q(**{'%s__%s' % (name, lookup): value})
+            equal &= Q(**{name: value})
+        # Bound on the first field alone lets the database use its index
+        name, descending = self.ordering[0]
+        bound = Q(**{'%s__%s' % (name, 'lte' if descending != reverse else 'gte'): values[0]})
+        return bound & seek
+
+    def page(self, after=None, before=None):
+        """
+        :param after: cursor of the previous page, first page if None
+        :param before: cursor of the next page, when going backwards
+        """
+        rows = self.queryset.annotate(**{'keyset_%d' % i: F(name) for i, (name, __) in enumerate(self.ordering)})
+        reverse = before is not None
+        cursor = before if reverse else after
+        if cursor is not None:
+            try:
+                rows = rows.filter(self._seek(decode_cursor(cursor, len(self.ordering)), reverse=reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise InvalidCursor(cursor)
+        try:
+            object_list = list(rows.order_by(*self._order_by(reverse))[:self.per_page + 1])
+        except (TypeError, ValueError, ValidationError):
+            raise InvalidCursor(cursor)
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if reverse:
+            object_list.reverse()
+            return KeysetPage(object_list, self, has_previous=more, has_next=True)
+        return KeysetPage(object_list, self, has_previous=cursor is not None, has_next=more)
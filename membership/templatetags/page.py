@@ -3,6 +3,8 @@
 from django import template
 from django.http import QueryDict
 
+from membership.pagination import KeysetPage
+
 register = template.Library()
 
 
@@ -24,6 +26,13 @@ class Page(template.Node):
         page_obj = context.get('page_obj')
         if page_obj is None:
             querystring['page'] = str(self.page)
+        elif isinstance(page_obj, KeysetPage):
+            for key in ['page', 'after', 'before']:
+                querystring.pop(key, None)
+            if self.page == 'previous':
+                querystring['before'] = page_obj.previous_cursor
+            elif self.page == 'next':
+                querystring['after'] = page_obj.next_cursor
         elif self.page == 'previous':
             querystring['page'] = str(page_obj.previous_page_number())
         elif self.page == 'next':
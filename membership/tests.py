@@ -5,14 +5,21 @@ import calendar
 from datetime import datetime, timedelta
 from decimal import Decimal
 
-from io import StringIO
+from io import BytesIO, StringIO
 
 import os
 import os.path
 import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import json
 
+from django.core.cache import cache
 from django.core.mail import EmailMessage
+from django_comments.models import Comment
 from django.core.management import call_command
 
 from membership import unpaid_members
@@ -20,26 +27,46 @@ from membership.billing.payments import process_payments, PaymentFromFutureExcep
 
 
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core import mail
+from django.core.mail.backends import locmem
 from django.core.exceptions import ValidationError
+from django.core.files.storage import FileSystemStorage
 from django.conf import settings
-from django.db.models import Q
-from django.test import TestCase
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.db.models.signals import pre_save
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.http import HttpResponse, HttpRequest
 from django.utils.translation import ugettext_lazy as _
 
 from membership import email_utils
-from membership.models import (Bill, BillingCycle, Contact, CancelledBill, Membership,
+from membership.models import (PDFCacheStats, MembershipSearchIndex, MembershipDuplicateKey, Bill, BillingCycle, Contact, CancelledBill, Membership,
                                MembershipOperationError, MembershipAlreadyStatus,
-                               Fee, Payment, PaymentAttachedError, MEMBER_STATUS)
+                               Fee, Payment, PaymentAttachedError, MEMBER_STATUS,
+                               OutgoingEmail, OUTBOX_QUEUED, OUTBOX_SENT, OUTBOX_FAILED,
+                               fee_schedule, PaymentImportCheckpoint, ImportJob, IMPORT_JOB_QUEUED,
+                               IMPORT_JOB_RUNNING, IMPORT_JOB_DONE, IMPORT_JOB_FAILED)
+from membership.billing.import_jobs import claim_next_job, run_job, run_queued_jobs, requeue_interrupted_jobs, \
+    Heartbeat
+from membership.outbox import dispatch_outbox
+from membership.billing.pdf_utils import ensure_bill_pdf, get_bill_pdf, pregenerate_bill_pdfs
+from membership.billing.pdf_cache import PDFCache, HIT_BATCH_SIZE, flush_cache_stats
+from membership.billing.render_context import BillRenderContext
+from membership.pagination import KeysetPaginator, encode_cursor, keyset_ordering
+from membership.billing.pdf_utils import create_reminder_pdf, render_reminder_shards, merge_pdfs
+from pypdf import PdfReader
 from membership.models import logger as models_logger
 from membership import reference_numbers
 from membership.utils import tupletuple_to_dict, log_change, group_iban, admtool_membership_details, group_reference
 from membership.forms import LoginField, PhoneNumberField, OrganizationRegistrationNumber
+from membership import test_utils
 from membership.test_utils import create_dummy_member, MockLoggingHandler
 from membership.decorators import trusted_host_required
 from sikteeri.iptools import IpRangeList
-from services.models import Service, ServiceType, Alias
+from services.models import Service, ServiceType, Alias, TakenAliasNames
 from membership.billing.procountor_csv import create_csv
 from procountor.procountor_api import ProcountorBankStatement, ProcountorBankStatementEvent, \
     ProcountorReferencePayment
@@ -55,8 +82,12 @@ from membership.management.commands.makebills import create_billingcycle
 from membership.management.commands.makebills import send_reminder
 from membership.management.commands.makebills import can_send_reminder
 from membership.management.commands.makebills import MembershipNotApproved
+from membership.management.commands.makebills import plan_makebills
+from membership.management.commands.makebills import create_billingcycles
+from membership.management.commands.recompute_paid_totals import recompute_paid_totals
 from membership.billing.payments import  process_op_csv, process_procountor_csv
 from membership.billing.payments import RequiredFieldNotFoundException
+from membership.billing.payments import process_payment_file, ProcountorDictReader, CheckpointMismatchException
 
 
 logger = logging.getLogger("membership.tests")
@@ -72,6 +103,24 @@ def open_test_data(file):
     return open(data_file, 'r', encoding='ISO-8859-1')
 
 
+# Bill pdfs and uploads are cached in a temporary directory during the tests
+CACHED_FILE_FIELDS = [Bill._meta.get_field('pdf_file'), ImportJob._meta.get_field('file')]
+_cache_storages = []
+
+
+def setUpModule():
+    storage = FileSystemStorage(location=tempfile.mkdtemp())
+    for field in CACHED_FILE_FIELDS:
+        _cache_storages.append(field.storage)
+        field.storage = storage
+
+
+def tearDownModule():
+    shutil.rmtree(CACHED_FILE_FIELDS[0].storage.location)
+    for field in CACHED_FILE_FIELDS:
+        field.storage = _cache_storages.pop(0)
+
+
 class ReferenceNumberTest(TestCase):
     def test_1234(self):
         self.assertEqual(generate_checknumber("1234"), 4)
@@ -981,6 +1030,395 @@ class CanSendReminderTest(TestCase):
         self.assertTrue(can_send, "Should be true with recent payment")
 
 
+class MakebillsPlannerTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        settings.ENABLE_REMINDERS = True
+
+    def tearDown(self):
+        settings.ENABLE_REMINDERS = False
+
+    def _create_members(self, count):
+        members = []
+        for i in range(count):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            members.append(membership)
+        return members
+
+    def _make_late(self, membership):
+        cycle = create_billingcycle(membership)
+        bill = cycle.last_bill()
+        bill.due_date = datetime.now() - timedelta(days=30)
+        bill.save()
+        return cycle
+
+    def test_plan(self):
+        new, late, paid = self._create_members(3)
+        late_cycle = self._make_late(late)
+        paid_cycle = self._make_late(paid)
+        paid_cycle.is_paid = True
+        paid_cycle.save()
+        Payment.objects.create(billingcycle=late_cycle, amount=1, payment_day=datetime.now(),
+                               transaction_id="test_plan_1")
+
+        plan = plan_makebills(Payment.latest_payment_date())
+        self.assertEqual([m.id for m in plan.new_cycles], [new.id])
+        self.assertEqual([m.id for m in plan.reminders], [late.id])
+
+    def test_query_count_does_not_grow(self):
+        for membership in self._create_members(2):
+            self._make_late(membership)
+        self._create_members(2)
+        latest_payment = datetime.now()
+        with self.assertNumQueries(2):
+            plan = plan_makebills(latest_payment)
+        self.assertEqual(len(plan.new_cycles), 2)
+        self.assertEqual(len(plan.reminders), 2)
+
+        for membership in self._create_members(8):
+            self._make_late(membership)
+        self._create_members(8)
+        with self.assertNumQueries(2):
+            plan = plan_makebills(latest_payment)
+        self.assertEqual(len(plan.new_cycles), 10)
+        self.assertEqual(len(plan.reminders), 10)
+
+
+class BatchMakebillsTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        for type in ['P', 'O', 'S', 'H', 'P']:
+            membership = create_dummy_member('N', type=type)
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        expired = Membership.objects.filter(type='P').first()
+        cycle = create_billingcycle(expired)
+        cycle.end = datetime.now() + timedelta(days=1)
+        cycle.save()
+        mail.outbox = []
+
+    def _cycle_rows(self):
+        return list(BillingCycle.objects.order_by('membership_id', 'start').values_list(
+            'membership_id', 'start', 'end', 'sum', 'is_paid', 'reference_number'))
+
+    def _bill_rows(self):
+        return list(Bill.objects.order_by('billingcycle__membership_id', 'billingcycle__start').values_list(
+            'billingcycle__membership_id', 'billingcycle__start', 'reminder_count', 'type'))
+
+    def test_same_rows_as_serial(self):
+        sid = transaction.savepoint()
+        makebills()
+        serial_cycles, serial_bills = self._cycle_rows(), self._bill_rows()
+        serial_mails = sorted(m.to[0] for m in mail.outbox)
+        transaction.savepoint_rollback(sid)
+        mail.outbox = []
+
+        handler = MockLoggingHandler()
+        models_logger.addHandler(handler)
+        makebills(batch=True, chunk_size=2)
+        models_logger.removeHandler(handler)
+
+        self.assertEqual(self._cycle_rows(), serial_cycles)
+        self.assertEqual(self._bill_rows(), serial_bills)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), serial_mails)
+        created = [info for info in handler.messages['info'] if " created: " in info]
+        self.assertEqual(len(created), 2 * 5)
+
+    def test_one_insert_per_chunk(self):
+        plan = plan_makebills(Payment.latest_payment_date())
+        with CaptureQueriesContext(connection) as queries:
+            create_billingcycles(plan.new_cycles, chunk_size=3)
+        inserts = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        cycle_inserts = [sql for sql in inserts if 'membership_billingcycle' in sql]
+        bill_inserts = [sql for sql in inserts if 'membership_bill"' in sql]
+        self.assertEqual(len(cycle_inserts), 2)
+        self.assertEqual(len(bill_inserts), 2)
+        self.assertEqual(BillingCycle.objects.count(), 6)
+
+
+class FeeScheduleTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+
+    def test_fee_at(self):
+        week_ago = datetime.now() - timedelta(days=7)
+        Fee.objects.create(type='P', start=week_ago, sum=42, vat_percentage=10)
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).sum, 42)
+        self.assertEqual(fee_schedule.fee_at('P', week_ago).sum, 42)
+        self.assertNotEqual(fee_schedule.fee_at('P', week_ago - timedelta(seconds=1)).sum, 42)
+        self.assertRaises(Fee.DoesNotExist, fee_schedule.fee_at, 'P', datetime(1900, 1, 1))
+        self.assertRaises(Fee.DoesNotExist, fee_schedule.fee_at, 'X', datetime.now())
+
+    def test_invalidation(self):
+        fee = Fee.objects.create(type='P', start=datetime.now() - timedelta(days=1), sum=42,
+                                 vat_percentage=10)
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).vat_percentage, 10)
+        fee.vat_percentage = 24
+        fee.save()
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).vat_percentage, 24)
+        fee.delete()
+        self.assertNotEqual(fee_schedule.fee_at('P', datetime.now()).sum, 42)
+
+    def test_changes_by_other_processes_expire(self):
+        fee = Fee.objects.create(type='P', start=datetime.now() - timedelta(days=1), sum=42,
+                                 vat_percentage=10)
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).sum, 42)
+        # No signal, as if saved by another process
+        Fee.objects.filter(id=fee.id).update(sum=43)
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).sum, 42)
+        fee_schedule._loaded -= settings.FEE_SCHEDULE_CACHE_SECONDS + 1
+        self.assertEqual(fee_schedule.fee_at('P', datetime.now()).sum, 43)
+
+    def test_no_fee_queries_per_bill(self):
+        for i in range(5):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        makebills()
+        fee_schedule.fee_at('P', datetime.now())
+        with CaptureQueriesContext(connection) as queries:
+            create_csv(mark_cancelled=False)
+        fee_queries = [q for q in queries.captured_queries if 'membership_fee' in q['sql']]
+        self.assertEqual(len(fee_queries), 0)
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError("Relay not available")
+
+
+class DroppingEmailBackend(locmem.EmailBackend):
+    """Loses the connection on the first send until reopened"""
+    def __init__(self, *args, **kwargs):
+        super(DroppingEmailBackend, self).__init__(*args, **kwargs)
+        self.dropped = False
+        self.failures = 0
+
+    def open(self):
+        if self.dropped:
+            self.dropped = False
+        return True
+
+    def send_messages(self, messages):
+        if self.dropped or not self.failures:
+            self.failures += 1
+            self.dropped = True
+            raise ConnectionError("Connection lost")
+        return super(DroppingEmailBackend, self).send_messages(messages)
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class FailingOnceEmailBackend(locmem.EmailBackend):
+    """Fails to send the message with subject fail once"""
+    failed = False
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.subject == 'fail' and not FailingOnceEmailBackend.failed:
+                FailingOnceEmailBackend.failed = True
+                raise ConnectionError("Connection lost")
+        return super(FailingOnceEmailBackend, self).send_messages(messages)
+
+
+class BulkDeliveryTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        for i in range(5):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        mail.outbox = []
+        CountingEmailBackend.opened = 0
+
+    def test_makebills_batches(self):
+        with self.settings(EMAIL_BACKEND='membership.tests.CountingEmailBackend'):
+            makebills(email_batch_size=2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened, 3)
+
+    def test_send_email_outside_bulk_delivery(self):
+        email_utils.send_email(EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com']))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_remaining_sent_on_exit(self):
+        with email_utils.bulk_delivery(batch_size=10) as mailer:
+            for i in range(3):
+                email_utils.send_email(EmailMessage('Subject %d' % i, 'Body', 'from@example.com',
+                                                    ['to@example.com']))
+            self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual((mailer.sent, mailer.batches), (3, 1))
+
+    def test_mbox_backend_batch(self):
+        import mailbox
+        path = os.path.join(tempfile.mkdtemp(), 'test.mbox')
+        try:
+            with self.settings(EMAIL_BACKEND='sikteeri.mboxemailbackend.EmailBackend',
+                               EMAIL_MBOX_FILE_PATH=path):
+                connection = mail.get_connection()
+                self.assertFalse(os.path.exists(path))
+                with email_utils.bulk_delivery(batch_size=2, connection=connection):
+                    for i in range(3):
+                        email_utils.send_email(EmailMessage('Subject %d' % i, 'Body', 'from@example.com',
+                                                            ['to@example.com']))
+                self.assertIsNone(connection.stream)
+                email_utils.send_email(EmailMessage('Single', 'Body', 'from@example.com', ['to@example.com']))
+            subjects = [message['Subject'] for message in mailbox.mbox(path)]
+            self.assertEqual(subjects, ['Subject 0', 'Subject 1', 'Subject 2', 'Single'])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_failed_messages_kept(self):
+        FailingOnceEmailBackend.failed = False
+        handler = MockLoggingHandler()
+        email_utils.logger.addHandler(handler)
+        try:
+            mailer = email_utils.BulkMailer(batch_size=10, connection=FailingOnceEmailBackend())
+            for subject in ('first', 'fail', 'last'):
+                mailer.add(EmailMessage(subject, 'Body', 'from@example.com', ['to@example.com']),
+                           log_message='Sent %s' % subject)
+            with self.assertRaises(ConnectionError):
+                mailer.flush()
+            self.assertEqual([m.subject for m in mail.outbox], ['first'])
+            self.assertEqual([m.subject for m, log_message in mailer.messages], ['fail', 'last'])
+            self.assertEqual(handler.messages['info'], ['Sent first'])
+
+            self.assertEqual(mailer.flush(), 2)
+            self.assertEqual([m.subject for m in mail.outbox], ['first', 'fail', 'last'])
+            self.assertEqual(mailer.sent, 3)
+            self.assertIn('Sent last', handler.messages['info'])
+        finally:
+            email_utils.logger.removeHandler(handler)
+
+    def test_sent_on_error(self):
+        failing = Membership.objects.order_by('id').last()
+
+        def fail(sender, instance, **kwargs):
+            if instance.membership_id == failing.id:
+                raise RuntimeError("makebills failed")
+
+        pre_save.connect(fail, sender=BillingCycle)
+        try:
+            with self.assertRaises(RuntimeError):
+                makebills(email_batch_size=10)
+        finally:
+            pre_save.disconnect(fail, sender=BillingCycle)
+        # Bills committed before the failure are sent
+        self.assertEqual(Bill.objects.count(), 4)
+        self.assertEqual(len(mail.outbox), 4)
+
+
+class OutboxTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        settings.BILL_EMAIL_OUTBOX = True
+        settings.BILLING_CC_EMAIL = "cc@example.com"
+        for i in range(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+        mail.outbox = []
+
+    def tearDown(self):
+        settings.BILL_EMAIL_OUTBOX = False
+        settings.BILLING_CC_EMAIL = None
+
+    def test_makebills_only_enqueues(self):
+        makebills()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OUTBOX_QUEUED).count(), 3)
+
+    def test_dispatch(self):
+        makebills()
+        counts = dispatch_outbox(batch_size=2)
+        self.assertEqual(counts, {'sent': 3, 'retry': 0, 'failed': 0})
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OUTBOX_SENT).count(), 3)
+
+        bill = Bill.objects.order_by('id')[0]
+        message = [m for m in mail.outbox if m.subject == bill.bill_subject()][0]
+        self.assertEqual(message.to, [bill.billingcycle.membership.billing_email()])
+        self.assertEqual(message.bcc, ["cc@example.com"])
+        self.assertEqual(message.extra_headers['CC'], "cc@example.com")
+        self.assertEqual(message.body, bill.render_as_text())
+        self.assertEqual(message.attachments[0][0],
+                         "kapsi_jasenlasku_%s.pdf" % bill.billingcycle.reference_number)
+        self.assertTrue(message.attachments[0][1].startswith(b'%PDF'))
+
+        # Nothing left to send
+        self.assertEqual(dispatch_outbox(), {'sent': 0, 'retry': 0, 'failed': 0})
+
+    def test_retry_and_fail(self):
+        makebills()
+        connection = FailingEmailBackend()
+        counts = dispatch_outbox(max_attempts=2, backoff=0, connection=connection)
+        self.assertEqual(counts, {'sent': 0, 'retry': 3, 'failed': 0})
+        counts = dispatch_outbox(max_attempts=2, backoff=0, connection=connection)
+        self.assertEqual(counts, {'sent': 0, 'retry': 0, 'failed': 3})
+        for message in OutgoingEmail.objects.all():
+            self.assertEqual(message.status, OUTBOX_FAILED)
+            self.assertEqual(message.attempts, 2)
+            self.assertIn("Relay not available", message.last_error)
+
+    def test_reopen_after_failure(self):
+        makebills()
+        counts = dispatch_outbox(backoff=3600, connection=DroppingEmailBackend())
+        self.assertEqual(counts, {'sent': 2, 'retry': 1, 'failed': 0})
+
+    def test_claimed_messages_skipped(self):
+        makebills()
+        claimed = OutgoingEmail.objects.order_by('id')[0]
+        OutgoingEmail.objects.filter(id=claimed.id).update(locked_until=datetime.now() + timedelta(minutes=5))
+        self.assertEqual(dispatch_outbox()['sent'], 2)
+        self.assertEqual(OutgoingEmail.objects.get(id=claimed.id).status, OUTBOX_QUEUED)
+        # Lock of a crashed dispatcher expires
+        OutgoingEmail.objects.filter(id=claimed.id).update(locked_until=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(dispatch_outbox()['sent'], 1)
+        self.assertIsNone(OutgoingEmail.objects.get(id=claimed.id).locked_until)
+
+    def test_concurrent_dispatchers(self):
+        makebills()
+
+        class ConcurrentEmailBackend(locmem.EmailBackend):
+            def send_messages(self, messages):
+                # Another dispatcher starts while the first message is sent
+                if not mail.outbox:
+                    dispatch_outbox(connection=locmem.EmailBackend())
+                return super(ConcurrentEmailBackend, self).send_messages(messages)
+
+        counts = dispatch_outbox(batch_size=10, connection=ConcurrentEmailBackend())
+        self.assertEqual(counts['sent'], 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OUTBOX_SENT).count(), 3)
+
+    def test_backoff(self):
+        makebills()
+        dispatch_outbox(backoff=3600, connection=FailingEmailBackend())
+        # Retries are not due yet
+        self.assertEqual(dispatch_outbox(), {'sent': 0, 'retry': 0, 'failed': 0})
+        OutgoingEmail.objects.update(next_attempt=datetime.now())
+        self.assertEqual(dispatch_outbox()['sent'], 3)
+
+
 class CSVNoMembersTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -1053,6 +1491,670 @@ class CSVReadingTest(TestCase):
             process_op_csv(f)  # Valid csv should not raise header error
 
 
+class BatchPaymentImportTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.cycles = []
+        for i in range(4):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            self.cycles.append(create_billingcycle(membership))
+
+    def _row(self, transaction, reference, amount):
+        return {'transaction': transaction, 'reference': reference, 'amount': Decimal(amount),
+                'date': datetime.now(), 'event_type_description': 'Viitesiirto',
+                'fromto': 'Payer', 'message': ''}
+
+    def test_rules(self):
+        first, second = self.cycles[:2]
+        rows = [
+            self._row('T1', first.reference_number, first.sum / 2),
+            self._row('T2', first.reference_number, first.sum / 2),
+            self._row('T3', first.reference_number, first.sum),  # Duplicate
+            self._row('T1', first.reference_number, first.sum / 2),  # Same transaction again
+            self._row('T4', '12345', 10),  # Unknown reference
+            self._row('T4', '12345', 10),
+            self._row('T5', second.reference_number, second.sum),
+        ]
+        messages = process_payments(rows, user=self.user, chunk_size=3)
+
+        self.assertTrue(BillingCycle.objects.get(id=first.id).is_paid)
+        self.assertTrue(BillingCycle.objects.get(id=second.id).is_paid)
+        self.assertEqual(first.payment_set.count(), 2)
+        duplicate = Payment.objects.get(transaction_id='T3')
+        self.assertTrue(duplicate.duplicate)
+        self.assertIsNone(duplicate.billingcycle)
+        unknown = Payment.objects.get(transaction_id='T4')
+        self.assertIsNone(unknown.billingcycle)
+        self.assertEqual(Payment.objects.count(), 5)
+
+        self.assertEqual(len(messages), 6)
+        self.assertEqual([m for m in messages if m[1] is not None][0][1], unknown.id)
+        self.assertIn("Unidentified payments: 2 (", messages[-1][2])
+        self.assertEqual(duplicate.logs.count(), 1)
+        self.assertEqual(BillingCycle.objects.get(id=first.id).logs.filter(
+            change_message="Marked as paid").count(), 2)
+
+    def test_query_count_per_chunk(self):
+        def rows(prefix):
+            return [self._row('%s%d' % (prefix, i), cycle.reference_number, cycle.sum)
+                    for i, cycle in enumerate(self.cycles)]
+        # Fill content type cache used by log entries
+        ContentType.objects.get_for_models(Payment, BillingCycle)
+        with CaptureQueriesContext(connection) as small:
+            process_payments(rows('A')[:2], user=self.user)
+        Payment.objects.all().delete()
+        BillingCycle.objects.update(is_paid=False)
+        with CaptureQueriesContext(connection) as large:
+            process_payments(rows('B'), user=self.user)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertEqual(BillingCycle.objects.filter(is_paid=True).count(), 4)
+
+
+class KeysetPaginationTest(TestCase):
+    fixtures = ['test_user.json']
+
+    def setUp(self):
+        cache.clear()
+        for i in range(8):
+            # Pairs of payments on the same day
+            Payment.objects.create(transaction_id='K%d' % i, amount=Decimal('10.00'),
+                                   payment_day=datetime(2015, 1, 1 + i // 2, 12, 0, 0, 123456),
+                                   type='Viitesiirto', payer_name='Payer %d' % (i % 3))
+        self.payments = Payment.objects.order_by('-payment_day', '-id')
+        self.client.login(username='admin', password='dhtn')
+
+    def test_ordering(self):
+        self.assertEqual(keyset_ordering(self.payments), [('payment_day', True), ('id', True)])
+        self.assertEqual(keyset_ordering(Payment.objects.order_by('payer_name')),
+                         [('payer_name', False), ('id', False)])
+        self.assertIsNone(keyset_ordering(Payment.objects.order_by('billingcycle')))
+        self.assertIsNone(keyset_ordering(Membership.objects.order_by('person__last_name')))
+
+    def test_forward_and_back(self):
+        for queryset in [self.payments, Payment.objects.order_by('payer_name')]:
+            paginator = KeysetPaginator(queryset, 3)
+            pages = [paginator.page()]
+            while pages[-1].has_next():
+                pages.append(paginator.page(after=pages[-1].next_cursor))
+            self.assertEqual([len(page) for page in pages], [3, 3, 2])
+            self.assertEqual([p for page in pages for p in page], list(queryset))
+            self.assertFalse(pages[0].has_previous())
+            back = paginator.page(before=pages[2].previous_cursor)
+            self.assertEqual(list(back), pages[1].object_list)
+            back = paginator.page(before=back.previous_cursor)
+            self.assertEqual(list(back), pages[0].object_list)
+            self.assertFalse(back.has_previous())
+        self.assertEqual(paginator.count, 8)
+        with self.assertNumQueries(0):
+            KeysetPaginator(Payment.objects.order_by('payer_name'), 3).count
+
+    def test_list_view(self):
+        response = self.client.get('/membership/payments/')
+        self.assertEqual(response.status_code, 200)
+        page = response.context['page_obj']
+        self.assertEqual(list(page), list(self.payments[:settings.ENTRIES_PER_PAGE]))
+        if page.has_next():
+            self.assertContains(response, '?after=%s' % page.next_cursor)
+        response = self.client.get('/membership/payments/?after=%s' % page.previous_cursor)
+        self.assertEqual(list(response.context['page_obj']), list(self.payments[1:settings.ENTRIES_PER_PAGE + 1]))
+        self.assertContains(response, '?before=%s' % response.context['page_obj'].previous_cursor)
+        self.assertEqual(self.client.get('/membership/payments/?after=garbage').status_code, 404)
+        self.assertEqual(self.client.get('/membership/payments/?after=%s' % encode_cursor(['x', 1])).status_code,
+                         404)
+        # Nullable ordering falls back to page numbers
+        response = self.client.get('/membership/payments/?sort=billingcycle:1')
+        self.assertEqual(response.context['page_obj'].number, 1)
+
+
+class PaidTotalTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        self.cycle = create_billingcycle(membership)
+
+    def _payment(self, transaction_id, amount):
+        return Payment.objects.create(transaction_id=transaction_id, amount=Decimal(amount),
+                                      payment_day=datetime.now(), type='Viitesiirto', payer_name='Payer',
+                                      reference_number=self.cycle.reference_number)
+
+    def _paid_total(self):
+        return BillingCycle.objects.get(id=self.cycle.id).paid_total
+
+    def test_attach_detach_edit_delete(self):
+        first = self._payment('T1', '10.00')
+        second = self._payment('T2', '5.50')
+        stale = BillingCycle.objects.get(id=self.cycle.id)
+
+        first.attach_to_cycle(self.cycle)
+        second.attach_to_cycle(self.cycle)
+        self.assertEqual(self.cycle.amount_paid(), Decimal('15.50'))
+        self.assertEqual(self._paid_total(), Decimal('15.50'))
+
+        second = Payment.objects.get(id=second.id)
+        second.amount = Decimal('6.00')
+        second.save()
+        self.assertEqual(self._paid_total(), Decimal('16.00'))
+
+        # Saving an outdated instance does not overwrite the total
+        stale.save()
+        self.assertEqual(self._paid_total(), Decimal('16.00'))
+
+        second.detach_from_cycle()
+        self.assertEqual(self._paid_total(), Decimal('10.00'))
+
+        Payment.objects.filter(id=first.id).delete()
+        self.assertEqual(self._paid_total(), Decimal('0.00'))
+
+    def test_deferred_fields(self):
+        payment = self._payment('T1', '10.00')
+        payment.attach_to_cycle(self.cycle)
+
+        payment = Payment.objects.only('id', 'ignore').get(id=payment.id)
+        payment.ignore = True
+        payment.save()
+        self.assertEqual(self._paid_total(), Decimal('10.00'))
+
+        payment = Payment.objects.only('id', 'ignore').get(id=payment.id)
+        payment.amount = Decimal('12.00')
+        payment.save()
+        self.assertEqual(self._paid_total(), Decimal('12.00'))
+
+        payment = Payment.objects.defer('amount').get(id=payment.id)
+        payment.billingcycle = None
+        payment.save()
+        self.assertEqual(self._paid_total(), Decimal('0.00'))
+
+    def test_batch_import(self):
+        row = {'reference': self.cycle.reference_number, 'amount': Decimal('7.00'), 'date': datetime.now(),
+               'event_type_description': 'Viitesiirto', 'fromto': 'Payer', 'message': ''}
+        process_payments([dict(row, transaction='T1'), dict(row, transaction='T2')], chunk_size=1)
+        self.assertEqual(self._paid_total(), Decimal('14.00'))
+
+    def test_recompute(self):
+        self._payment('T1', '10.00').attach_to_cycle(self.cycle)
+        self.assertEqual(recompute_paid_totals(), [])
+
+        BillingCycle.objects.filter(id=self.cycle.id).update(paid_total=Decimal('3.00'))
+        drifted = recompute_paid_totals(repair=False)
+        self.assertEqual([c.id for c in drifted], [self.cycle.id])
+        self.assertEqual(self._paid_total(), Decimal('3.00'))
+
+        recompute_paid_totals()
+        self.assertEqual(self._paid_total(), Decimal('10.00'))
+        self.assertEqual(recompute_paid_totals(repair=False), [])
+
+
+class BillRenderContextTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.bills = []
+        for i in range(3):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            cycle = create_billingcycle(membership)
+            self.bills.append(Bill.objects.create(billingcycle=cycle, type='E', reminder_count=1))
+            self.bills.append(cycle.first_bill())
+        Payment.objects.create(billingcycle=cycle, transaction_id='T1', amount=Decimal('5.00'),
+                               payment_day=datetime(2015, 1, 2), type='Viitesiirto', payer_name='Payer')
+
+    def test_same_output_as_single_bill(self):
+        context = BillRenderContext(self.bills, payments=Payment)
+        for bill in self.bills:
+            bill = Bill.objects.get(id=bill.id)
+            self.assertEqual(bill.render_as_text(context=context), bill.render_as_text())
+            self.assertEqual(context.pdf_data(bill.billingcycle, bill=bill, reminder=bill.is_reminder()),
+                             BillRenderContext(payments=Payment).pdf_data(bill.billingcycle, bill=bill,
+                                                                          reminder=bill.is_reminder()))
+
+    def test_no_queries_per_bill(self):
+        with CaptureQueriesContext(connection) as queries:
+            context = BillRenderContext(self.bills, payments=Payment)
+            cycle_context = BillRenderContext(cycles=[bill.billingcycle_id for bill in self.bills[::2]],
+                                              payments=Payment)
+            context.latest_payment_date()
+            cycle_context.latest_payment_date()
+        # Bills, cycles and their bills, latest payment date twice
+        self.assertEqual(len(queries), 5)
+        first_bills = [cycle.first_bill().id for cycle in cycle_context.cycles]
+        with CaptureQueriesContext(connection) as queries:
+            for bill in context.bills:
+                context.text_context(bill)
+                context.pdf_data(bill.billingcycle, bill=bill, reminder=bill.is_reminder())
+            bill_ids = [cycle_context.pdf_data(cycle, reminder=True)['bill_id'] for cycle in cycle_context.cycles]
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(bill_ids, first_bills)
+
+
+class BillListQueryTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(id=1)
+        self.client.login(username='admin', password='dhtn')
+
+    def _add_cycles(self, count):
+        for i in range(count):
+            membership = create_dummy_member('N')
+            membership.preapprove(self.user)
+            membership.approve(self.user)
+            cycle = create_billingcycle(membership)
+            cycle.bill_set.update(due_date=datetime.now() - timedelta(days=20))
+            Bill.objects.create(billingcycle=cycle, type='E', reminder_count=1,
+                                due_date=datetime.now() - timedelta(days=1))
+            Payment.objects.create(billingcycle=cycle, transaction_id='T%d' % cycle.id, amount=Decimal('5.00'),
+                                   payment_day=datetime(2015, 1, 2), type='Viitesiirto', payer_name='Payer')
+
+    def _page_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_annotations(self):
+        self._add_cycles(1)
+        cycle = BillingCycle.objects.for_listing().get()
+        last_bill = cycle.last_bill()
+        self.assertEqual(cycle.last_bill_id, last_bill.id)
+        self.assertEqual(cycle.last_bill_due_date, last_bill.due_date)
+        self.assertEqual(cycle.last_bill_reminder_count, 1)
+        self.assertEqual(cycle.first_bill_due_date, cycle.first_bill().due_date)
+        self.assertTrue(cycle.is_last_bill_late())
+        self.assertTrue(cycle.is_first_bill_late())
+        with self.assertNumQueries(0):
+            cycle.is_last_bill_late()
+            cycle.is_first_bill_late()
+
+    def test_queries_per_page(self):
+        for url in ['/membership/bills/', '/membership/bills/unpaid/']:
+            self._add_cycles(1)
+            one_cycle = self._page_queries(url)
+            self._add_cycles(4)
+            self.assertEqual(self._page_queries(url), one_cycle)
+
+
+class BillPdfCacheTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.field = Bill._meta.get_field('pdf_file')
+        self.storage = self.field.storage
+        self.field.storage = FileSystemStorage(location=self.cache_dir)
+        self.user = User.objects.get(id=1)
+        membership = create_dummy_member('N')
+        membership.preapprove(self.user)
+        membership.approve(self.user)
+        self.cycle = create_billingcycle(membership)
+        self.bill = Bill.objects.create(billingcycle=self.cycle, type='E')
+
+    def tearDown(self):
+        self.field.storage = self.storage
+        shutil.rmtree(self.cache_dir)
+
+    def _bill(self):
+        return Bill.objects.get(id=self.bill.id)
+
+    def test_cached(self):
+        content = get_bill_pdf(self._bill(), payments=Payment)
+        self.assertTrue(content.startswith(b'%PDF'))
+        name = self._bill().pdf_file.name
+        self.assertTrue(name.startswith('bill_pdfs/'))
+        self.assertFalse(ensure_bill_pdf(self._bill(), payments=Payment))
+        self.assertEqual(get_bill_pdf(self._bill(), payments=Payment), content)
+
+    def test_outdated_when_inputs_change(self):
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        name = self._bill().pdf_file.name
+
+        contact = self.cycle.membership.get_billing_contact()
+        contact.street_address = 'Uusi katu 1'
+        contact.save()
+        self.assertTrue(ensure_bill_pdf(self._bill(), payments=Payment))
+        self.assertNotEqual(self._bill().pdf_file.name, name)
+
+        # A reminder changes with the amount paid
+        reminder = Bill.objects.create(billingcycle=self.cycle, type='E', reminder_count=1)
+        self.assertTrue(ensure_bill_pdf(reminder, payments=Payment))
+        Payment.objects.create(billingcycle=self.cycle, transaction_id='T1', amount=Decimal('5.00'),
+                               payment_day=datetime.now(), type='Viitesiirto', payer_name='Payer')
+        reminder = Bill.objects.get(id=reminder.id)
+        self.assertTrue(ensure_bill_pdf(reminder, payments=Payment))
+
+    def _empty_cache(self):
+        # Sending the billing cycle already rendered its first bill
+        PDFCache(self.field.storage).evict(max_bytes=0)
+        flush_cache_stats()
+        PDFCacheStats.reset()
+
+    def test_sharded_names_and_stats(self):
+        self._empty_cache()
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        name = self._bill().pdf_file.name
+        self.assertTrue(name.startswith('bill_pdfs/0/%d-' % self.bill.id))
+        # Hits are written in batches
+        self.assertEqual(PDFCacheStats.current().hits, 0)
+        flush_cache_stats()
+        stats = PDFCacheStats.current()
+        self.assertEqual((stats.hits, stats.misses), (1, 1))
+        self.assertEqual(stats.hit_rate(), 0.5)
+
+        # Outdated version is removed
+        contact = self.cycle.membership.get_billing_contact()
+        contact.street_address = 'Uusi katu 1'
+        contact.save()
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        self.assertFalse(self.field.storage.exists(name))
+        self.assertEqual(PDFCache(self.field.storage).usage()[0], 1)
+
+    def test_hits_written_in_batches(self):
+        self._empty_cache()
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(HIT_BATCH_SIZE):
+                ensure_bill_pdf(self._bill(), payments=Payment)
+        stats_updates = [q['sql'] for q in queries.captured_queries
+                         if 'membership_pdfcachestats' in q['sql']]
+        self.assertEqual(len(stats_updates), 1)
+        self.assertEqual(PDFCacheStats.current().hits, HIT_BATCH_SIZE)
+
+    def test_eviction(self):
+        self._empty_cache()
+        bills = [self.bill] + [Bill.objects.create(billingcycle=self.cycle, type='E') for i in range(2)]
+        now = datetime.now()
+        for i, bill in enumerate(bills):
+            ensure_bill_pdf(bill, payments=Payment)
+            # Oldest use first
+            used = (now - timedelta(days=10 - i)).timestamp()
+            os.utime(self.field.storage.path(Bill.objects.get(id=bill.id).pdf_file.name), (used, used))
+        cache = PDFCache(self.field.storage)
+        count, used = cache.usage()
+        self.assertEqual(count, 3)
+
+        self.assertEqual(cache.evict(max_bytes=used, max_age=timedelta(days=30)), (0, 0))
+        first_size = self.field.storage.size(Bill.objects.get(id=bills[0].id).pdf_file.name)
+        self.assertEqual(cache.evict(max_bytes=used - 1, max_age=timedelta(days=30)), (1, first_size))
+        self.assertEqual(cache.evict(max_bytes=used, max_age=timedelta(days=8, hours=12), now=now)[0], 1)
+        self.assertEqual(cache.usage()[0], 1)
+        self.assertEqual(PDFCacheStats.current().evictions, 2)
+
+        # Evicted pdfs are rendered again
+        self.assertTrue(ensure_bill_pdf(Bill.objects.get(id=bills[0].id), payments=Payment))
+        self.assertFalse(ensure_bill_pdf(Bill.objects.get(id=bills[2].id), payments=Payment))
+
+    def test_missing_file_rendered(self):
+        ensure_bill_pdf(self._bill(), payments=Payment)
+        self.field.storage.delete(self._bill().pdf_file.name)
+        self.assertTrue(ensure_bill_pdf(self._bill(), payments=Payment))
+
+    def test_view_streams_cached_file(self):
+        self.assertTrue(self.client.login(username='admin', password='dhtn'))
+        url = reverse('bill_pdf', args=[self.bill.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'%PDF'))
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF')
+        self.assertEqual(response['Content-Range'], 'bytes 0-3/%d' % len(content))
+        self.assertEqual(response['Content-Length'], '4')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), content[-10:])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=%d-' % (len(content) + 1))
+        self.assertEqual(response.status_code, 416)
+
+    def test_pregenerate(self):
+        other = Bill.objects.create(billingcycle=self.cycle, type='E')
+        self.assertEqual(pregenerate_bill_pdfs([self.bill.id, other.id]), 2)
+        self.assertEqual(pregenerate_bill_pdfs([self.bill.id, other.id]), 0)
+
+
+class ReminderPdfTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        user = User.objects.get(id=1)
+        self.cycles = []
+        for i in range(5):
+            membership = create_dummy_member('N')
+            membership.preapprove(user)
+            membership.approve(user)
+            self.cycles.append(create_billingcycle(membership))
+
+    def _reference_numbers(self, content):
+        pages = PdfReader(BytesIO(content)).pages
+        return [[c.reference_number for c in self.cycles if group_reference(c.reference_number) in page.extract_text()]
+                for page in pages]
+
+    def test_merged_pages_in_order(self):
+        serial = BytesIO()
+        create_reminder_pdf(self.cycles, serial, payments=Payment)
+        ids = [c.id for c in self.cycles]
+        merged = BytesIO()
+        merge_pdfs(render_reminder_shards([ids[:2], ids[2:4], ids[4:]]), merged)
+
+        expected = [[c.reference_number] for c in self.cycles]
+        self.assertEqual(self._reference_numbers(serial.getvalue()), expected)
+        self.assertEqual(self._reference_numbers(merged.getvalue()), expected)
+
+    def test_reminders_file(self):
+        settings.ENABLE_REMINDERS = True
+        try:
+            pdf_file = BillingCycle.get_pdf_reminders_file(memberid=self.cycles[0].membership.id)
+        finally:
+            settings.ENABLE_REMINDERS = False
+        with pdf_file:
+            self.assertEqual(len(PdfReader(pdf_file).pages), 1)
+
+    def test_static_layout_shared_by_pages(self):
+        output = BytesIO()
+        create_reminder_pdf(self.cycles, output, payments=Payment)
+        pages = PdfReader(BytesIO(output.getvalue())).pages
+        forms = set()
+        for page in pages:
+            xobjects = page['/Resources']['/XObject']
+            # The logo is drawn inside the template form
+            self.assertEqual(list(xobjects.keys()), ['/FormXob.PageTemplate'])
+            forms.add(xobjects.raw_get('/FormXob.PageTemplate').idnum)
+        self.assertEqual(len(pages), 5)
+        self.assertEqual(len(forms), 1)
+
+
+class ImportTimeTest(TestCase):
+    # Seconds, generous for slow CI machines, SIKTEERI_SETUP_BUDGET overrides
+    SETUP_BUDGET = 5.0
+    SCRIPT = ("import sys, time, django; started = time.perf_counter(); django.setup(); "
+              "print(time.perf_counter() - started); "
+              "print(' '.join(name for name in sys.modules if name.split('.')[0] in ('reportlab', 'pypdf')))")
+
+    def test_setup_import_time(self):
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'sikteeri.settings')
+        result = subprocess.run([sys.executable, '-c', self.SCRIPT], env=env, stdout=subprocess.PIPE,
+                                check=True, universal_newlines=True)
+        elapsed, __, modules = result.stdout.partition('\n')
+
+        # PDF rendering libraries are loaded on first use
+        self.assertEqual(modules.split(), [])
+        budget = float(os.environ.get('SIKTEERI_SETUP_BUDGET', self.SETUP_BUDGET))
+        self.assertLess(float(elapsed), budget)
+
+
+class InterruptedImport(Exception):
+    pass
+
+
+class StreamingPaymentImportTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def _open(self, file):
+        return open(os.path.join(os.path.dirname(__file__), 'test_data', file), 'rb')
+
+    def test_import(self):
+        progress = []
+        with self._open("csv-test.csv") as f:
+            messages = process_payment_file(f, chunk_size=2,
+                                            progress=lambda rows, rate: progress.append(rows))
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertIn("Unidentified payments: 3", messages[-1][2])
+        checkpoint = PaymentImportCheckpoint.objects.get()
+        self.assertTrue(checkpoint.finished)
+        self.assertEqual(checkpoint.last_transaction_id, "201004202588NGN52047")
+
+        # Importing the same file again does nothing
+        with self._open("csv-test.csv") as f:
+            messages = process_payment_file(f)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_resume(self):
+        def interrupt(rows, rate):
+            if rows > 1:
+                raise InterruptedImport()
+        with self._open("csv-test.csv") as f:
+            self.assertRaises(InterruptedImport, process_payment_file, f, chunk_size=1,
+                              progress=interrupt)
+        self.assertEqual(Payment.objects.count(), 1)
+        checkpoint = PaymentImportCheckpoint.objects.get()
+        self.assertFalse(checkpoint.finished)
+        self.assertEqual(checkpoint.last_transaction_id, "200901252588NGNO0290")
+
+        with CaptureQueriesContext(connection) as queries:
+            with self._open("csv-test.csv") as f:
+                process_payment_file(f, chunk_size=1)
+        self.assertEqual(Payment.objects.count(), 3)
+        # The already imported payment is not looked up again
+        self.assertFalse(any('200901252588NGNO0290' in q['sql'] for q in queries.captured_queries))
+        self.assertEqual(PaymentImportCheckpoint.objects.get().rows, 3)
+
+    def test_checkpoint_mismatch(self):
+        def interrupt(rows, rate):
+            if rows > 1:
+                raise InterruptedImport()
+        with self._open("csv-test.csv") as f:
+            self.assertRaises(InterruptedImport, process_payment_file, f, chunk_size=1,
+                              progress=interrupt)
+        PaymentImportCheckpoint.objects.update(byte_offset=F('byte_offset') + 1)
+        with self._open("csv-test.csv") as f:
+            self.assertRaises(CheckpointMismatchException, process_payment_file, f, chunk_size=1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_same_result_as_text_import(self):
+        with open_test_data("procountor-csv-test.csv") as f:
+            process_procountor_csv(f)
+        text_rows = list(Payment.objects.order_by('transaction_id').values_list(
+            'transaction_id', 'amount', 'reference_number', 'payer_name', 'payment_day'))
+        Payment.objects.all().delete()
+        with self._open("procountor-csv-test.csv") as f:
+            process_payment_file(f, reader_class=ProcountorDictReader)
+        self.assertEqual(list(Payment.objects.order_by('transaction_id').values_list(
+            'transaction_id', 'amount', 'reference_number', 'payer_name', 'payment_day')), text_rows)
+
+
+class ImportJobTest(TestCase):
+    fixtures = ['membership_fees.json', 'test_user.json']
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.field = ImportJob._meta.get_field('file')
+        self.storage = self.field.storage
+        self.field.storage = FileSystemStorage(location=self.cache_dir)
+        self.client.login(username='admin', password='dhtn')
+
+    def tearDown(self):
+        self.field.storage = self.storage
+        shutil.rmtree(self.cache_dir)
+
+    def _upload(self, file, format):
+        with open(os.path.join(os.path.dirname(__file__), 'test_data', file), 'rb') as f:
+            return self.client.post(reverse('import_payments'), {'csv': f, 'format': format})
+
+    def test_upload_returns_immediately(self):
+        response = self._upload("csv-test.csv", 'op')
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, reverse('import_job', args=[job.id]))
+        self.assertEqual(job.status, IMPORT_JOB_QUEUED)
+        self.assertEqual(Payment.objects.count(), 0)
+
+        status = json.loads(self.client.get(reverse('import_job_status', args=[job.id])).content)
+        self.assertFalse(status['finished'])
+
+        self.assertEqual(run_queued_jobs(), 1)
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, IMPORT_JOB_DONE)
+        self.assertEqual(job.rows, 3)
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertFalse(job.file.storage.exists(job.file.name))
+        status = json.loads(self.client.get(reverse('import_job_status', args=[job.id])).content)
+        self.assertTrue(status['finished'])
+        response = self.client.get(reverse('import_job', args=[job.id]))
+        self.assertContains(response, "Unidentified payments: 3")
+
+    def test_jobs_run_one_at_a_time(self):
+        self._upload("csv-test.csv", 'op')
+        self._upload("procountor-csv-test.csv", 'procountor')
+        first = claim_next_job()
+        self.assertIsNone(claim_next_job())
+        run_job(first)
+        second = claim_next_job()
+        self.assertNotEqual(first.id, second.id)
+        run_job(second)
+        self.assertEqual(ImportJob.objects.filter(status=IMPORT_JOB_DONE).count(), 2)
+
+    def test_failed_job(self):
+        self._upload("csv-invalid.csv", 'op')
+        run_queued_jobs()
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, IMPORT_JOB_FAILED)
+        self.assertIn("RequiredFieldNotFoundException", job.error)
+        # Kept for resuming the import
+        self.assertTrue(job.file.storage.exists(job.file.name))
+
+    def test_interrupted_job_is_requeued(self):
+        self._upload("csv-test.csv", 'op')
+        job = claim_next_job(worker='other:1')
+        self.assertEqual(job.worker, 'other:1')
+        self.assertEqual(requeue_interrupted_jobs(), 0)
+        self.assertEqual(run_queued_jobs(), 0)
+        ImportJob.objects.filter(id=job.id).update(heartbeat=datetime.now() - timedelta(hours=1))
+        self.assertEqual(requeue_interrupted_jobs(), 1)
+        self.assertEqual(run_queued_jobs(), 1)
+        self.assertEqual(ImportJob.objects.get().status, IMPORT_JOB_DONE)
+
+
+class ImportJobHeartbeatTest(TransactionTestCase):
+
+    def test_heartbeat_during_slow_chunk(self):
+        stale = datetime.now() - timedelta(hours=1)
+        job = ImportJob.objects.create(file='payment_imports/slow.csv', format='op', status=IMPORT_JOB_RUNNING,
+                                       worker='worker:1', heartbeat=stale)
+        with Heartbeat(job, interval=0.01):
+            deadline = time.monotonic() + 5
+            while ImportJob.objects.get(id=job.id).heartbeat == stale and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(requeue_interrupted_jobs(), 0)
+        self.assertEqual(ImportJob.objects.get(id=job.id).status, IMPORT_JOB_RUNNING)
+
+
 class ProcountorCSVNoMembersTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
 
@@ -1497,6 +2599,70 @@ class LoginFieldTest(TestCase):
     def test_space(self):
         self.assertRaises(ValidationError, self.field.clean, "test user")
 
+    def test_reserved_ignores_case(self):
+        Alias(owner=create_dummy_member('N'), name='TestUser').save()
+        self.assertRaises(ValidationError, self.field.clean, "testuser")
+
+
+class AliasLookupTest(TestCase):
+    fixtures = ['membership_fees.json']
+
+    def setUp(self):
+        self.m = create_dummy_member('N')
+        Alias(owner=self.m, name=' Matti.Meikalainen ').save()
+
+    def test_normalized_name(self):
+        alias = Alias.objects.get()
+        self.assertEqual(alias.name, 'Matti.Meikalainen')
+        self.assertEqual(alias.normalized_name, 'matti.meikalainen')
+
+    def test_taken_names_in_one_query(self):
+        with self.assertNumQueries(1):
+            taken = Alias.taken_names(['MATTI.meikalainen', 'meikalainen.matti', 'mm'])
+        self.assertEqual(taken, {'matti.meikalainen'})
+        with self.assertNumQueries(0):
+            self.assertEqual(Alias.taken_names([]), set())
+
+    def test_email_forwards_in_one_query(self):
+        with self.assertNumQueries(1):
+            forwards = Alias.email_forwards(first_name='Matti', last_name='Meikäläinen',
+                                            given_names='Matti Kalle')
+        self.assertNotIn('matti.meikalainen', forwards)
+        self.assertEqual(forwards[0], 'meikalainen.matti')
+        self.assertIn('matti.kalle.meikalainen', forwards)
+
+
+class TakenAliasNamesTest(TransactionTestCase):
+    fixtures = ['membership_fees.json']
+
+    def setUp(self):
+        self.names = TakenAliasNames()
+        self.m = create_dummy_member('N')
+
+    def test_cached_outside_transaction(self):
+        Alias(owner=self.m, name='Taken').save()
+        self.assertTrue(self.names.is_taken('taken'))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.names.is_taken('TAKEN'))
+            self.assertFalse(self.names.is_taken('free'))
+
+    def test_reloaded_after_change(self):
+        self.assertFalse(self.names.is_taken('taken'))
+        alias = Alias(owner=self.m, name='taken')
+        alias.save()
+        self.names.invalidate()
+        self.assertTrue(self.names.is_taken('taken'))
+        alias.delete()
+        self.names.invalidate()
+        self.assertFalse(self.names.is_taken('taken'))
+
+    def test_uncommitted_not_cached(self):
+        with transaction.atomic():
+            Alias(owner=self.m, name='pending').save()
+            self.assertTrue(self.names.is_taken('pending'))
+            transaction.set_rollback(True)
+        self.assertFalse(self.names.is_taken('pending'))
+
 
 class MemberListTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
@@ -1533,6 +2699,39 @@ class MemberListTest(TestCase):
         response = self.client.get('/membership/memberships/approved/?page=2')
         self.assertEqual(response.status_code, 404)
 
+    def test_memberlist_constant_queries(self):
+        Comment.objects.create(content_object=self.m3, site_id=settings.SITE_ID, comment='Checked')
+        url = '/membership/memberships/new/'
+        with CaptureQueriesContext(connection) as one_member:
+            response = self.client.get(url)
+        self.assertRegex(response.content.decode("utf-8"),
+                         r'<li class="list_item preapprovable( duplicate)? comments" id="%i">' % self.m3.id)
+        for i in range(5):
+            create_dummy_member('N').preapprove(self.user)
+            create_dummy_member('N')
+        for url in ['/membership/memberships/new/', '/membership/memberships/preapproved/']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), len(one_member))
+
+    def test_plaintext_exports(self):
+        self.m2.person.first_name = 'A & <B>'
+        self.m2.person.save()
+        response = self.client.get('/membership/memberships/preapproved-plain/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'),
+                         '<pre>\n#%i A &amp; &lt;B&gt; %s\n\n</pre>' % (self.m2.id, self.m2.person.last_name))
+
+        self.m1.person.email = 'first@example.com'
+        self.m1.person.save()
+        m4 = create_dummy_member('N', type='O')
+        m4.preapprove(self.user)
+        m4.approve(self.user)
+        response = self.client.get('/membership/memberships/approved-emails/')
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'),
+                         'first@example.com\n%s\n\n' % m4.organization.email)
+
     def test_memberlist_sort_by_name(self):
         response = self.client.get('/membership/memberships/approved/?sort=name')
         self.assertEqual(response.status_code, 200)
@@ -1897,9 +3096,83 @@ class DuplicateMembershipDetectionTest(TestCase):
 
         self.assertEqual(len(m1.duplicates()), 0)
 
+    def _member(self, type='P'):
+        # Random dummy members may share an email or phone number
+        member = create_dummy_member('N', type=type)
+        contact = member.organization if type == 'O' else member.person
+        contact.email = 'duplicate-test-%d@example.com' % member.id
+        contact.phone = contact.sms = '%09d' % (50000000 + member.id)
+        if type != 'O':
+            contact.last_name = 'Testinen%s' % chr(ord('a') + member.id % 26)
+        contact.save()
+        return member
+
+    def test_normalized_keys(self):
+        m1 = self._member()
+        m1.person.first_name = 'Äijälä'
+        m1.person.email = 'Someone@Example.com'
+        m1.person.phone = '+358 40 555 1234'
+        m1.person.save()
+
+        m2 = self._member()
+        m2.person.first_name = 'aijala'
+        m2.person.last_name = ' %s ' % m1.person.last_name.upper()
+        m2.person.save()
+        m3 = self._member()
+        m3.person.email = 'someone@example.com'
+        m3.person.save()
+        m4 = self._member()
+        m4.person.sms = '040-5551234'
+        m4.person.save()
+
+        self.assertEqual(m1.duplicate_ids(), [m2.id, m3.id, m4.id])
+        self.assertEqual(list(m4.duplicates()), [m1])
+
+    def test_organization_legal_form(self):
+        m1 = self._member(type='O')
+        m1.organization.organization_name = 'Esimerkki Yhdistys ry'
+        m1.organization.save()
+        m2 = self._member(type='O')
+        m2.organization.organization_name = 'Yhdistys, Esimerkki'
+        m2.organization.save()
+        self.assertEqual(m1.duplicate_ids(), [m2.id])
+
+    def test_page_and_clusters(self):
+        members = [self._member() for i in range(6)]
+        for member in members[1:3]:
+            member.person.email = members[0].person.email
+            member.person.save()
+        members[3].person.phone = members[2].person.phone
+        members[3].person.save()
+        MembershipDuplicateKey.objects.filter(membership=members[5]).delete()
+        with self.assertNumQueries(1):
+            duplicate_ids = MembershipDuplicateKey.duplicate_ids(member.id for member in members)
+        found = [duplicate_ids[member.id] for member in members]
+        self.assertEqual(found, [[m.id for m in members[1:3]],
+                                 [members[0].id, members[2].id],
+                                 [m.id for m in members[:2]] + [members[3].id],
+                                 [members[2].id], [], []])
+        clusters = MembershipDuplicateKey.clusters()
+        self.assertIn([m.id for m in members[:4]], clusters)
+        self.assertEqual(MembershipDuplicateKey.rebuild(batch_size=2),
+                         MembershipDuplicateKey.objects.count())
+
+    def test_list_page_one_query(self):
+        user = User.objects.create_superuser('dupadmin', 'dupadmin@example.com', 'secret')
+        self.client.login(username='dupadmin', password='secret')
+        for i in range(5):
+            create_dummy_member('N')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('new_memberships'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'membership_membershipduplicatekey' in q['sql']]), 1)
+
 
 class MembershipSearchTest(TestCase):
     def setUp(self):
+        # Same random names regardless of the tests run before
+        test_utils.random.seed(1)
         self.m = create_dummy_member('N')
         self.m.save()
 
@@ -1930,6 +3203,58 @@ class MembershipSearchTest(TestCase):
         alias.save()
         self.assertEqual(len(Membership.search(alias.name)), 1)
 
+    def test_find_by_email_and_phone_part(self):
+        self.m.person.email = 'Search.Test@example.com'
+        self.m.person.save()
+        self.assertEqual(list(Membership.search('search.test')), [self.m])
+        self.assertEqual(list(Membership.search('st@')), [self.m])
+        self.assertIn(self.m, Membership.search(self.m.person.phone[-4:]))
+
+    def test_words_narrow_search(self):
+        person = self.m.person
+        self.assertEqual(list(Membership.search('%s %s' % (person.first_name, person.last_name))), [self.m])
+        self.assertEqual(len(Membership.search('%s nosuchname' % person.first_name)), 0)
+        self.assertEqual(list(Membership.search('#%d %s' % (self.m.id, person.last_name))), [self.m])
+        self.assertEqual(len(Membership.search('#%d %s' % (self.o.id, person.last_name))), 0)
+
+    def test_fts_lookup_cached(self):
+        list(Membership.search(self.m.person.last_name))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(list(Membership.search(self.m.person.last_name)), [self.m])
+        self.assertFalse([q for q in queries.captured_queries if 'sqlite_master' in q['sql']])
+
+    def test_exact_name(self):
+        self.m.person.first_name = 'Äijälä'
+        self.m.person.save()
+        self.assertEqual(list(Membership.search('"äijälä"')), [self.m])
+        self.assertEqual(list(Membership.search('ÄIJÄ')), [self.m])
+        self.assertEqual(len(Membership.search('"äijä"')), 0)
+
+    def test_index_follows_changes(self):
+        old_name = self.o.organization.organization_name
+        self.o.organization.organization_name = 'Uusi Yhdistys ry'
+        self.o.organization.save()
+        self.assertEqual(len(Membership.search('"%s"' % old_name)), 0)
+        self.assertEqual(list(Membership.search('yhdistys')), [self.o])
+
+        self.m.person = create_dummy_member('N').person
+        self.m.save()
+        self.assertEqual(len(Membership.search('"%s"' % self.m.person.first_name)), 2)
+
+    def test_rebuild(self):
+        MembershipSearchIndex.objects.all().delete()
+        self.assertEqual(len(Membership.search(self.m.person.last_name)), 0)
+        self.assertEqual(MembershipSearchIndex.rebuild(batch_size=1), 2)
+        self.assertEqual(list(Membership.search(self.m.person.last_name)), [self.m])
+
+    def test_trigram_index_used(self):
+        if connection.vendor != 'sqlite':
+            return
+        with CaptureQueriesContext(connection) as queries:
+            list(Membership.search(self.m.person.last_name))
+        self.assertIn('MATCH', queries.captured_queries[-1]['sql'])
+        self.assertNotIn('membership_contact"."first_name" LIKE', queries.captured_queries[-1]['sql'])
+
 
 class MembershipPaperReminderSentTest(TestCase):
     fixtures = ['membership_fees.json', 'test_user.json']
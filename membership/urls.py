@@ -71,6 +71,8 @@ urlpatterns = [
 
     url(r'payments/edit/(\d+)/$', membership.views.payment_edit, name='payment_edit'),
     url(r'payments/import/$', membership.views.import_payments, name='import_payments'),
+    url(r'payments/import/(\d+)/$', membership.views.import_job, name='import_job'),
+    url(r'payments/import/(\d+)/status/$', membership.views.import_job_status, name='import_job_status'),
     url(r'payments/send_duplicate_notification/(\d+)$', membership.views.send_duplicate_notification,
         name='payment_send_duplicate_notification'),
 
@@ -84,63 +86,57 @@ urlpatterns = [
     url(r'admtool/lookup/alias/(.+)$', membership.views.admtool_lookup_alias_json, name='admtool'),
 
     url(r'memberships/new/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='N').order_by('id'),
+        {'queryset': Membership.objects.filter(status__exact='N').order_by('id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='new_memberships'),
     url(r'memberships/preapproved/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='P').order_by('id'),
+        {'queryset': Membership.objects.filter(status__exact='P').order_by('id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='preapproved_memberships'),
-    url(r'memberships/preapproved-plain/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='P').order_by('id'),
-         'template_name': 'membership/membership_list_plaintext.html',
-         'context_object_name': 'member_list'},
+    url(r'memberships/preapproved-plain/$', membership.views.member_export,
+        {'queryset': Membership.objects.filter(status__exact='P').order_by('id')},
         name='preapproved_memberships_plain'),
     url(r'memberships/approved/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='A').
-            order_by('person__last_name', 'person__first_name', 'id'),
+            order_by('person__last_name', 'person__first_name', 'id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='approved_memberships'),
     url(r'memberships/dissociation_requested/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='S').
-            order_by('person__last_name', 'person__first_name', 'id'),
+            order_by('person__last_name', 'person__first_name', 'id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='dissociation_requested_memberships'),
-    url(r'memberships/dissociation_requested-plain/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='S').order_by('id'),
-         'template_name': 'membership/membership_list_plaintext.html',
-         'context_object_name': 'member_list'},
+    url(r'memberships/dissociation_requested-plain/$', membership.views.member_export,
+        {'queryset': Membership.objects.filter(status__exact='S').order_by('id')},
         name='dissociation_requested_memberships_plain'),
     url(r'memberships/dissociated/$', membership.views.member_object_list,
         {'queryset': Membership.objects.filter(status__exact='I').
-            order_by('person__last_name', 'person__first_name', 'id'),
+            order_by('person__last_name', 'person__first_name', 'id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='dissociated_memberships'),
-    url(r'memberships/approved-emails/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='A').
-            order_by('id').values('person__email', 'organization__email'),
-         'template_name': 'membership/membership_list_emails.txt',
-         'context_object_name': 'member_list'},
+    url(r'memberships/approved-emails/$', membership.views.member_export,
+        {'queryset': Membership.objects.filter(status__exact='A').order_by('id'),
+         'export': 'emails'},
         name='approved_memberships_emails'),
     url(r'memberships/unpaid_paper_reminded/$', membership.views.unpaid_paper_reminded,
         name='unpaid_paper_reminded_memberships'),
     url(r'memberships/unpaid_paper_reminded-plain/$', membership.views.unpaid_paper_reminded_plain,
         name='unpaid_paper_reminded_memberships_plain'),
     url(r'memberships/deleted/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.filter(status__exact='D').order_by('-id'),
+        {'queryset': Membership.objects.filter(status__exact='D').order_by('-id').for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='deleted_memberships'),
     url(r'memberships/$', membership.views.member_object_list,
-        {'queryset': Membership.objects.all(),
+        {'queryset': Membership.objects.for_listing(),
          'template_name': 'membership/membership_list.html',
          'context_object_name': 'member_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='all_memberships'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset_pagination': True}, name='all_memberships'),
 
     url(r'^memberships/inline/search/$', membership.views.search,
         {'template_name': 'membership/membership_list_inline.html',
@@ -152,17 +148,18 @@ urlpatterns = [
 
     url(r'bills/$', membership.views.billing_object_list,
         {'queryset': BillingCycle.objects.filter(
-            membership__status='A').order_by('-start', '-id'),
+            membership__status='A').order_by('-start', '-id').for_listing(),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='cycle_list'),
     url(r'bills/unpaid/$', membership.views.billing_object_list,
-        {'queryset': BillingCycle.objects.filter(is_paid__exact=False, membership__status='A').order_by('start', 'id'),
+        {'queryset': BillingCycle.objects.filter(is_paid__exact=False, membership__status='A').order_by('start', 'id')
+            .for_listing(),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='unpaid_cycle_list'),
     url(r'bills/locked/$', membership.views.billing_object_list,
-        {'queryset': BillingCycle.get_reminder_billingcycles(),
+        {'queryset': BillingCycle.get_reminder_billingcycles().for_listing(),
          'template_name': 'membership/bill_list.html',
          'context_object_name': 'cycle_list',
          'paginate_by': ENTRIES_PER_PAGE}, name='locked_cycle_list'),
@@ -173,17 +170,17 @@ urlpatterns = [
         {'queryset': payments,
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset_pagination': True}, name='payment_list'),
     url(r'payments/unknown/$', membership.views.billing_object_list,
         {'queryset': payments.filter(billingcycle=None, ignore=False),
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='unknown_payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset_pagination': True}, name='unknown_payment_list'),
     url(r'payments/ignored/$', membership.views.billing_object_list,
         {'queryset': payments.filter(ignore=True),
          'template_name': 'membership/payment_list.html',
          'context_object_name': 'payment_list',
-         'paginate_by': ENTRIES_PER_PAGE}, name='ignored_payment_list'),
+         'paginate_by': ENTRIES_PER_PAGE, 'keyset_pagination': True}, name='ignored_payment_list'),
 ]
 
 urlpatterns += [
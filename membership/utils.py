@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
 from datetime import datetime
 
 from django_comments.models import Comment
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.utils.html import escape
@@ -74,6 +77,22 @@ def log_change(object, user, before=None, after=None, change_message=None):
     )
 
 
+def log_changes(entries):
+    """
+    Bulk version of log_change.
+    :param entries: list of (object, user, change_message) tuples
+    """
+    from django.contrib.admin.models import LogEntry, CHANGE
+    LogEntry.objects.bulk_create([
+        LogEntry(user_id=user.pk,
+                 content_type_id=ContentType.objects.get_for_model(object).pk,
+                 object_id=str(object.pk),
+                 object_repr=str(object)[:200],
+                 action_flag=CHANGE,
+                 change_message=change_message)
+        for object, user, change_message in entries])
+
+
 def change_message_to_list(row):
     """Convert humanized diffs to a list for usage in template"""
     retval = []
@@ -334,3 +353,56 @@ def get_client_ip(request):
     else:
         ip = request.META.get('REMOTE_ADDR')
     return ip
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _read_range(file_handle, length, block_size=8192):
+    try:
+        while length > 0:
+            data = file_handle.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file_handle.close()
+
+
+def file_response(request, file_handle, content_type, filename, as_attachment=False):
+    """
+    Stream an open binary file with Content-Length, serving a single byte
+    range if the request has a Range header.
+    """
+    file_handle.seek(0, os.SEEK_END)
+    size = file_handle.tell()
+    file_handle.seek(0)
+    start, end = 0, size - 1
+
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if match and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                end = min(int(last), size - 1)
+        else:
+            # Suffix range, the last bytes of the file
+            start = max(size - int(last), 0)
+        if start > end:
+            file_handle.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        file_handle.seek(start)
+        response = StreamingHttpResponse(_read_range(file_handle, end - start + 1), status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    else:
+        response = FileResponse(file_handle, content_type=content_type)
+
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = '%s; filename=%s' % ('attachment' if as_attachment else 'inline', filename)
+    return response
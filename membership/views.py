@@ -16,38 +16,47 @@ from django.db import transaction
 from django.forms import ChoiceField, ModelForm, Form, EmailField, BooleanField
 from django.forms import ModelChoiceField, CharField, Textarea, HiddenInput, FileField
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseServerError
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseServerError, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.list import ListView
-from services.models import Alias, Service, ServiceType
+from services.models import Alias, Service, ServiceType, normalize_alias
 
 from membership.templatetags.sorturl import lookup_sort
 from membership.decorators import trusted_host_required
 from membership.forms import PersonApplicationForm, OrganizationApplicationForm, PersonContactForm, ServiceForm, \
     ContactForm, SupportingPersonApplicationForm
 from membership.utils import log_change, serializable_membership_info, admtool_membership_details, \
-    get_client_ip, bake_log_entries
+    get_client_ip, bake_log_entries, file_response
 from membership.public_memberlist import public_memberlist_data
+from membership.billing.render_context import BillRenderContext
+from membership.pagination import InvalidCursor, KeysetPaginator, ListingPaginator
 from membership.unpaid_members import unpaid_members_data, members_to_lock
-from membership.billing.payments import process_op_csv, process_procountor_csv
 from membership.models import Contact, Membership, MEMBER_TYPES_DICT, Bill, BillingCycle, Payment, ApplicationPoll, \
-    MembershipAlreadyStatus
+    MembershipAlreadyStatus, ImportJob, IMPORT_JOB_FORMATS
 from services.views import check_alias_availability, validate_alias
 
 logger = logging.getLogger("membership.views")
 
 ENTRIES_PER_PAGE = settings.ENTRIES_PER_PAGE
+# Rows fetched at a time by the streamed member exports
+EXPORT_CHUNK_SIZE = 2000
 
 # Class based views
 
 
 class SortListView(ListView):
     """ListView with search query parameter"""
+    paginator_class = ListingPaginator
     search_query = ''
     sort = None
     header = ''
     disable_duplicates_header = ''
+    # Paginate with after/before cursors instead of page numbers when the
+    # ordering allows it
+    keyset_pagination = False
 
     def get_context_data(self, **kwargs):
         context = super(SortListView, self).get_context_data(**kwargs)
@@ -56,6 +65,16 @@ class SortListView(ListView):
         context['disable_duplicates_header'] = self.disable_duplicates_header
         return context
 
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination or not KeysetPaginator.supports(queryset):
+            return super(SortListView, self).paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidCursor:
+            raise Http404(_('Invalid page.'))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
     def get_queryset(self):
         qs = super(SortListView, self).get_queryset()
         ordering = lookup_sort(self.request.GET.get('sort'))
@@ -696,11 +715,8 @@ def bill_pdf(request, bill_id):
 
     bill = get_object_or_404(Bill, id=bill_id)
     try:
-        pdf = bill.generate_pdf()
-        if pdf:
-            response = HttpResponse(pdf, content_type='application/pdf')
-            response['Content-Disposition'] = 'inline; filename=bill_%s.pdf' % bill.id
-            return response
+        pdf_file = bill.open_pdf()
+        return file_response(request, pdf_file, 'application/pdf', 'bill_%s.pdf' % bill.id)
     except Exception as e:
         logger.exception("Failed to generate pdf for bill %s" % bill.id)
     response = HttpResponseServerError("Failed to generate pdf", content_type='plain/text', )
@@ -753,28 +769,21 @@ def billingcycle_connect_payment(request, id, template_name='membership/billingc
 
 @permission_required('membership.can_import_payments')
 def import_payments(request, template_name='membership/import_payments.html'):
-    import_messages = []
     class PaymentCSVForm(Form):
         csv = FileField(label=_('CSV File'),
                          help_text=_('Choose CSV file to upload'))
-        format = ChoiceField(choices=(('op', 'Osuuspankki'), ('procountor', 'Procountor')),
+        format = ChoiceField(choices=IMPORT_JOB_FORMATS,
                            help_text=_("File type"))
 
     if request.method == 'POST':
         form = PaymentCSVForm(request.POST, request.FILES)
         if form.is_valid():
-            try:
-                in_memory_file = request.FILES['csv']
-                logger.info("Beginning payment import.")
-                if form.cleaned_data['format'] == 'op':
-                    import_messages = process_op_csv(in_memory_file, user=request.user)
-                elif form.cleaned_data['format'] == 'procountor':
-                    import_messages = process_procountor_csv(in_memory_file, user=request.user)
-                messages.success(request, _("Payment import succeeded!"))
-            except:
-                  logger.error("%s" % traceback.format_exc())
-                  logger.error("Payment CSV import failed.")
-                  messages.error(request, _("Payment import failed."))
+            job = ImportJob.objects.create(file=request.FILES['csv'],
+                                           format=form.cleaned_data['format'],
+                                           user=request.user)
+            logger.info("Payment import job %s queued." % repr(job))
+            messages.success(request, _("Payment import queued."))
+            return redirect('import_job', job.id)
         else:
             messages.error(request, _("Payment import failed."))
     else:
@@ -783,7 +792,29 @@ def import_payments(request, template_name='membership/import_payments.html'):
     return render(request, template_name,
                   {'title': _("Import payments"),
                    'form': form,
-                   'import_messages': import_messages})
+                   'jobs': ImportJob.objects.order_by('-id')[:10]})
+
+
+@permission_required('membership.can_import_payments')
+def import_job(request, id, template_name='membership/import_job.html'):
+    job = get_object_or_404(ImportJob, id=id)
+    return render(request, template_name,
+                  {'title': _("Import payments"),
+                   'job': job,
+                   'import_messages': job.import_messages()})
+
+
+@permission_required('membership.can_import_payments')
+def import_job_status(request, id):
+    job = get_object_or_404(ImportJob, id=id)
+    json_obj = {
+        'status': job.status,
+        'status_display': str(job.get_status_display()),
+        'rows': job.rows,
+        'finished': job.is_finished(),
+    }
+    return HttpResponse(json.dumps(json_obj, sort_keys=True, indent=4),
+                        content_type='application/json')
 
 
 @permission_required('membership.read_bills')
@@ -792,18 +823,21 @@ def print_reminders(request, **kwargs):
     if request.method == 'POST':
         try:
             if 'marksent' in request.POST:
+                bills = []
                 for billing_cycle in BillingCycle.get_reminder_billingcycles().all():
                     bill = Bill(billingcycle=billing_cycle, type='P')
                     bill.reminder_count = billing_cycle.bill_set.count()
                     bill.save()
-                    bill.generate_pdf()
+                    bills.append(bill)
+                context = BillRenderContext(bills, payments=Payment)
+                for bill in bills:
+                    bill.generate_pdf(context=context)
                 output_messages.append(_('Reminders marked as sent'))
             else:
-                pdf = BillingCycle.get_pdf_reminders()
-                if pdf:
-                    response = HttpResponse(pdf, content_type='application/pdf')
-                    response['Content-Disposition'] = 'attachment; filename=reminders.pdf'
-                    return response
+                pdf_file = BillingCycle.get_pdf_reminders_file()
+                if pdf_file:
+                    return file_response(request, pdf_file, 'application/pdf', 'reminders.pdf',
+                                         as_attachment=True)
                 else:
                     output_messages.append(_('Error processing PDF'))
         except RuntimeError:
@@ -1018,7 +1052,7 @@ def membership_edit(request, id, template_name='membership/membership_edit.html'
 def membership_duplicates(request, id):
     membership = get_object_or_404(Membership, id=id)
 
-    view_params = {'queryset': membership.duplicates(),
+    view_params = {'queryset': membership.duplicates().for_listing(),
                    'template_name': 'membership/membership_list.html',
                    'context_object_name': 'member_list',
                    'header':  _("List duplicates for member #%(mid)i %(membership)s" % {"mid":membership.id,
@@ -1031,7 +1065,7 @@ def membership_duplicates(request, id):
 
 @permission_required('membership.read_members')
 def unpaid_paper_reminded(request):
-    view_params = {'queryset': Membership.paper_reminder_sent_unpaid_after(),
+    view_params = {'queryset': Membership.paper_reminder_sent_unpaid_after().for_listing(),
                    'template_name': 'membership/membership_list.html',
                    'context_object_name': 'member_list',
                    'paginate_by': ENTRIES_PER_PAGE
@@ -1042,12 +1076,42 @@ def unpaid_paper_reminded(request):
 
 @permission_required('membership.read_members')
 def unpaid_paper_reminded_plain(request):
-    view_params = {'queryset': Membership.paper_reminder_sent_unpaid_after().order_by('id'),
-                   'template_name': 'membership/membership_list_plaintext.html',
-                   'context_object_name': 'member_list'
-                   }
+    return member_export(request, Membership.paper_reminder_sent_unpaid_after().order_by('id'))
 
-    return member_object_list(request, **view_params)
+
+def _plaintext_lines(memberships):
+    yield '<pre>\n'
+    for membership in memberships:
+        yield '#%d %s\n' % (membership.id, escape(membership.name()))
+    yield '\n</pre>'
+
+
+def _email_lines(rows):
+    for row in rows:
+        yield '%s\n' % escape(row['organization__email'] or row['person__email'])
+    yield '\n'
+
+
+@permission_required('membership.read_members')
+def member_export(request, queryset, export='plaintext'):
+    """
+    Stream a list of members as "#id name" lines or, for export 'emails',
+    the email addresses of their primary contacts. The rows are fetched
+    EXPORT_CHUNK_SIZE at a time.
+    """
+    ordering = lookup_sort(request.GET.get('sort'))
+    if ordering is not None:
+        queryset = queryset.order_by(ordering)
+    if export == 'emails':
+        rows = queryset.values('person__email', 'organization__email')
+        lines = _email_lines(rows.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    else:
+        contact_fields = ['first_name', 'last_name', 'organization_name']
+        memberships = queryset.select_related('person', 'organization').only(
+            'id', 'person', 'organization',
+            *['%s__%s' % (contact, field) for contact in ['person', 'organization'] for field in contact_fields])
+        lines = _plaintext_lines(memberships.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponse(lines)
 
 
 @permission_required('membership.delete_members')
@@ -1297,7 +1361,7 @@ def admtool_membership_detail_json(request, id):
 
 @trusted_host_required
 def admtool_lookup_alias_json(request, alias):
-    aliases = Alias.objects.filter(name__iexact=alias)
+    aliases = Alias.objects.filter(normalized_name=normalize_alias(alias))
     if len(aliases) == 1:
         return HttpResponse(aliases[0].owner.id, content_type='text/plain')
     elif not aliases:
@@ -1342,6 +1406,6 @@ def search(request, **kwargs):
 
     kwargs['queryset'] = qs.order_by("organization__organization_name",
                      "person__last_name",
-                     "person__first_name")
+                     "person__first_name").for_listing()
     kwargs['search_query'] = query
     return SortListView.as_view(**kwargs)(request)
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('procountor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(choices=[('referencepayments', 'Reference payments'), ('bankstatements', 'Bank statements')], max_length=32, unique=True, verbose_name='endpoint')),
+                ('synced_until', models.DateField(null=True, verbose_name='synced until')),
+                ('archive_ids', models.TextField(default='[]')),
+                ('last_changed', models.DateTimeField(auto_now=True, verbose_name='last changed')),
+            ],
+        ),
+    ]
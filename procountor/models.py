@@ -1,3 +1,6 @@
+import json
+from datetime import datetime, time
+
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
@@ -21,3 +24,51 @@ class APIToken(models.Model):
         if not object:
             return None
         return object.api_key
+
+
+class SyncState(models.Model):
+    """
+    Progress of the incremental payment import from one Procountor endpoint.
+
+    archive_ids holds the archive codes of the events already imported in
+    the overlap window before synced_until, so a run re-reading the overlap
+    can skip them without a database lookup per row.
+    """
+    REFERENCE_PAYMENTS = 'referencepayments'
+    BANK_STATEMENTS = 'bankstatements'
+    ENDPOINTS = (
+        (REFERENCE_PAYMENTS, _('Reference payments')),
+        (BANK_STATEMENTS, _('Bank statements')),
+    )
+
+    endpoint = models.CharField(max_length=32, choices=ENDPOINTS, unique=True, verbose_name=_('endpoint'))
+    synced_until = models.DateField(null=True, verbose_name=_('synced until'))
+    archive_ids = models.TextField(default='[]')  # JSON list
+    last_changed = models.DateTimeField(auto_now=True, verbose_name=_('last changed'))
+
+    @classmethod
+    def for_endpoint(cls, endpoint):
+        return cls.objects.get_or_create(endpoint=endpoint)[0]
+
+    def window_start(self, overlap):
+        """
+        Start of the next window to fetch, None if never synced
+        """
+        if self.synced_until is None:
+            return None
+        return datetime.combine(self.synced_until - overlap, time())
+
+    def known_archive_ids(self):
+        return set(json.loads(self.archive_ids))
+
+    def advance(self, until, seen, overlap):
+        """
+        Record a window synced up to until.
+        :param seen: (archive id, event date) pairs of the events fetched
+        """
+        # The next window starts at midnight, keep the whole first day
+        keep_from = datetime.combine(until.date() - overlap, time())
+        self.synced_until = until.date()
+        self.archive_ids = json.dumps(sorted({archive_id for archive_id, date in seen
+                                              if archive_id and (date is None or date >= keep_from)}))
+        self.save()
@@ -1,9 +1,13 @@
 import random
 import string
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from decimal import Decimal
 
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 
 logger = logging.getLogger("ProcountorAPI")
@@ -172,8 +176,25 @@ class ProcountorReferencePayment(object):
 
 
 class ProcountorAPIClient(object):
-    def __init__(self, api, company_id, redirect_uri, client_id, client_secret, api_key):
+    # Response status codes of requests which are retried
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api, company_id, redirect_uri, client_id, client_secret, api_key,
+                 page_size=100, max_workers=4, max_retries=5, backoff=1.0):
+        """
+        :param page_size: rows requested per page from list endpoints
+        :param max_workers: pages fetched concurrently
+        :param max_retries: retries of GET requests failing with RETRY_STATUS_CODES
+        :param backoff: seconds before the first retry, doubled on every further retry
+        """
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
         self.api = api.rstrip("/")
         self.client_id = client_id
         self.client_secret = client_secret
@@ -193,13 +214,90 @@ class ProcountorAPIClient(object):
                                                                                          response.content))
         return response
 
+    def _retry_delay(self, attempt, response=None):
+        if response is not None:
+            try:
+                return float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+        return self.backoff * 2 ** attempt
+
     def get(self, path, headers=None, params=None):
         url = "%s/%s" % (self.api, path)
         if not params:
             params = {}
-        response = self.session.get(url, params=params, headers=headers, allow_redirects=False)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, params=params, headers=headers, allow_redirects=False)
+            except requests.ConnectionError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("GET %s failed (%s), retrying in %.1f seconds" % (url, e, delay))
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    break
+                delay = self._retry_delay(attempt, response)
+                logger.warning("GET %s failed (%d), retrying in %.1f seconds" % (url, response.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
         return self._error_handler(url, params, response)
 
+    def _get_page(self, path, params, page):
+        page_params = dict(params, page=page)
+        return self.get(path, params=page_params).json()
+
+    def iter_pages(self, path, params=None, result_key="results"):
+        """
+        Generator of result rows from all pages of a list endpoint, in order.
+
+        The first page tells the total result count. When it is known,
+        the later pages are fetched concurrently by at most max_workers
+        threads sharing the session connection pool, and rows are yielded
+        as soon as all earlier pages have arrived. Otherwise the pages are
+        fetched one by one with the previousId cursor.
+        """
+        params = dict(params or {}, size=self.page_size)
+        result = self._get_page(path, params, 0)
+        rows = result.get(result_key, [])
+        for row in rows:
+            yield row
+        meta = result.get("meta") or {}
+        total = meta.get("totalCount")
+
+        if total is None:
+            # Without meta the page may or may not be the last one, stop there
+            while rows and "pageSize" in meta and meta.get("resultCount") == meta["pageSize"]:
+                params["previousId"] = str(rows[-1]["id"])
+                result = self.get(path, params=params).json()
+                rows = result.get(result_key, [])
+                meta = result.get("meta") or {}
+                for row in rows:
+                    yield row
+            return
+
+        pages = iter(range(1, -(-total // self.page_size)))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def submit_next():
+                page = next(pages, None)
+                if page is not None:
+                    pending.append(pool.submit(self._get_page, path, params, page))
+
+            try:
+                # Keep a bounded number of pages in flight
+                for _ in range(2 * self.max_workers):
+                    submit_next()
+                while pending:
+                    result = pending.popleft().result()
+                    submit_next()
+                    for row in result.get(result_key, []):
+                        yield row
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def post(self, path, body=None, headers=None, params=None):
         if not headers:
             headers = {}
@@ -238,28 +336,18 @@ class ProcountorAPIClient(object):
         Get refence payments
         :param start:
         :param end:
-        :return:
+        :return: generator of ProcountorReferencePayment
         """
         params = {
             "startDate": start.strftime("%Y-%m-%d"),
             "endDate": end.strftime("%Y-%m-%d"),
             "orderById": "asc",
         }
-        out = []
-        while True:
-            res = self.get("referencepayments", params=params)
-            result = res.json()
-            meta = result.get("meta")
-            out += [ProcountorReferencePayment(row) for row in result.get("results", [])]
-            if meta.get("resultCount") == meta.get("pageSize"):
-                params["previousId"] = str(out[-1].id)
-            else:
-                break
-        return out
+        return (ProcountorReferencePayment(row) for row in self.iter_pages("referencepayments", params=params))
 
     def get_bankstatements(self, start, end):
         """
-        TODO: Fetch all pages!!!
+        Get bank statements of all pages as a generator of ProcountorBankStatement
         {
           "bankStatements": [
             {
@@ -309,8 +397,7 @@ class ProcountorAPIClient(object):
             "startDate": start.strftime("%Y-%m-%d"),
             "endDate": end.strftime("%Y-%m-%d")
         }
-        res = self.get("bankstatements", params=params)
-        return [ProcountorBankStatement(x) for x in res.json().get("results", [])]
+        return (ProcountorBankStatement(row) for row in self.iter_pages("bankstatements", params=params))
 
     def get_ledgerreceipts(self, start, end):
 
@@ -321,6 +408,16 @@ class ProcountorAPIClient(object):
         res = self.get("ledgerreceipts", params=params)
         return res.json()
 
+    def iter_ledgerreceipts(self, start, end):
+        """
+        Generator of the ledger receipts of all result pages
+        """
+        params = {
+            "startDate": start.strftime("%Y-%m-%d"),
+            "endDate": end.strftime("%Y-%m-%d")
+        }
+        return self.iter_pages("ledgerreceipts", params=params)
+
     def get_invoices(self, start, end, status="PAID"):
         params = {
             "startDate": start.strftime("%Y-%m-%d"),
@@ -329,3 +426,14 @@ class ProcountorAPIClient(object):
         }
         res = self.get("invoices", params=params)
         return res.json()
+
+    def iter_invoices(self, start, end, status="PAID"):
+        """
+        Generator of the invoices of all result pages
+        """
+        params = {
+            "startDate": start.strftime("%Y-%m-%d"),
+            "endDate": end.strftime("%Y-%m-%d"),
+            "status": status,
+        }
+        return self.iter_pages("invoices", params=params)
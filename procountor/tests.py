@@ -1,10 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 import requests_mock
 
-from procountor.models import APIToken
-from procountor.procountor_api import ProcountorAPIClient
+from membership.models import Payment
+from procountor.models import APIToken, SyncState
+from procountor.procountor_api import ProcountorAPIClient, ProcountorAPIException
 
 class ProcountorLoginTests(TestCase):
     fixtures = ['test_user.json']
@@ -65,3 +69,167 @@ class ProcountorAPIClientTests(TestCase):
 
             self.assertEqual(client._oauth_access_token, response_data["access_token"])
             self.assertTrue(client._oauth_expires > datetime.now())
+
+
+def _reference_payment(i):
+    return {"id": i, "paymentDate": "2020-01-01", "valueDate": "2020-01-01", "sum": 10,
+            "name": "Payer %d" % i, "bankReference": "%d" % (1000 + i), "archiveId": "A%d" % i}
+
+
+class ProcountorPaginationTests(TestCase):
+    url = 'https://invalid.url/api/referencepayments'
+
+    def setUp(self):
+        self.client = ProcountorAPIClient(api='https://invalid.url/api', company_id=1,
+                                          redirect_uri="redirect-url-placeholder", client_id="abc123",
+                                          client_secret="abc1234", api_key="foobar",
+                                          page_size=50, max_workers=4, backoff=0)
+
+    def _page_callback(self, total, pages_requested):
+        def callback(request, context):
+            page = int(request.qs['page'][0])
+            size = int(request.qs['size'][0])
+            pages_requested.append(page)
+            rows = [_reference_payment(i) for i in range(page * size, min(total, (page + 1) * size))]
+            return {"results": rows,
+                    "meta": {"pageNumber": page, "pageSize": size, "resultCount": len(rows), "totalCount": total}}
+        return callback
+
+    def test_all_pages_fetched_in_order(self):
+        pages_requested = []
+        with requests_mock.Mocker() as m:
+            m.get(self.url, json=self._page_callback(5025, pages_requested))
+            payments = list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+
+        self.assertEqual([p.id for p in payments], list(range(5025)))
+        self.assertEqual(sorted(pages_requested), list(range(101)))
+
+    def test_single_page(self):
+        pages_requested = []
+        with requests_mock.Mocker() as m:
+            m.get(self.url, json=self._page_callback(3, pages_requested))
+            payments = list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+
+        self.assertEqual([p.reference for p in payments], ["1000", "1001", "1002"])
+        self.assertEqual(pages_requested, [0])
+
+    def test_throttled_and_failed_pages_are_retried(self):
+        pages_requested = []
+        callback = self._page_callback(200, pages_requested)
+        with requests_mock.Mocker() as m:
+            m.get(self.url + '?page=2', [{'status_code': 429, 'headers': {'Retry-After': '0'}},
+                                         {'status_code': 503},
+                                         {'json': callback}])
+            m.get(self.url + '?page=0', json=callback)
+            m.get(self.url + '?page=1', json=callback)
+            m.get(self.url + '?page=3', json=callback)
+            payments = list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+
+        self.assertEqual([p.id for p in payments], list(range(200)))
+
+    def test_retries_are_limited(self):
+        self.client.max_retries = 2
+        with requests_mock.Mocker() as m:
+            m.get(self.url, status_code=500)
+            with self.assertRaises(ProcountorAPIException):
+                list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+            self.assertEqual(m.call_count, 3)
+
+    def test_unknown_total_falls_back_to_cursor(self):
+        def callback(request, context):
+            previous = int(request.qs.get('previousid', ['-1'])[0])
+            rows = [_reference_payment(i) for i in range(previous + 1, min(120, previous + 51))]
+            return {"results": rows, "meta": {"pageSize": 50, "resultCount": len(rows)}}
+
+        with requests_mock.Mocker() as m:
+            m.get(self.url, json=callback)
+            payments = list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+            self.assertEqual(m.call_count, 3)
+
+        self.assertEqual([p.id for p in payments], list(range(120)))
+
+    def test_missing_meta_stops(self):
+        rows = [_reference_payment(i) for i in range(50)]
+        with requests_mock.Mocker() as m:
+            m.get(self.url, json={"results": rows})
+            payments = list(self.client.get_referencepayments(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+            self.assertEqual(m.call_count, 1)
+
+        self.assertEqual(len(payments), 50)
+
+    def test_invoices_fetch_all_pages(self):
+        pages_requested = []
+        with requests_mock.Mocker() as m:
+            m.get('https://invalid.url/api/invoices', json=self._page_callback(120, pages_requested))
+            invoices = list(self.client.iter_invoices(datetime(2020, 1, 1), datetime(2020, 2, 1)))
+
+        self.assertEqual([invoice["id"] for invoice in invoices], list(range(120)))
+        self.assertEqual(sorted(pages_requested), [0, 1, 2])
+
+
+class ProcountorSyncTests(TestCase):
+    api = 'https://invalid.url/api'
+
+    def setUp(self):
+        APIToken.objects.create(api_key="foobar")
+        self.reference_payments = [_reference_payment(i) for i in range(3)]
+        self.requests = []
+
+    def _sync(self):
+        def referencepayments(request, context):
+            self.requests.append(request.qs)
+            rows = self.reference_payments
+            return {"results": rows, "meta": {"pageSize": 100, "resultCount": len(rows), "totalCount": len(rows)}}
+
+        with self.settings(PROCOUNTOR_API_URL=self.api):
+            with requests_mock.Mocker() as m:
+                m.post(self.api + '/oauth/token', json={"access_token": "token", "expires_in": 3600})
+                m.get(self.api + '/referencepayments', json=referencepayments)
+                m.get(self.api + '/bankstatements', json={"results": [], "meta": {}})
+                call_command('procountor', stdout=None)
+
+    def test_sync_state_recorded(self):
+        self._sync()
+        self.assertEqual(Payment.objects.count(), 3)
+        state = SyncState.objects.get(endpoint=SyncState.REFERENCE_PAYMENTS)
+        self.assertEqual(state.synced_until, datetime.now().date())
+        self.assertEqual(SyncState.objects.get(endpoint=SyncState.BANK_STATEMENTS).synced_until,
+                         datetime.now().date())
+
+    def test_next_sync_requests_overlap_window_only(self):
+        today = datetime.now().date()
+        SyncState.objects.create(endpoint=SyncState.REFERENCE_PAYMENTS, synced_until=today - timedelta(days=5))
+        self._sync()
+        self.assertEqual(self.requests[0]['startdate'], [(today - timedelta(days=6)).strftime("%Y-%m-%d")])
+
+        self._sync()
+        self.assertEqual(self.requests[1]['startdate'], [(today - timedelta(days=1)).strftime("%Y-%m-%d")])
+
+    def test_known_archive_ids_are_skipped(self):
+        today = datetime.now()
+        for row in self.reference_payments:
+            row["paymentDate"] = today.strftime("%Y-%m-%d")
+        self._sync()
+        self.reference_payments.append(dict(_reference_payment(3), paymentDate=today.strftime("%Y-%m-%d")))
+
+        with CaptureQueriesContext(connection) as queries:
+            self._sync()
+        self.assertEqual(Payment.objects.count(), 4)
+        payment_lookups = [q['sql'] for q in queries.captured_queries
+                           if q['sql'].startswith('SELECT') and 'membership_payment' in q['sql']]
+        self.assertTrue(any("'A3'" in sql for sql in payment_lookups))
+        for sql in payment_lookups:
+            self.assertNotIn("'A0'", sql)
+
+        with CaptureQueriesContext(connection) as queries:
+            self._sync()
+        self.assertLessEqual(len(queries.captured_queries), 6)
+        self.assertEqual(Payment.objects.count(), 4)
+
+    def test_overlap_keeps_whole_first_day(self):
+        state = SyncState.for_endpoint(SyncState.REFERENCE_PAYMENTS)
+        until = datetime(2020, 1, 10, 15, 30)
+        seen = [('A0', datetime(2020, 1, 8)), ('A1', datetime(2020, 1, 9)), ('A2', datetime(2020, 1, 10))]
+        state.advance(until, seen, timedelta(days=1))
+        self.assertEqual(state.window_start(timedelta(days=1)), datetime(2020, 1, 9))
+        self.assertEqual(state.known_archive_ids(), {'A1', 'A2'})
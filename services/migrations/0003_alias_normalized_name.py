@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    def fill_normalized_names(apps, schema_editor):
+        Alias = apps.get_model('services', 'Alias')
+        aliases = list(Alias.objects.only('id', 'name'))
+        for alias in aliases:
+            alias.normalized_name = alias.name.strip().lower()
+        Alias.objects.bulk_update(aliases, ['normalized_name'], batch_size=500)
+
+    dependencies = [
+        ('services', '0002_add_initial_servicetypes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alias',
+            name='normalized_name',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=128),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_normalized_names, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,12 @@
 from datetime import datetime
+import threading
+import time
 import unicodedata
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import connection, models
 from django.db.models import Q
 from django.core.exceptions import ValidationError
 
@@ -19,6 +22,11 @@ def remove_accents(string):
     return "".join([c for c in nkfd_form if not unicodedata.combining(c)])
 
 
+def normalize_alias(name):
+    """Form of an alias name used for case insensitive comparison"""
+    return name.strip().lower()
+
+
 def logging_log_change(sender, instance, created, **kwargs):
     operation = "created" if created else "modified"
     logger.info('%s %s: %s' % (sender.__name__, operation, repr(instance)))
@@ -71,6 +79,7 @@ class ServiceType(models.Model):
 class Alias(models.Model):
     owner = models.ForeignKey('membership.Membership', verbose_name=_('Alias owner'), on_delete=models.PROTECT)
     name = models.CharField(max_length=128, unique=True, verbose_name=_('Alias name'))
+    normalized_name = models.CharField(max_length=128, db_index=True, editable=False)
     account = models.BooleanField(default=False, verbose_name=_('Is primary member account, e.g. fall-back address for reminders'))
     created = models.DateTimeField(auto_now_add=True, verbose_name=_('Created'))
     comment = models.CharField(max_length=128, blank=True, verbose_name=_('Comment'))
@@ -134,8 +143,7 @@ class Alias(models.Model):
         all_initials_name.append(last_name)
         permutations.append(".".join(all_initials_name))
 
-        return [perm for perm in permutations
-                if cls.objects.filter(name__iexact=perm).count() == 0]
+        return cls.available_names(permutations)
 
     @classmethod
     def unix_logins(cls, membership=None, first_name=None, last_name=None,
@@ -170,10 +178,25 @@ class Alias(models.Model):
         for initial in initials:
             permutations.append(initial + last_name)
 
-        return [perm for perm in permutations
-                if cls.objects.filter(name__iexact=perm).count() == 0]
+        return cls.available_names(permutations)
+
+    @classmethod
+    def taken_names(cls, names):
+        """Returns the set of normalized names already reserved, in one query."""
+        normalized = {normalize_alias(name) for name in names}
+        if not normalized:
+            return set()
+        return set(cls.objects.filter(normalized_name__in=normalized)
+                   .values_list('normalized_name', flat=True))
+
+    @classmethod
+    def available_names(cls, names):
+        """Returns names that are not reserved, in their original order."""
+        taken = cls.taken_names(names)
+        return [name for name in names if normalize_alias(name) not in taken]
 
     def save(self,*args,**kwargs):
+        self.normalized_name = normalize_alias(self.name)
         try:
             self.full_clean()
         except ValidationError as e:
@@ -185,6 +208,47 @@ class Alias(models.Model):
         return self.name
 
 
+class TakenAliasNames(object):
+    """
+    In-process set of reserved alias names for the public availability checks.
+
+    The set is dropped on every Alias save and delete in this process and
+    reloaded at most ALIAS_NAME_CACHE_SECONDS after changes made by other
+    processes. Forms check the database, so a stale answer here is only
+    a hint to the applicant.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._loaded = 0
+
+    def names(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._names is None or now - self._loaded > settings.ALIAS_NAME_CACHE_SECONDS:
+                self._names = frozenset(Alias.objects.values_list('normalized_name', flat=True))
+                self._loaded = now
+            return self._names
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+
+    def is_taken(self, name):
+        # Uncommitted aliases must not leak to other requests
+        if connection.in_atomic_block:
+            return bool(Alias.taken_names([name]))
+        return normalize_alias(name) in self.names()
+
+
+taken_alias_names = TakenAliasNames()
+
+
+def _alias_changed(sender, instance, **kwargs):
+    taken_alias_names.invalidate()
+
+
 def valid_aliases(owner):
     """Builds a queryset of all valid aliases"""
     no_expire = Q(expiration_date=None)
@@ -194,3 +258,5 @@ def valid_aliases(owner):
 
 models.signals.post_save.connect(logging_log_change, sender=Alias)
 models.signals.post_save.connect(logging_log_change, sender=Service)
+models.signals.post_save.connect(_alias_changed, sender=Alias)
+models.signals.post_delete.connect(_alias_changed, sender=Alias)
@@ -6,7 +6,7 @@ from membership.utils import log_change
 from membership.utils import bake_log_entries
 from membership.models import Membership
 from membership.forms import VALID_USERNAME_RE
-from services.models import Alias
+from services.models import Alias, taken_alias_names
 from django.contrib.auth.decorators import permission_required
 from django.contrib import messages
 from django.forms import ModelForm, ModelChoiceField
@@ -95,7 +95,7 @@ def alias_add_for_member(request, id, template_name='membership/membership_add_a
 # Would this suffice? <http://djangosnippets.org/snippets/2276/>
 # This is called from membership.views.handle_json!
 def check_alias_availability(request, alias):
-    if Alias.objects.filter(name__iexact=alias).count() == 0:
+    if not taken_alias_names.is_taken(alias):
         return HttpResponse("true", content_type='text/plain')
     return HttpResponse("false", content_type='text/plain')
 
@@ -105,7 +105,7 @@ def check_alias_availability(request, alias):
 def validate_alias(request, alias):
     exists = True
     valid = True
-    if Alias.objects.filter(name__iexact=alias).count() == 0:
+    if not taken_alias_names.is_taken(alias):
         exists = False
     if re.match(VALID_USERNAME_RE, alias) is None:
         valid = False
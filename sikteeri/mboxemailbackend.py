@@ -23,25 +23,61 @@ def file_lock(file_handle):
 
 
 class EmailBackend(BaseEmailBackend):
+    """
+    Appends messages to the mbox file EMAIL_MBOX_FILE_PATH.
+
+    Between open() and close() the file is kept open and locked, so a
+    batch of messages is written through one buffered handle.
+    """
 
     def __init__(self, *args, **kwargs):
         self.file_path = getattr(settings, 'EMAIL_MBOX_FILE_PATH', None)
-        with open(self.file_path, 'a') as f:
-            with file_lock(f):
-                f.write('')
+        self.stream = None
         super(EmailBackend, self).__init__(*args, **kwargs)
 
+    def open(self):
+        """
+        :return: True if a new handle was opened
+        """
+        if self.stream is not None:
+            return False
+        try:
+            self.stream = open(self.file_path, 'a')
+            flock(self.stream, LOCK_EX)
+        except:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            if not self.fail_silently:
+                raise
+            return False
+        return True
+
+    def close(self):
+        if self.stream is None:
+            return
+        try:
+            self.stream.flush()
+            flock(self.stream, LOCK_UN)
+        finally:
+            self.stream.close()
+            self.stream = None
+
     def send_messages(self, email_messages):
         if not email_messages:
             return
+        new_stream = self.open()
+        if self.stream is None:
+            return 0
         try:
-            with open(self.file_path, 'a') as f:
-                with file_lock(f):
-                    for message in email_messages:
-                        f.write("From sikteeri Mon Mar 23 08:36:59 2009\n")
-                        f.write(message.message().as_string())
-                        f.write('\n\n')
+            for message in email_messages:
+                self.stream.write("From sikteeri Mon Mar 23 08:36:59 2009\n")
+                self.stream.write(message.message().as_string())
+                self.stream.write('\n\n')
         except:
             if not self.fail_silently:
                 raise
+        finally:
+            if new_stream:
+                self.close()
         return len(email_messages)
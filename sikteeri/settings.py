@@ -51,6 +51,8 @@ MEDIA_ROOT = config.get('MEDIA_ROOT', '')
 
 # Where to store cached PDFs
 CACHE_DIRECTORY = config.get('CACHE_DIRECTORY', 'cache')
+# How long alias availability answers may miss aliases made by other processes
+ALIAS_NAME_CACHE_SECONDS = int(config.get('ALIAS_NAME_CACHE_SECONDS', 60))
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.6/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = config.get('ALLOWED_HOSTS', [])
@@ -75,6 +77,8 @@ MAINTENANCE_MESSAGE = config.get('MAINTENANCE_MESSAGE', None)
 
 # Show 30 items per page in listview
 ENTRIES_PER_PAGE= int(config.get('ENTRIES_PER_PAGE', 30))
+# Total counts of keyset paginated lists are cached this long
+KEYSET_COUNT_CACHE_SECONDS = int(config.get('KEYSET_COUNT_CACHE_SECONDS', 300))
 
 # Hosts allowed to fetch statistics etc. without authentication
 TRUSTED_HOSTS = config.get('TRUSTED_HOSTS', [])
@@ -106,6 +110,20 @@ BILL_DAYS_TO_DUE = int(get_required('BILL_DAYS_TO_DUE'))
 REMINDER_GRACE_DAYS = int(get_required('REMINDER_GRACE_DAYS'))
 ENABLE_REMINDERS = config.get('ENABLE_REMINDERS', False)
 BILL_ATTACH_PDF = config.get('BILL_ATTACH_PDF', True)
+# How long fees edited by other processes may be served from memory
+FEE_SCHEDULE_CACHE_SECONDS = int(config.get('FEE_SCHEDULE_CACHE_SECONDS', 60))
+# If true, bills are queued to the outbox and sent by dispatch_outbox
+BILL_EMAIL_OUTBOX = config.get('BILL_EMAIL_OUTBOX', False)
+OUTBOX_BATCH_SIZE = int(config.get('OUTBOX_BATCH_SIZE', 100))
+# Messages per second, 0 is unlimited
+OUTBOX_RATE_LIMIT = float(config.get('OUTBOX_RATE_LIMIT', 0))
+OUTBOX_MAX_ATTEMPTS = int(config.get('OUTBOX_MAX_ATTEMPTS', 5))
+# Seconds before the first retry, doubled on every further attempt
+OUTBOX_RETRY_BACKOFF = int(config.get('OUTBOX_RETRY_BACKOFF', 60))
+# Seconds a dispatcher holds a claimed message before others may send it
+OUTBOX_LOCK_SECONDS = int(config.get('OUTBOX_LOCK_SECONDS', 600))
+# Seconds without progress after which a running payment import is requeued
+IMPORT_JOB_STALE_SECONDS = int(config.get('IMPORT_JOB_STALE_SECONDS', 600))
 # If set, a copy of reminders is sent to account@domain
 UNIX_EMAIL_DOMAIN = config.get('UNIX_EMAIL_DOMAIN', None)
 
@@ -113,6 +131,8 @@ UNIX_EMAIL_DOMAIN = config.get('UNIX_EMAIL_DOMAIN', None)
 SERVER_EMAIL = config.get('SERVER_EMAIL', 'root@localhost')
 FROM_EMAIL = get_required('FROM_EMAIL')
 SYSADMIN_EMAIL = get_required('SYSADMIN_EMAIL')
+# Messages sent over one email connection in bulk delivery
+EMAIL_BATCH_SIZE = int(config.get('EMAIL_BATCH_SIZE', 100))
 
 # Organization information 
 ORGANIZATION_REG_ID = get_required("ORGANIZATION_REG_ID")
@@ -122,6 +142,15 @@ BUSINESS_ID = get_required("BUSINESS_ID")
 
 FONT_PATH = os.path.join(BASE_DIR, 'external/fonts')
 IMG_PATH = os.path.join(BASE_DIR, 'external/img')
+# Processes rendering paper reminders in management commands, used for at
+# least PDF_PARALLEL_MIN_PAGES pages. Web requests render serially.
+PDF_RENDER_WORKERS = int(config.get('PDF_RENDER_WORKERS', 4))
+PDF_PARALLEL_MIN_PAGES = int(config.get('PDF_PARALLEL_MIN_PAGES', 200))
+# Larger rendered pdfs are spooled to a temporary file instead of memory
+PDF_SPOOL_MAX_SIZE = int(config.get('PDF_SPOOL_MAX_SIZE', 4 * 1024 * 1024))
+# Budget of the bill pdf cache, enforced by manage.py pdf_cache --evict
+PDF_CACHE_MAX_BYTES = int(config.get('PDF_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+PDF_CACHE_MAX_AGE_DAYS = int(config.get('PDF_CACHE_MAX_AGE_DAYS', 90))
 
 # When PRODUCTION is true, show production graphics and colours.
 # Otherwise indicate that this is a development environment (logo, colour)
@@ -136,6 +165,8 @@ PROCOUNTOR_COMPANY_ID = config.get('PROCOUNTOR_COMPANY_ID', 0)
 PROCOUNTOR_REDIRECT_URL = config.get('PROCOUNTOR_REDIRECT_URL', "redirect-url-placeholder")
 PROCOUNTOR_CLIENT_ID = config.get('PROCOUNTOR_CLIENT_ID', "")
 PROCOUNTOR_CLIENT_SECRET = config.get('PROCOUNTOR_CLIENT_SECRET', "")
+# Days before the last synced date fetched again on each incremental sync
+PROCOUNTOR_SYNC_OVERLAP_DAYS = int(config.get('PROCOUNTOR_SYNC_OVERLAP_DAYS', 1))
 
 ######################################################
 # Implementation details below - should not need